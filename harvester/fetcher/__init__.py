@@ -1,4 +1,5 @@
 from .fetcher import Fetcher
+from .fetcher import PagedFetcher
 from .fetcher import NoRecordsFetchedException
 from .oai_fetcher import OAIFetcher
 from .solr_fetcher import SolrFetcher
@@ -28,6 +29,7 @@ from .controller import EMAIL_RETURN_ADDRESS
 
 __all__ = (
         Fetcher,
+        PagedFetcher,
         NoRecordsFetchedException,
         HARVEST_TYPES,
         OAIFetcher,
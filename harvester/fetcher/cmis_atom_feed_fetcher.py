@@ -1,9 +1,13 @@
 # -*- coding: utf-8 -*-
-import requests
+import urllib
 from requests.auth import HTTPBasicAuth
 from xml.etree import ElementTree as ET
 from xmljson import badgerfish
 from .fetcher import Fetcher
+from . import http_client
+
+ATOM_NS = '{http://www.w3.org/2005/Atom}'
+CMISRA_NS = '{http://docs.oasis-open.org/ns/cmis/restatom/200908/}'
 
 
 class CMISAtomFeedFetcher(Fetcher):
@@ -14,15 +18,31 @@ class CMISAtomFeedFetcher(Fetcher):
     the data for one collection from one http request then parses the resulting
     data. This might not work if we get collections much bigger than the
     current ones (~1000 objects max)
+
+    The extra_data is "<username>, <password>". With a page size added,
+    "<username>, <password>, <maxItems>", the feed is requested in pages of
+    maxItems with skipCount, following the "next" links. Each page is
+    parsed as it is read and the entries are converted one at a time as
+    they are returned, so big collections are harvested in bounded memory.
     '''
 
     def __init__(self, url_harvest, extra_data, **kwargs):
         '''Grab file and copy to local temp file'''
         super(CMISAtomFeedFetcher, self).__init__(url_harvest, extra_data)
         # parse extra data for username,password
-        uname, pswd = extra_data.split(',')
-        resp = requests.get(url_harvest,
-                            auth=HTTPBasicAuth(uname.strip(), pswd.strip()))
+        params = [param.strip() for param in extra_data.split(',')]
+        uname, pswd = params[:2]
+        self.auth = HTTPBasicAuth(uname, pswd)
+        self.page_size = int(params[2]) if len(params) > 2 else None
+        if self.page_size:
+            sep = '&' if '?' in url_harvest else '?'
+            self.url_page = ''.join((url_harvest, sep, urllib.urlencode(
+                [('maxItems', self.page_size), ('skipCount', 0)])))
+            self.url_next = None
+            self.page_offset = 0
+            self._entries = None
+            return
+        resp = http_client.get(url_harvest, auth=self.auth)
         self.tree = ET.fromstring(resp.content)
         self.objects = [
             badgerfish.data(x)
@@ -33,7 +53,81 @@ class CMISAtomFeedFetcher(Fetcher):
         ]
         self.objects_iter = iter(self.objects)
 
+    def _iter_entries(self, url):
+        '''Generate the object entries of the feed page in document order,
+        the entries under the children of the top level entries. The page
+        is parsed as it is read. An entry & the entries nested in it are
+        returned once it ends, then it is removed from the tree.
+        Sets url_next from the "next" link of the feed.
+        '''
+        resp = http_client.get(url, auth=self.auth, stream=True)
+        try:
+            resp.raise_for_status()
+            resp.raw.decode_content = True
+            parents = []
+            children_open = 0
+            entries = []
+            for event, elem in ET.iterparse(resp.raw,
+                                            events=('start', 'end')):
+                if event == 'start':
+                    if elem.tag == CMISRA_NS + 'children':
+                        children_open += 1
+                    elif elem.tag == ATOM_NS + 'entry' and children_open:
+                        entries.append(elem)
+                    parents.append(elem)
+                    continue
+                parents.pop()
+                if elem.tag == CMISRA_NS + 'children':
+                    children_open -= 1
+                elif elem.tag == ATOM_NS + 'link' and len(parents) == 1 \
+                        and elem.get('rel') == 'next':
+                    self.url_next = elem.get('href')
+                elif elem.tag == ATOM_NS + 'entry' and (
+                        (entries and elem is entries[0]) or
+                        len(parents) == 1):
+                    for entry in entries:
+                        yield entry
+                    entries = []
+                    parents[-1].remove(elem)
+        finally:
+            resp.close()
+
+    def _next_entry(self):
+        '''Return the next object entry, moving on to the next page at
+        the end of one'''
+        while True:
+            try:
+                if self._entries is None:
+                    self.url_next = None
+                    self._entries = self._iter_entries(self.url_page)
+                    for n in range(self.page_offset):
+                        next(self._entries)
+                entry = next(self._entries)
+                self.page_offset += 1
+                return entry
+            except StopIteration:
+                self._entries = None
+                if not self.url_next:
+                    raise
+                self.url_page = self.url_next
+                self.page_offset = 0
+
+    def get_checkpoint(self):
+        '''The URL of the page & the number of objects returned from it,
+        for a paged harvest'''
+        if not self.page_size:
+            return None
+        return {'url_page': self.url_page, 'page_offset': self.page_offset}
+
+    def resume(self, checkpoint):
+        if not self.page_size:
+            raise NotImplementedError
+        self.url_page = checkpoint['url_page']
+        self.page_offset = checkpoint['page_offset']
+
     def next(self):
+        if self.page_size:
+            return badgerfish.data(self._next_entry())
         return self.objects_iter.next()
 
 
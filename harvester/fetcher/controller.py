@@ -1,12 +1,21 @@
 # -*- coding: utf-8 -*-
 import os
+import sys
 import tempfile
+import threading
+import time
+import Queue
 import urlparse
 import datetime
 import uuid
 import json
+import hashlib
+import gzip
+import re
 import codecs
+import StringIO
 import boto3
+from botocore.exceptions import ClientError
 from email.mime.text import MIMEText
 import logbook
 from logbook import FileHandler
@@ -15,6 +24,8 @@ from ..collection_registry_client import Collection
 from .. import config
 from .fetcher import Fetcher
 from .fetcher import NoRecordsFetchedException
+from .page_writer import S3PageWriter
+from .page_writer import PART_SIZE
 from .oai_fetcher import OAIFetcher
 from .solr_fetcher import SolrFetcher
 from .solr_fetcher import PySolrQueryFetcher
@@ -56,6 +67,14 @@ HARVEST_TYPES = {
 }
 
 
+class JSONPage(list):
+    '''A page of harvested objects with the JSON for each, serialized
+    once to size the page and reused to save it'''
+    def __init__(self, objs, objs_json):
+        super(JSONPage, self).__init__(objs)
+        self.json = objs_json
+
+
 class HarvestController(object):
     '''Controller for the harvesting. Selects correct Fetcher for the given
     collection, then retrieves records for the given collection and saves to
@@ -73,13 +92,51 @@ class HarvestController(object):
     ]
     bucket = 'ucldc-ingest'
     tmpl_s3path = 'data-fetched/{cid}/{datetime_start}/'
+    tmpl_s3_checkpoint = 'data-fetched/{cid}/checkpoint.json'
+    tmpl_s3_last_harvest = 'data-fetched/{cid}/last-harvest.json'
+    tmpl_s3_digests = 'data-fetched/{cid}/digests.txt.gz'
+    fmt_datetime_start = '%Y-%m-%d-%H%M'
+    fmt_harvested_at = '%Y-%m-%dT%H:%M:%SZ'
+    re_page_key = re.compile(r'page-(?P<page>\d+)\.jsonl(?P<gz>\.gz)?$')
 
     def __init__(self,
                  user_email,
                  collection,
                  profile_path=None,
                  config_file=None,
+                 pipeline_workers=0,
+                 pipeline_queue_size=4,
+                 s3_compress=False,
+                 s3_part_size=PART_SIZE,
+                 page_records=None,
+                 page_bytes=None,
+                 page_seconds=None,
+                 checkpoint_interval=60,
+                 resume=False,
+                 incremental=False,
                  **kwargs):
+        '''If pipeline_workers is set, objsets are written to disk & S3 by
+        that many writer threads while the fetcher gets the next page.
+        pipeline_queue_size is the number of fetched objsets allowed to wait
+        for a writer before the fetcher blocks.
+        If s3_compress is set, pages are saved gzipped as page-N.jsonl.gz.
+        Pages bigger than s3_part_size go up as S3 multipart uploads.
+        If page_records or page_bytes is set, objsets from the fetcher are
+        coalesced into pages of about that many records or bytes of JSON
+        before being saved. page_seconds also flushes a page once its first
+        record has waited that long.
+        For fetchers that support it, a checkpoint of the fetch position is
+        saved next to the pages on S3 at most every checkpoint_interval
+        seconds (None turns this off). If resume is set, the harvest picks
+        up from the last checkpoint saved for the collection. A harvest
+        that isn't resumed, or completes, removes the checkpoint.
+        If incremental is set, fetchers that support it only get the records
+        changed since the last successful harvest of the collection. Every
+        record is marked "changed" or "unchanged" in harvest_delta, by its
+        digest against the one saved for its record id by the last
+        incremental harvest, and only changed records are saved to disk for
+        the ingest.
+        '''
         self.user_email = user_email  # single or list
         self.collection = collection
         self.profile_path = profile_path
@@ -92,11 +149,20 @@ class HarvestController(object):
         if not self.couch_dashboard_name:
             self.couch_dashboard_name = 'dashboard'
 
+        self.logger = logbook.Logger('HarvestController')
+        self.incremental = incremental
+        self.last_harvest = None
+        self.since = None
         cls_fetcher = HARVEST_TYPES.get(self.collection.harvest_type, None)
+        if incremental:
+            self.last_harvest = self.load_last_harvest()
+            if self.last_harvest and cls_fetcher.supports_since:
+                self.since = datetime.datetime.strptime(
+                    self.last_harvest['harvested_at'], self.fmt_harvested_at)
+                kwargs['since'] = self.since
         self.fetcher = cls_fetcher(self.collection.url_harvest,
                                    self.collection.harvest_extra_data,
                                    **kwargs)
-        self.logger = logbook.Logger('HarvestController')
         self.dir_save = tempfile.mkdtemp('_' + self.collection.slug)
         self.ingest_doc_id = None
         self.ingestion_doc = None
@@ -104,12 +170,47 @@ class HarvestController(object):
         self.num_records = 0
         self.datetime_start = datetime.datetime.now()
         self.objset_page = 0
+        self.pipeline_workers = pipeline_workers
+        self.pipeline_queue_size = pipeline_queue_size
+        self.s3_compress = s3_compress
+        self.s3_part_size = s3_part_size
+        self.page_records = page_records
+        self.page_bytes = page_bytes
+        self.page_seconds = page_seconds
+        self._registry_block = None
+        self._registry_json = None
+        self.checkpoint_interval = checkpoint_interval
+        self.resume = resume
+        self.checkpoint = None
+        self.num_records_resumed = 0
+        self._checkpoint_lock = threading.Lock()
+        self._page_cursors = {}
+        self._pages_saved = set()
+        self._page_last_saved = -1
+        self._checkpoint_saved_at = None
+        self.harvested_at = None
+        self.num_records_changed = 0
+        self._digests = {}
+        self._digests_previous = {}
 
     @property
     def s3path(self):
         return self.tmpl_s3path.format(
             cid=self.collection.id,
-            datetime_start=self.datetime_start.strftime('%Y-%m-%d-%H%M'))
+            datetime_start=self.datetime_start.strftime(
+                self.fmt_datetime_start))
+
+    @property
+    def s3_checkpoint_key(self):
+        return self.tmpl_s3_checkpoint.format(cid=self.collection.id)
+
+    @property
+    def s3_last_harvest_key(self):
+        return self.tmpl_s3_last_harvest.format(cid=self.collection.id)
+
+    @property
+    def s3_digests_key(self):
+        return self.tmpl_s3_digests.format(cid=self.collection.id)
 
     @staticmethod
     def dt_json_handler(obj):
@@ -125,34 +226,64 @@ class HarvestController(object):
     def jsonl(objset):
         '''Return a JSONL string for a given set of python objects
         '''
-        jsonl = ''
         if isinstance(objset, dict):
             objset = [objset]
-        for obj in objset:
-            jsonl += ''.join((json.dumps(
-                obj, default=HarvestController.dt_json_handler), '\n'))
-        return jsonl
+        return ''.join([''.join((json.dumps(
+            obj, default=HarvestController.dt_json_handler), '\n'))
+            for obj in objset])
 
-    def save_objset_s3(self, objset):
-        '''Save the objset to a bucket'''
-        if not hasattr(self, 's3'):
-            self.s3 = boto3.resource('s3')
-        body = HarvestController.jsonl(objset)
-        bucket = self.s3.Bucket('ucldc-ingest')
-        key = ''.join((self.s3path, 'page-{}.jsonl'.format(self.objset_page)))
-        self.objset_page += 1
-        bucket.put_object(Body=body, Key=key)
+    def _objs_json(self, objset):
+        '''Pairs of each object in the objset & its JSON'''
+        if isinstance(objset, JSONPage):
+            return zip(objset, objset.json)
+        return ((obj, self.dumps(obj)) for obj in objset)
+
+    def save_objset_s3(self, objset, page=None, s3=None):
+        '''Save the objset to a bucket.
+        If page is None, the next page number is used. The pipelined
+        writers pass in the page number assigned at fetch time and their own
+        s3 resource, boto3 resources are not thread safe.
+        '''
+        if not s3:
+            if not hasattr(self, 's3'):
+                self.s3 = boto3.resource('s3')
+            s3 = self.s3
+        if page is None:
+            page = self.objset_page
+            self.objset_page += 1
+        if isinstance(objset, dict):
+            objset = [objset]
+        key = ''.join((self.s3path, 'page-{}.jsonl'.format(page)))
+        if self.s3_compress:
+            key = ''.join((key, '.gz'))
+        with S3PageWriter(
+                s3.Bucket('ucldc-ingest'),
+                key,
+                compress=self.s3_compress,
+                part_size=self.s3_part_size,
+                dumps=self.dumps) as writer:
+            for obj, obj_json in self._objs_json(objset):
+                writer.write_json(obj_json)
 
     def save_objset(self, objset):
         '''Save an object set to disk. If it is a single object, wrap in a
         list to be uniform'''
         filename = os.path.join(self.dir_save, str(uuid.uuid4()))
-        if not type(objset) == list:
+        if not isinstance(objset, list):
             objset = [objset]
+        objs_json = self._objs_json(objset)
+        if self.incremental:
+            objs_json = [(obj, obj_json) for obj, obj_json in objs_json
+                         if obj.get('harvest_delta') != 'unchanged']
+            if not objs_json:
+                return
         with open(filename, 'w') as foo:
-            foo.write(
-                json.dumps(
-                    objset, default=HarvestController.dt_json_handler))
+            foo.write('[')
+            for n, (obj, obj_json) in enumerate(objs_json):
+                if n:
+                    foo.write(', ')
+                foo.write(obj_json)
+            foo.write(']')
 
     def create_ingest_doc(self):
         '''Create the DPLA style ingest doc in couch for this harvest session.
@@ -200,6 +331,13 @@ class HarvestController(object):
             "fetch_process/total_items": items,
             "fetch_process/total_collections": num_coll
         }
+        if self.checkpoint:
+            kwargs["fetch_process/checkpoint"] = self.checkpoint
+        if self.incremental:
+            kwargs["fetch_process/incremental"] = True
+            kwargs["fetch_process/since"] = self.since.isoformat() \
+                if self.since else None
+            kwargs["fetch_process/changed_items"] = self.num_records_changed
         if not self.ingestion_doc:
             self.create_ingest_doc()
         try:
@@ -209,56 +347,118 @@ class HarvestController(object):
                               (self.ingestion_doc["_id"], __name__))
             raise e
 
+    @property
+    def registry_block(self):
+        '''The registry based data attached to every harvested object.
+        It is the same for every object in a harvest, so it is built once
+        and the one list is shared by all objects. Do not modify it.
+        The JSON for it is cached as well, see dumps.
+        '''
+        if self._registry_block is None:
+            # get base registry URL
+            url_tuple = urlparse.urlparse(self.collection.url)
+            base_url = ''.join((url_tuple.scheme, '://', url_tuple.netloc))
+            self.collection['@id'] = self.collection.url
+            self.collection['id'] = self.collection.url.strip('/').rsplit(
+                '/', 1)[1]
+            self.collection['ingestType'] = 'collection'
+            self.collection['title'] = self.collection.name
+            collection = dict(self.collection)
+            campus = []
+            for c in self.collection.get('campus', []):
+                c.update({'@id': ''.join((base_url, c['resource_uri']))})
+                campus.append(c)
+            collection['campus'] = campus
+            repository = []
+            for r in self.collection['repository']:
+                r.update({'@id': ''.join((base_url, r['resource_uri']))})
+                repository.append(r)
+            collection['repository'] = repository
+            # in future may be more than one
+            self._registry_json = json.dumps(
+                [collection], default=HarvestController.dt_json_handler)
+            self._registry_block = [collection]
+        return self._registry_block
+
     def _add_registry_data(self, obj):
         '''Add the registry based data to the harvested object.
         '''
-        # get base registry URL
-        url_tuple = urlparse.urlparse(self.collection.url)
-        base_url = ''.join((url_tuple.scheme, '://', url_tuple.netloc))
-        self.collection['@id'] = self.collection.url
-        self.collection['id'] = self.collection.url.strip('/').rsplit('/',
-                                                                      1)[1]
-        self.collection['ingestType'] = 'collection'
-        self.collection['title'] = self.collection.name
         if 'collection' in obj:
             # save before hammering
             obj['source_collection_name'] = obj['collection']
-        obj['collection'] = dict(self.collection)
-        campus = []
-        for c in self.collection.get('campus', []):
-            c.update({'@id': ''.join((base_url, c['resource_uri']))})
-            campus.append(c)
-        obj['collection']['campus'] = campus
-        repository = []
-        for r in self.collection['repository']:
-            r.update({'@id': ''.join((base_url, r['resource_uri']))})
-            repository.append(r)
-        obj['collection']['repository'] = repository
-        # in future may be more than one
-        obj['collection'] = [obj['collection']]
+        obj['collection'] = self.registry_block
         return obj
 
-    def harvest(self):
-        '''Harvest the collection'''
-        self.logger.info(' '.join((
-            'Starting harvest for:',
-            str(self.user_email),
-            self.collection.url,
-            str(self.collection['campus']),
-            str(self.collection['repository']))))
-        self.num_records = 0
+    def _record_digest(self, obj):
+        '''Return the key & the digest of the JSON of a harvested object,
+        before the registry data is added. The key is the record id from
+        the fetcher, or the digest for records without one.
+        '''
+        digest = hashlib.md5(json.dumps(
+            obj, sort_keys=True,
+            default=HarvestController.dt_json_handler)).hexdigest()
+        record_id = self.fetcher.record_id(obj)
+        return (digest if record_id is None else record_id), digest
+
+    def _mark_delta(self, obj):
+        '''Mark the harvested object as changed or unchanged since the last
+        incremental harvest, by the digest of its JSON.
+        Call before the registry data is added.
+        '''
+        key, digest = self._record_digest(obj)
+        self._digests[key] = digest
+        if self._digests_previous.get(key) == digest:
+            obj['harvest_delta'] = 'unchanged'
+        else:
+            obj['harvest_delta'] = 'changed'
+            self.num_records_changed += 1
+        return obj
+
+    def _resumed_delta(self, obj):
+        '''Count & digest a record saved before the harvest was resumed, as
+        _mark_delta did. The digest is of the record as fetched, without
+        harvest_delta & the registry data.
+        '''
+        obj = dict(obj)
+        if obj.pop('harvest_delta', None) == 'changed':
+            self.num_records_changed += 1
+        obj.pop('collection', None)
+        if 'source_collection_name' in obj:
+            obj['collection'] = obj.pop('source_collection_name')
+        key, digest = self._record_digest(obj)
+        self._digests[key] = digest
+
+    def dumps(self, obj):
+        '''Return the JSON for a harvested object.
+        If the object has the registry block, the cached JSON for the block
+        is spliced in instead of encoding the collection again.
+        '''
+        if self._registry_block is None or not isinstance(obj, dict) or \
+                obj.get('collection') is not self._registry_block:
+            return json.dumps(obj, default=HarvestController.dt_json_handler)
+        obj_rest = dict(obj)
+        del obj_rest['collection']
+        if not obj_rest:
+            return ''.join(('{"collection": ', self._registry_json, '}'))
+        return ''.join((
+            json.dumps(obj_rest, default=HarvestController.dt_json_handler)
+            [:-1], ', "collection": ', self._registry_json, '}'))
+
+    def _objsets(self):
+        '''Iterate over the fetcher, adding the registry data to each
+        object & logging progress. Yields the objsets ready to save.
+        '''
+        self.num_records = self.num_records_resumed
         next_log_n = interval = 100
         for objset in self.fetcher:
-            if isinstance(objset, list):
-                self.num_records += len(objset)
-                # TODO: use map here
-                for obj in objset:
-                    self._add_registry_data(obj)
-            else:
-                self.num_records += 1
-                self._add_registry_data(objset)
-            self.save_objset(objset)
-            self.save_objset_s3(objset)
+            objs = objset if isinstance(objset, list) else [objset]
+            self.num_records += len(objs)
+            # TODO: use map here
+            for obj in objs:
+                if self.incremental:
+                    self._mark_delta(obj)
+                self._add_registry_data(obj)
+            yield objset
             if self.num_records >= next_log_n:
                 self.logger.info(' '.join((str(self.num_records),
                                            'records harvested')))
@@ -267,10 +467,344 @@ class HarvestController(object):
                     interval = 10 * interval
                 next_log_n += interval
 
-        if self.num_records == 0:
+    def _pages(self):
+        '''Coalesce the objsets from _objsets into pages to save.
+        Fetchers that return one record per next() would otherwise make a
+        file & an S3 object per record.
+        A page is flushed when it reaches page_records or page_bytes, when
+        page_seconds have passed since its first objset arrived, or at the
+        end of the fetch.
+        Without page_records or page_bytes the objsets pass through as is.
+        With page_bytes the pages are JSONPages, the JSON used to size them
+        is the JSON saved.
+        '''
+        if not (self.page_records or self.page_bytes):
+            for objset in self._objsets():
+                yield objset
+            return
+        page = []
+        page_json = []
+        page_bytes = 0
+        page_start = None
+        for objset in self._objsets():
+            if isinstance(objset, dict):
+                objset = [objset]
+            if not page:
+                page_start = time.time()
+            page.extend(objset)
+            if self.page_bytes:
+                objs_json = [self.dumps(obj) for obj in objset]
+                page_json.extend(objs_json)
+                page_bytes += sum(len(obj_json) + 1 for obj_json in objs_json)
+            if (self.page_records and len(page) >= self.page_records) or \
+                    (self.page_bytes and page_bytes >= self.page_bytes) or \
+                    (self.page_seconds and
+                     time.time() - page_start >= self.page_seconds):
+                yield JSONPage(page, page_json) if self.page_bytes else page
+                page = []
+                page_json = []
+                page_bytes = 0
+        if page:
+            yield JSONPage(page, page_json) if self.page_bytes else page
+
+    def _fetched_page(self, page):
+        '''Note the fetcher position at the end of a page, from the fetch
+        thread before the next page is fetched.'''
+        cursor = self.fetcher.get_checkpoint()
+        if cursor is not None:
+            with self._checkpoint_lock:
+                self._page_cursors[page] = (cursor, self.num_records)
+
+    def _saved_page(self, page, s3=None):
+        '''Note a page is saved to disk & S3.
+        The checkpoint moves to the last page with all pages before it
+        saved, pipelined writers can finish pages out of order. It is saved
+        to S3 if checkpoint_interval seconds have passed since the last save.
+        '''
+        with self._checkpoint_lock:
+            self._pages_saved.add(page)
+            while self._page_last_saved + 1 in self._pages_saved:
+                self._page_last_saved += 1
+                self._pages_saved.remove(self._page_last_saved)
+                cursor, num_records = self._page_cursors.pop(
+                    self._page_last_saved, (None, None))
+                if cursor is not None:
+                    self.checkpoint = {
+                        'harvest_type': self.collection.harvest_type,
+                        'url_harvest': self.collection.url_harvest,
+                        'datetime_start': self.datetime_start.strftime(
+                            self.fmt_datetime_start),
+                        'harvested_at': self.harvested_at.strftime(
+                            self.fmt_harvested_at),
+                        'page': self._page_last_saved,
+                        'num_records': num_records,
+                        'cursor': cursor
+                    }
+            if self.checkpoint and self.checkpoint_interval is not None and \
+                    time.time() - self._checkpoint_saved_at >= \
+                    self.checkpoint_interval:
+                self.save_checkpoint(s3=s3)
+
+    def save_checkpoint(self, s3=None):
+        '''Save the current checkpoint for the collection to S3'''
+        if not s3:
+            if not hasattr(self, 's3'):
+                self.s3 = boto3.resource('s3')
+            s3 = self.s3
+        s3.Bucket('ucldc-ingest').put_object(
+            Body=json.dumps(self.checkpoint), Key=self.s3_checkpoint_key)
+        self._checkpoint_saved_at = time.time()
+
+    def delete_checkpoint(self):
+        '''Remove the checkpoint saved for the collection, so it can't be
+        resumed'''
+        if not hasattr(self, 's3'):
+            self.s3 = boto3.resource('s3')
+        self.s3.Bucket('ucldc-ingest').Object(self.s3_checkpoint_key).delete()
+
+    def _checkpoint_completed(self, checkpoint):
+        '''True if the harvest that saved the checkpoint completed, the
+        last harvest recorded for the collection started at the same time'''
+        try:
+            last_harvest = json.loads(self.s3.Bucket('ucldc-ingest').Object(
+                self.s3_last_harvest_key).get()['Body'].read())
+        except (ClientError, ValueError):
+            return False
+        return last_harvest.get('datetime_start') == \
+            checkpoint['datetime_start']
+
+    def _resume_harvest(self):
+        '''Pick up the harvest from the checkpoint saved for the
+        collection.
+        The harvest continues in the same S3 directory after the last
+        page saved. The pages already on S3 are copied into dir_save so the
+        rest of the ingest sees the whole collection. For incremental
+        harvests their changed records are counted & their digests kept.
+        '''
+        if not hasattr(self, 's3'):
+            self.s3 = boto3.resource('s3')
+        bucket = self.s3.Bucket('ucldc-ingest')
+        try:
+            checkpoint = json.loads(bucket.Object(
+                self.s3_checkpoint_key).get()['Body'].read())
+        except ClientError:
+            self.logger.warning('No checkpoint at {}, harvesting from the '
+                                'start'.format(self.s3_checkpoint_key))
+            return
+        if checkpoint['harvest_type'] != self.collection.harvest_type or \
+                checkpoint['url_harvest'] != self.collection.url_harvest:
+            self.logger.warning('Checkpoint at {} is for a different harvest '
+                                'setup, harvesting from the start'.format(
+                                    self.s3_checkpoint_key))
+            return
+        if self._checkpoint_completed(checkpoint):
+            self.logger.warning('Checkpoint at {} is for a completed harvest, '
+                                'harvesting from the start'.format(
+                                    self.s3_checkpoint_key))
+            return
+        self.fetcher.resume(checkpoint['cursor'])
+        self.checkpoint = checkpoint
+        self.datetime_start = datetime.datetime.strptime(
+            checkpoint['datetime_start'], self.fmt_datetime_start)
+        if 'harvested_at' in checkpoint:
+            self.harvested_at = datetime.datetime.strptime(
+                checkpoint['harvested_at'], self.fmt_harvested_at)
+        self.objset_page = checkpoint['page'] + 1
+        self._page_last_saved = checkpoint['page']
+        self.num_records_resumed = checkpoint['num_records']
+        for obj_summary in bucket.objects.filter(Prefix=self.s3path):
+            match = self.re_page_key.search(obj_summary.key)
+            if not match or int(match.group('page')) > checkpoint['page']:
+                continue
+            body = obj_summary.get()['Body'].read()
+            if match.group('gz'):
+                body = gzip.GzipFile(fileobj=StringIO.StringIO(body)).read()
+            lines = body.splitlines()
+            if self.incremental:
+                objs = [json.loads(line) for line in lines]
+                for obj in objs:
+                    self._resumed_delta(obj)
+                lines = [line for line, obj in zip(lines, objs)
+                         if obj.get('harvest_delta') != 'unchanged']
+                if not lines:
+                    continue
+            filename = os.path.join(self.dir_save, str(uuid.uuid4()))
+            with open(filename, 'w') as foo:
+                foo.write(''.join(('[', ', '.join(lines), ']')))
+        self.logger.info('Resuming harvest at page {} after {} records'.format(
+            self.objset_page, self.num_records_resumed))
+
+    def load_last_harvest(self):
+        '''Return the record of the last successful harvest of the
+        collection, None if there isn't one for the current harvest setup.
+        '''
+        if not hasattr(self, 's3'):
+            self.s3 = boto3.resource('s3')
+        try:
+            last_harvest = json.loads(self.s3.Bucket('ucldc-ingest').Object(
+                self.s3_last_harvest_key).get()['Body'].read())
+        except ClientError:
+            self.logger.warning('No last harvest at {}, harvesting all '
+                                'records'.format(self.s3_last_harvest_key))
+            return None
+        if last_harvest['harvest_type'] != self.collection.harvest_type or \
+                last_harvest['url_harvest'] != self.collection.url_harvest or \
+                last_harvest['harvest_extra_data'] != \
+                self.collection.harvest_extra_data:
+            self.logger.warning('Last harvest at {} is for a different '
+                                'harvest setup, harvesting all records'.format(
+                                    self.s3_last_harvest_key))
+            return None
+        return last_harvest
+
+    def load_digests(self):
+        '''Return the record digests saved by the last incremental harvest,
+        by record id. Each line of the file is a record id, a tab & the
+        digest, lines without a record id are from the old format and are
+        ignored.'''
+        if not self.last_harvest:
+            return {}
+        if not hasattr(self, 's3'):
+            self.s3 = boto3.resource('s3')
+        try:
+            body = self.s3.Bucket('ucldc-ingest').Object(
+                self.s3_digests_key).get()['Body'].read()
+        except ClientError:
+            return {}
+        lines = gzip.GzipFile(
+            fileobj=StringIO.StringIO(body)).read().decode('utf-8')
+        return dict(line.rsplit(u'\t', 1) for line in lines.splitlines()
+                    if u'\t' in line)
+
+    def save_last_harvest(self):
+        '''Record the successful harvest of the collection on S3.
+        The time saved is when the fetch started, so changes made during
+        the fetch are picked up by the next incremental harvest.
+        Incremental harvests save the record digests as well, a full harvest
+        removes them. datetime_start identifies the harvest run, so its
+        checkpoint is never resumed.
+        '''
+        if not hasattr(self, 's3'):
+            self.s3 = boto3.resource('s3')
+        bucket = self.s3.Bucket('ucldc-ingest')
+        bucket.put_object(
+            Key=self.s3_last_harvest_key,
+            Body=json.dumps({
+                'harvest_type': self.collection.harvest_type,
+                'url_harvest': self.collection.url_harvest,
+                'harvest_extra_data': self.collection.harvest_extra_data,
+                'harvested_at': self.harvested_at.strftime(
+                    self.fmt_harvested_at),
+                'datetime_start': self.datetime_start.strftime(
+                    self.fmt_datetime_start),
+                'incremental': self.incremental,
+                'num_records': self.num_records,
+                'num_records_changed': self.num_records_changed
+            }))
+        if not self.incremental:
+            bucket.Object(self.s3_digests_key).delete()
+            return
+        digests = self._digests
+        if self.since:  # records not fetched are unchanged
+            digests = dict(self._digests_previous)
+            digests.update(self._digests)
+        body = StringIO.StringIO()
+        with gzip.GzipFile(fileobj=body, mode='wb') as gzfoo:
+            gzfoo.write(u'\n'.join(
+                u'\t'.join((key, digest))
+                for key, digest in sorted(digests.items())).encode('utf-8'))
+        bucket.put_object(Key=self.s3_digests_key, Body=body.getvalue())
+
+    def _harvest_pipelined(self):
+        '''Fetch objsets in this thread while a pool of writer threads
+        saves them to disk & S3.
+        The queue between them is bounded, so the fetcher blocks when the
+        writers fall behind. Page numbers are assigned in fetch order.
+        The first writer error stops the fetch and is re-raised here.
+        '''
+        objset_queue = Queue.Queue(maxsize=self.pipeline_queue_size)
+        errors = []
+
+        def writer(s3):
+            while True:
+                item = objset_queue.get()
+                try:
+                    if item is None:
+                        return
+                    if errors:  # drain the queue, fetcher is stopping
+                        continue
+                    page, objset = item
+                    self.save_objset(objset)
+                    self.save_objset_s3(objset, page=page, s3=s3)
+                    self._saved_page(page, s3=s3)
+                except Exception:
+                    errors.append(sys.exc_info())
+                finally:
+                    objset_queue.task_done()
+
+        workers = []
+        for n in range(self.pipeline_workers):
+            # create resources here, creating from threads is not safe
+            worker = threading.Thread(
+                target=writer,
+                args=(boto3.resource('s3'), ),
+                name='HarvestWriter-{}'.format(n))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        try:
+            for objset in self._pages():
+                self._fetched_page(self.objset_page)
+                objset_queue.put((self.objset_page, objset))
+                self.objset_page += 1
+                if errors:
+                    break
+        finally:
+            for worker in workers:
+                objset_queue.put(None)
+            for worker in workers:
+                worker.join()
+        if errors:
+            exc_type, exc_value, exc_tb = errors[0]
+            raise exc_type, exc_value, exc_tb
+
+    def harvest(self):
+        '''Harvest the collection'''
+        self.logger.info(' '.join((
+            'Starting harvest for:',
+            str(self.user_email),
+            self.collection.url,
+            str(self.collection['campus']),
+            str(self.collection['repository']))))
+        self.harvested_at = datetime.datetime.utcnow()
+        if self.resume:
+            self._resume_harvest()
+        if not self.checkpoint:  # a new run, drop the checkpoint of any other
+            self.delete_checkpoint()
+        if self.incremental:
+            self._digests_previous = self.load_digests()
+        self._checkpoint_saved_at = time.time()
+        try:
+            if self.pipeline_workers:
+                self._harvest_pipelined()
+            else:
+                for objset in self._pages():
+                    page = self.objset_page
+                    self._fetched_page(page)
+                    self.save_objset(objset)
+                    self.save_objset_s3(objset)
+                    self._saved_page(page)
+        finally:
+            self.fetcher.close()
+
+        if self.num_records == 0 and not self.since:
             raise NoRecordsFetchedException
         msg = ' '.join((str(self.num_records), 'records harvested'))
+        if self.incremental:
+            msg = ' '.join((msg, str(self.num_records_changed), 'changed'))
         self.logger.info(msg)
+        self.save_last_harvest()
+        self.delete_checkpoint()
         return self.num_records
 
 
@@ -283,6 +817,14 @@ def parse_args():
         type=str,
         nargs='?',
         help='URL for the collection Django tastypie api resource')
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help='Resume from the last checkpoint saved for the collection')
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help='Only ingest records new or changed since the last harvest')
     return parser.parse_args()
 
 
@@ -383,11 +925,23 @@ def main(user_email,
     ingest_doc_id = harvester.create_ingest_doc()
     logger.info('Ingest DOC ID: ' + ingest_doc_id)
     logger.info('Start harvesting next')
-    num_recs = harvester.harvest()
+    try:
+        num_recs = harvester.harvest()
+    except Exception as e:
+        import traceback
+        error_msg = ''.join(("Error while harvesting: type-> ", str(type(e)),
+                             " TRACE:\n" + str(traceback.format_exc())))
+        logger.error(error_msg)
+        harvester.update_ingest_doc(
+            'error', error_msg=error_msg, items=harvester.num_records)
+        raise e
     msg = ''.join(('Finished harvest of ', collection.slug, '. ',
                    str(num_recs), ' records harvested.'))
     logger.info(msg)
     logger.debug('-- get a new harvester --')
+    harvester_done = harvester
+    # last-harvest.json now holds this run, don't load it for the new one
+    kwargs['incremental'] = False
     harvester = HarvestController(
          user_email,
          collection,
@@ -395,6 +949,10 @@ def main(user_email,
          config_file=config_file,
          **kwargs)
     harvester.ingest_doc_id = ingest_doc_id
+    harvester.incremental = harvester_done.incremental
+    harvester.since = harvester_done.since
+    harvester.last_harvest = harvester_done.last_harvest
+    harvester.num_records_changed = harvester_done.num_records_changed
     harvester.couch = dplaingestion.couch.Couch(
             config_file=harvester.config_file,
             dpla_db_name=harvester.couch_db_name,
@@ -422,7 +980,8 @@ __all__ = (Fetcher, NoRecordsFetchedException, HARVEST_TYPES)
 
 if __name__ == '__main__':
     args = parse_args()
-    main(args.user_email, args.url_api_collection)
+    main(args.user_email, args.url_api_collection, resume=args.resume,
+         incremental=args.incremental)
 
 # Copyright © 2016, Regents of the University of California
 # All rights reserved.
@@ -1,27 +1,28 @@
 # -*- coding: utf-8 -*-
 import datetime
 import time
-import requests
 import re
 from xml.etree import ElementTree as ET
 from collections import defaultdict
-from .fetcher import Fetcher
+from .fetcher import PagedFetcher
+from . import http_client
 
-class eMuseum_Fetcher(Fetcher):
+class eMuseum_Fetcher(PagedFetcher):
     '''Paginates through eMuseum API XML search results until
         no more records are found'''
 
     def __init__(self, url_harvest, extra_data, **kwargs):
+        super(eMuseum_Fetcher, self).__init__(url_harvest, extra_data,
+                                              **kwargs)
         self.url_base = url_harvest
-        self.page_current = 1
-        self.doc_current = 1
-        self.docs_fetched = 0
 
     @property
     def url_current(self):
+        return self.url_page(self.page_current)
+
+    def url_page(self, page):
         quote_param = '/search/*/objects/xml?filter=approved%3Atrue&page='
-        return '{0}{1}{2}'.format(self.url_base, quote_param,
-                                  self.page_current)
+        return '{0}{1}{2}'.format(self.url_base, quote_param, page)
 
     def _dochits_to_objset(self, docHits):
         '''Returns list of objects. Use 'name' attribute
@@ -63,19 +64,15 @@ class eMuseum_Fetcher(Fetcher):
             objset.append(obj)
         return objset
 
-    def next(self):
-        '''get next objset, use etree to pythonize. Stop
-        iterating when no more <object>s are found'''
+    def fetch_page(self, page):
+        '''get objset for the page, use etree to pythonize. The total is
+        not known, iterating stops when no more <object>s are found'''
         dt_start = dt_end = datetime.datetime.now()
-        xml = requests.get(self.url_current).text
+        xml = http_client.get(self.url_page(page)).text
         dt_end = datetime.datetime.now()
         time.sleep((dt_end-dt_start).total_seconds())
         tree = ET.fromstring(xml.encode('utf-8'))
         hits = tree.findall("objects/object")
-        self.docs_total = len(hits)
-        if self.docs_total == 0:
-            raise StopIteration
-        self.page_current += 1
         return self._dochits_to_objset(hits)
 
 # Copyright © 2016, Regents of the University of California
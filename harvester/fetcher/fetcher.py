@@ -1,4 +1,7 @@
 # -*- coding: utf-8 -*-
+import re
+import sys
+from multiprocessing.pool import ThreadPool
 import logbook
 
 
@@ -7,7 +10,21 @@ class NoRecordsFetchedException(Exception):
 
 
 class Fetcher(object):
-    '''Base class for harvest objects.'''
+    '''Base class for harvest objects.
+
+    Fetchers that can resume a fetch list the attributes that track their
+    position in checkpoint_attrs, or override get_checkpoint & resume.
+
+    Fetchers that can ask the source for only the records changed since a
+    given time set supports_since and take a "since" keyword argument, a
+    UTC datetime.
+
+    Incremental harvests track records by record_id, the first string value
+    of the record_id_keys in the record.
+    '''
+    checkpoint_attrs = ()
+    supports_since = False
+    record_id_keys = ('id', '_id', 'uid')
 
     def __init__(self, url_harvest, extra_data, **kwargs):
         self.url = url_harvest
@@ -23,6 +40,155 @@ class Fetcher(object):
         '''
         raise NotImplementedError
 
+    def get_checkpoint(self):
+        '''Return a JSON serializable cursor for the position of the fetch
+        after the last objset returned by next().
+        Returns None if the fetcher can't resume.
+        '''
+        if not self.checkpoint_attrs:
+            return None
+        return dict((attr, getattr(self, attr))
+                    for attr in self.checkpoint_attrs)
+
+    def resume(self, checkpoint):
+        '''Move the fetch to a cursor from get_checkpoint, the next objset
+        returned is the one after the checkpoint was taken.
+        Call before any objsets are fetched.
+        '''
+        if not self.checkpoint_attrs:
+            raise NotImplementedError
+        for attr in self.checkpoint_attrs:
+            setattr(self, attr, checkpoint[attr])
+
+    def record_id(self, obj):
+        '''Return the id of a fetched record, None if it doesn't have one'''
+        if not isinstance(obj, dict):
+            return None
+        for key in self.record_id_keys:
+            value = obj.get(key)
+            if isinstance(value, basestring):
+                return value
+        return None
+
+    def close(self):
+        '''Release the threads or processes the fetcher holds. Called once
+        the harvest is done, or has failed.'''
+        pass
+
+
+class PagedFetcher(Fetcher):
+    '''Base class for fetchers of sources that address their result pages
+    by number or offset.
+
+    Subclasses implement fetch_page(page), which returns the objset for a
+    page number and must not change the fetcher's state, and set page_last
+    to the number of the last page. If page_last is None the fetch stops at
+    the first empty page.
+
+    next() returns the objset for page_current and moves to the next page.
+    With concurrency > 1 up to that many pages are fetched at once by a
+    pool of threads, the objsets are still returned in page order.
+    Concurrency comes from the concurrency keyword argument or a
+    "concurrency=<n>" parameter in the extra_data, which is removed from
+    self.extra_data.
+    '''
+    page_first = 1
+    page_last = None
+    concurrency = 1
+    checkpoint_attrs = ('page_current', )
+    re_concurrency = re.compile(r'&?\bconcurrency=(?P<concurrency>\d+)')
+
+    def __init__(self, url_harvest, extra_data, concurrency=None, **kwargs):
+        super(PagedFetcher, self).__init__(url_harvest, extra_data, **kwargs)
+        if isinstance(extra_data, basestring):
+            match = self.re_concurrency.search(extra_data)
+            if match:
+                self.extra_data = ''.join((extra_data[:match.start()],
+                                           extra_data[match.end():]))
+                if not concurrency:
+                    concurrency = match.group('concurrency')
+        if concurrency:
+            self.concurrency = int(concurrency)
+        self.page_current = self.page_first
+        self._pages_done = {}
+        self._pages_pending = {}
+        self._pool = None
+
+    def resume(self, checkpoint):
+        super(PagedFetcher, self).resume(checkpoint)
+        # drop pages kept from before the checkpoint
+        for page in self._pages_done.keys():
+            if page < self.page_current:
+                del self._pages_done[page]
+
+    def fetch_page(self, page):
+        '''Return the objset for the page number'''
+        raise NotImplementedError
+
+    @property
+    def page_prefetch_last(self):
+        '''The last page worth fetching ahead of page_current'''
+        return self.page_last
+
+    def _fetch_page(self, page):
+        '''Run fetch_page in a pool thread, keeping any exception to
+        re-raise in the fetch thread'''
+        try:
+            return self.fetch_page(page), None
+        except Exception:
+            return None, sys.exc_info()
+
+    def _get_page(self, page):
+        '''Get the objset for the page, from the pages already fetched or
+        the pool. Starts fetching the pages after it to keep concurrency
+        pages in flight, also when the page itself was already fetched.'''
+        if self.concurrency > 1:
+            self._prefetch(page)
+        if page in self._pages_done:
+            return self._pages_done.pop(page)
+        if self.concurrency <= 1:
+            return self.fetch_page(page)
+        objset, exc_info = self._pages_pending.pop(page).get()
+        if exc_info:
+            self._close_pool()
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return objset
+
+    def _prefetch(self, page):
+        '''Start fetching the pages from page on that aren't already
+        fetched or in flight, up to concurrency pages'''
+        if not self._pool:
+            self._pool = ThreadPool(self.concurrency)
+        for next_page in range(page, page + self.concurrency):
+            if next_page > page and self.page_prefetch_last is not None \
+                    and next_page > self.page_prefetch_last:
+                break
+            if next_page not in self._pages_pending and \
+                    next_page not in self._pages_done:
+                self._pages_pending[next_page] = self._pool.apply_async(
+                    self._fetch_page, (next_page, ))
+
+    def _close_pool(self):
+        '''Let the pool threads finish, pages still pending are dropped'''
+        if self._pool:
+            self._pool.close()
+            self._pool = None
+        self._pages_pending = {}
+
+    def close(self):
+        self._close_pool()
+
+    def next(self):
+        if self.page_last is not None and self.page_current > self.page_last:
+            self._close_pool()
+            raise StopIteration
+        objset = self._get_page(self.page_current)
+        if self.page_last is None and not objset:
+            self._close_pool()
+            raise StopIteration
+        self.page_current += 1
+        return objset
+
 
 # Copyright © 2016, Regents of the University of California
 # All rights reserved.
@@ -1,12 +1,13 @@
 # -*- coding: utf-8 -*-
 import os
-import urllib
 import re
+from multiprocessing.pool import ThreadPool
 from xml.etree import ElementTree as ET
-from .fetcher import Fetcher
+from .fetcher import PagedFetcher
+from . import http_client
 
 
-class Flickr_Fetcher(Fetcher):
+class Flickr_Fetcher(PagedFetcher):
     '''A fetcher for the Flickr API.
 
     NOTE: This fetcher DOES NOT use the url_harvest. The extra_data should
@@ -19,9 +20,18 @@ class Flickr_Fetcher(Fetcher):
     to get the list of all photos.
 
     It then proceeds to use flickr.photos.getInfo to get metadata for the
-    photos
+    photos, info_concurrency photos of a page at a time.
+
+    Pages of photos can be fetched concurrently, see PagedFetcher.
+
+    All API calls share a token bucket that keeps them within the API key's
+    quota, FLICKR_API_RATE calls an hour (3600 by default) with bursts of up
+    to FLICKR_API_BURST calls.
     '''
 
+    checkpoint_attrs = ('page_current', 'doc_current', 'docs_fetched')
+    info_concurrency = 8
+
     url_get_user_photos_template = 'https://api.flickr.com/services/rest/' \
         '?api_key={api_key}&user_id={user_id}&per_page={per_page}&method=' \
         'flickr.people.getPublicPhotos&page={page}'
@@ -36,15 +46,22 @@ class Flickr_Fetcher(Fetcher):
                  extra_data,
                  page_size=500,
                  page_range=None,
+                 info_concurrency=None,
                  **kwargs):
+        super(Flickr_Fetcher, self).__init__(url_harvest, extra_data,
+                                             **kwargs)
         self.url_base = url_harvest
-        self.user_id = extra_data
+        self.user_id = self.extra_data
         self.api_key = os.environ.get('FLICKR_API_KEY', 'boguskey')
+        self.api_limit = http_client.TokenBucket(
+            float(os.environ.get('FLICKR_API_RATE', 3600)) / 3600,
+            int(os.environ.get('FLICKR_API_BURST', 100)))
+        if info_concurrency:
+            self.info_concurrency = int(info_concurrency)
         self.page_size = page_size
-        self.page_current = 1
         self.doc_current = 0
         self.docs_fetched = 0
-        xml = urllib.urlopen(self.url_current).read()
+        xml = self.api_get(self.url_current)
         total = re.search('total="(?P<total>\d+)"', xml)
         self.docs_total = int(total.group('total'))
         page_total = re.search('pages="(?P<page_total>\d+)"', xml)
@@ -54,8 +71,9 @@ class Flickr_Fetcher(Fetcher):
             self.page_start = int(start)
             self.page_end = int(end)
             self.page_current = self.page_start
+            self.page_last = self.page_end
             if self.page_end >= self.page_total:
-                self.page_end = self.page_total
+                self.page_end = self.page_last = self.page_total
                 docs_last_page = self.docs_total - \
                     ((self.page_total - 1) * self.page_size)
                 self.docs_total = (self.page_end - self.page_start) * \
@@ -64,21 +82,37 @@ class Flickr_Fetcher(Fetcher):
                 self.docs_total = (self.page_end - self.page_start + 1) * \
                     self.page_size
 
+    @property
+    def page_prefetch_last(self):
+        '''Without a page range the fetch stops on the number of documents,
+        don't fetch ahead past the last page'''
+        if self.page_last is None:
+            return self.page_total
+        return self.page_last
+
     @property
     def url_current(self):
+        return self.url_page(self.page_current)
+
+    def url_page(self, page):
         '''If @N found in extra_data, it's a user ID. If not, it's a photoset'''
         if "@N" in self.user_id:
             return self.url_get_user_photos_template.format(
                 api_key=self.api_key,
                 user_id=self.user_id,
                 per_page=self.page_size,
-                page=self.page_current)
+                page=page)
         else:
             return self.url_get_photoset_template.format(
                 api_key=self.api_key,
                 user_id=self.user_id,
                 per_page=self.page_size,
-                page=self.page_current)
+                page=page)
+
+    def api_get(self, url):
+        '''Call the API, waiting for the rate limit'''
+        self.api_limit.take()
+        return http_client.get_content(url)
 
     def parse_tags_for_photo_info(self, info_tree):
         '''Parse the sub tags of a photo info objects and add to the
@@ -111,30 +145,37 @@ class Flickr_Fetcher(Fetcher):
                     .format(self.docs_fetched, self.docs_total))
             else:
                 raise StopIteration
-        if hasattr(self, 'page_end') and self.page_current > self.page_end:
-            raise StopIteration
+        objset = super(Flickr_Fetcher, self).next()
+        self.docs_fetched += len(objset)
+        self.doc_current += len(objset)
+        return objset
+
+    def fetch_page(self, page):
         # for the given page of public photos results,
         # for each <photo> tag, create an object with id, server & farm saved
         # then get the info for the photo and add to object
         # return the full list of objects to the harvest controller
-        tree = ET.fromstring(urllib.urlopen(self.url_current).read())
-        photo_list = tree.findall('.//photo')
-        objset = []
-        for photo in photo_list:
-            photo_obj = photo.attrib
-            url_photo_info = self.url_get_photo_info_template.format(
-                api_key=self.api_key, photo_id=photo_obj['id'])
-            ptree = ET.fromstring(urllib.urlopen(url_photo_info).read())
-            photo_info = ptree.find('.//photo')
-            photo_obj.update(photo_info.attrib)
-            photo_obj.update(
-                self.parse_tags_for_photo_info(photo_info.getchildren()))
-            self.docs_fetched += 1
-            objset.append(photo_obj)
-
-        self.page_current += 1
-        self.doc_current += len(objset)
-        return objset
+        tree = ET.fromstring(self.api_get(self.url_page(page)))
+        photo_list = [photo.attrib for photo in tree.findall('.//photo')]
+        if self.info_concurrency <= 1 or len(photo_list) <= 1:
+            return map(self.get_photo_info, photo_list)
+        pool = ThreadPool(min(self.info_concurrency, len(photo_list)))
+        try:
+            # map keeps the photos in page order
+            return pool.map(self.get_photo_info, photo_list)
+        finally:
+            pool.close()
+
+    def get_photo_info(self, photo_obj):
+        '''Add the flickr.photos.getInfo data to the photo object'''
+        url_photo_info = self.url_get_photo_info_template.format(
+            api_key=self.api_key, photo_id=photo_obj['id'])
+        ptree = ET.fromstring(self.api_get(url_photo_info))
+        photo_info = ptree.find('.//photo')
+        photo_obj.update(photo_info.attrib)
+        photo_obj.update(
+            self.parse_tags_for_photo_info(photo_info.getchildren()))
+        return photo_obj
 
 
 # Copyright © 2017, Regents of the University of California
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+'''The HTTP client shared by the fetchers.
+
+One requests Session is shared by every fetcher & thread in the process, so
+connections are kept alive in a pool per host and reused. requests asks for
+gzip & deflate and decodes the responses transparently.
+Requests that fail with a connection error, a timeout, a broken or badly
+encoded body or a 429/5xx status are retried with exponential backoff and
+full jitter, a Retry-After header is honoured.
+
+Timeouts, retries & pool size can be set with the HARVESTER_HTTP_*
+environment variables or, except for the pool size, per call.
+'''
+import os
+import random
+import shutil
+import threading
+import time
+import urllib
+import urlparse
+import logbook
+import requests
+from requests.adapters import HTTPAdapter
+
+TIMEOUT_CONNECT = float(os.environ.get('HARVESTER_HTTP_TIMEOUT_CONNECT', 10))
+TIMEOUT_READ = float(os.environ.get('HARVESTER_HTTP_TIMEOUT_READ', 300))
+MAX_RETRIES = int(os.environ.get('HARVESTER_HTTP_RETRIES', 5))
+BACKOFF = float(os.environ.get('HARVESTER_HTTP_BACKOFF', 2))
+BACKOFF_MAX = float(os.environ.get('HARVESTER_HTTP_BACKOFF_MAX', 120))
+POOL_SIZE = int(os.environ.get('HARVESTER_HTTP_POOL_SIZE', 20))
+RETRY_STATUS = (429, 500, 502, 503, 504)
+RETRY_EXCEPTIONS = (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout,
+                    requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.ContentDecodingError)
+
+logger = logbook.Logger('HTTPClient')
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    '''Return the session for the process, creating it on first use'''
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+    return _session
+
+
+def backoff(attempt, response=None):
+    '''Seconds to wait before retry number attempt + 1.
+    Full jitter, a random time up to the exponential backoff, keeps many
+    workers from retrying a struggling server in step.
+    '''
+    if response is not None:
+        try:
+            return min(float(response.headers['retry-after']), BACKOFF_MAX)
+        except (KeyError, TypeError, ValueError):
+            pass
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF * 2 ** attempt))
+
+
+def request(method, url, timeout=None, retries=None, **kwargs):
+    '''Make a request with the shared session, retrying failures.
+    timeout is a (connect, read) tuple or a number of seconds. Other
+    keyword arguments go to requests.
+    The response for a retryable status is returned once the retries are
+    used up, other errors are raised.
+    '''
+    if timeout is None:
+        timeout = (TIMEOUT_CONNECT, TIMEOUT_READ)
+    if retries is None:
+        retries = MAX_RETRIES
+    session = get_session()
+    attempt = 0
+    while True:
+        response = None
+        try:
+            response = session.request(method, url, timeout=timeout,
+                                       **kwargs)
+            if response.status_code not in RETRY_STATUS or \
+                    attempt >= retries:
+                return response
+            reason = 'HTTP {}'.format(response.status_code)
+            response.close()
+        except RETRY_EXCEPTIONS as e:
+            if attempt >= retries:
+                raise
+            reason = repr(e)
+        pause = backoff(attempt, response)
+        logger.warning(
+            '{} {} failed with {}, retry {} of {} in {:.1f}s'.format(
+                method, url, reason, attempt + 1, retries, pause))
+        time.sleep(pause)
+        attempt += 1
+
+
+class TokenBucket(object):
+    '''Rate limit for calls shared by many threads. Tokens are added at
+    rate per second up to capacity, the burst allowed after a quiet spell.
+    take() blocks until a token is available.
+    '''
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self._lock = threading.Lock()
+
+    def take(self, tokens=1):
+        '''Wait for & remove tokens from the bucket'''
+        while True:
+            with self._lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens +
+                                  (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                pause = (tokens - self.tokens) / self.rate
+            time.sleep(pause)
+
+
+def get(url, **kwargs):
+    '''GET the URL, see request'''
+    return request('GET', url, **kwargs)
+
+
+def head(url, **kwargs):
+    '''HEAD the URL, see request'''
+    return request('HEAD', url, **kwargs)
+
+
+def post(url, **kwargs):
+    '''POST to the URL, see request'''
+    return request('POST', url, **kwargs)
+
+
+def get_content(url, **kwargs):
+    '''Return the body of the URL as a byte string, raising an HTTPError
+    for an error status.
+    URLs that aren't HTTP, such as file: URLs for local files, are read
+    with urllib.
+    '''
+    if urlparse.urlsplit(url).scheme not in ('http', 'https'):
+        return urllib.urlopen(url).read()
+    response = get(url, **kwargs)
+    response.raise_for_status()
+    return response.content
+
+
+def download(url, fileobj, chunk_size=1024 * 1024, retries=None,
+             **kwargs):
+    '''Write the body of the URL to the file object in chunks, without
+    holding it in memory. Returns the number of bytes written.
+    If the connection breaks the download is retried, asking for the rest
+    of the body with a Range request. A server that ignores the Range gets
+    the whole body written again.
+    URLs that aren't HTTP are copied with urllib.
+    '''
+    start = fileobj.tell()
+    if urlparse.urlsplit(url).scheme not in ('http', 'https'):
+        shutil.copyfileobj(urllib.urlopen(url), fileobj, chunk_size)
+        return fileobj.tell() - start
+    if retries is None:
+        retries = MAX_RETRIES
+    headers = kwargs.pop('headers', None) or {}
+    attempt = 0
+    while True:
+        written = fileobj.tell() - start
+        if written:
+            headers = dict(headers, Range='bytes={}-'.format(written))
+        response = get(url, stream=True, headers=headers, retries=retries,
+                       **kwargs)
+        try:
+            if written and response.status_code == 416:
+                # the break came after the last byte
+                return written
+            response.raise_for_status()
+            if written and response.status_code != 206:
+                fileobj.seek(start)
+                fileobj.truncate()
+            for chunk in response.iter_content(chunk_size):
+                fileobj.write(chunk)
+            return fileobj.tell() - start
+        except RETRY_EXCEPTIONS as e:
+            if attempt >= retries:
+                raise
+            pause = backoff(attempt)
+            logger.warning(
+                'Download of {} broke after {} bytes with {}, retry {} of {} '
+                'in {:.1f}s'.format(url, fileobj.tell() - start, repr(e),
+                                    attempt + 1, retries, pause))
+            time.sleep(pause)
+            attempt += 1
+        finally:
+            response.close()
+
+
+# Copyright © 2016, Regents of the University of California
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+# - Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# - Neither the name of the University of California nor the names of its
+#   contributors may be used to endorse or promote products derived from this
+#   software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
@@ -1,10 +1,11 @@
 # -*- coding: utf-8 -*-
-import urllib
 import json
-from .fetcher import Fetcher
+import math
+from .fetcher import PagedFetcher
+from . import http_client
 
 
-class IA_Fetcher(Fetcher):
+class IA_Fetcher(PagedFetcher):
     '''A fetcher for the Internet Archive.
     Put a dummy URL in harvesturl field such as 'https://example.edu'
 
@@ -20,43 +21,57 @@ class IA_Fetcher(Fetcher):
     More search query help and example queries here:
     https://archive.org/advancedsearch.php
 
+    The first page of results gives the number of pages, pages can then be
+    fetched concurrently, see PagedFetcher.
     '''
 
+    checkpoint_attrs = ('page_current', 'doc_current')
+
     url_advsearch = 'https://archive.org/advancedsearch.php?' \
         'q={search_query}&rows=500&page={page_current}&output=json'
+    page_size = 500
 
     def __init__(self, url_harvest, extra_data, **kwargs):
+        super(IA_Fetcher, self).__init__(url_harvest, extra_data, **kwargs)
         self.url_base = url_harvest
-        self.search_query = extra_data
-        self.page_current = 1
+        self.search_query = self.extra_data
         self.doc_current = 0
-
-    def next(self):
-        self.url_current = self.url_advsearch.format(
-            page_current=self.page_current, search_query=self.search_query)
-        search = urllib.urlopen(self.url_current).read()
-        results = json.loads(search)
+        results = self.get_results(self.page_current)
         self.doc_total = results["response"]["numFound"]
+        self.page_last = int(math.ceil(self.doc_total /
+                                       float(self.page_size)))
+        if self.page_last:
+            self._pages_done[self.page_current] = self.get_docs(
+                results, self.page_current)
 
-        if self.doc_current >= self.doc_total:
-            if self.doc_current != self.doc_total:
-                raise ValueError(
-                    "Number of documents fetched ({0}) doesn't match \
-                    total reported by server ({1})".format(
-                        self.doc_current, self.doc_total))
-            else:
-                raise StopIteration
+    def url_page(self, page):
+        return self.url_advsearch.format(
+            page_current=page, search_query=self.search_query)
+
+    def get_results(self, page):
+        return json.loads(http_client.get_content(self.url_page(page)))
 
+    def get_docs(self, results, page):
         docList = results['response']['docs']
         if len(docList) == 0:
             raise ValueError(
                 "No results for URL ({0}) -- Check search syntax".format(
-                    self.searchURL))
-        else:
-            objset = []
-            for g in docList:
-                objset.append(g)
-        self.page_current += 1
+                    self.url_page(page)))
+        return docList
+
+    def fetch_page(self, page):
+        return self.get_docs(self.get_results(page), page)
+
+    def next(self):
+        try:
+            objset = super(IA_Fetcher, self).next()
+        except StopIteration:
+            if self.doc_current != self.doc_total:
+                raise ValueError(
+                    "Number of documents fetched ({0}) doesn't match \
+                    total reported by server ({1})".format(
+                        self.doc_current, self.doc_total))
+            raise
         self.doc_current += len(objset)
         return objset
 
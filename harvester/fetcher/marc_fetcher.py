@@ -1,33 +1,128 @@
 # -*- coding: utf-8 -*-
-import urllib
 import tempfile
+import math
+from itertools import islice
 from xml.etree import ElementTree as ET
 from pymarc import MARCReader
-import pymarc
 from .fetcher import Fetcher
+from .fetcher import PagedFetcher
+from . import http_client
+
+MARC_LEADER_DEFAULT = (' ' * 10) + '22' + (' ' * 8) + '4500'
+
+
+def _local_name(tag):
+    '''Tag without its namespace, None for comments & processing
+    instructions'''
+    if not isinstance(tag, basestring):
+        return None
+    return tag.rsplit('}', 1)[-1]
+
+
+def _marc_tag(tag):
+    '''Normalize a field tag the way pymarc.Field does'''
+    try:
+        return '%03i' % int(tag)
+    except ValueError:
+        return '%03s' % tag
+
+
+def marc_xml_record_to_dict(record):
+    '''Return the pymarc Record.as_dict() structure for a MARC XML record
+    element, ElementTree or lxml, without a round trip through pymarc's
+    SAX parser.'''
+    marc = {'leader': MARC_LEADER_DEFAULT, 'fields': []}
+    for elem in record:
+        name = _local_name(elem.tag)
+        if name == 'leader':
+            marc['leader'] = unicode(elem.text or u'')
+        elif name == 'controlfield':
+            marc['fields'].append(
+                {_marc_tag(elem.get('tag')): unicode(elem.text or u'')})
+        elif name == 'datafield':
+            subfields = [
+                {sub.get('code'): unicode(sub.text or u'')}
+                for sub in elem if _local_name(sub.tag) == 'subfield']
+            marc['fields'].append({_marc_tag(elem.get('tag')): {
+                'ind1': unicode(elem.get('ind1', u' ')),
+                'ind2': unicode(elem.get('ind2', u' ')),
+                'subfields': subfields}})
+    return marc
+
+
+def marc_xml_to_dicts(element):
+    '''Return the as_dict() structures for the MARC XML records in the
+    element, which can be a record itself.
+    Like pymarc.parse_xml_to_array, any element named record is taken to be
+    a MARC record, unless it wraps one, as the SRU zs:record does.
+    '''
+    records = [elem for elem in element.iter()
+               if _local_name(elem.tag) == 'record']
+    return [marc_xml_record_to_dict(rec) for rec in records
+            if not any(_local_name(child.tag) == 'record'
+                       for child in islice(rec.iter(), 1, None))]
 
 
 class MARCFetcher(Fetcher):
-    '''Harvest a MARC FILE. Can be local or at a URL'''
+    '''Harvest a MARC FILE. Can be local or at a URL
+
+    The file is downloaded to a local temp file in chunks, resuming with
+    range requests if the connection breaks. Records are returned in lists
+    of batch_size.
+    As records are read the byte offset & length of each one is added to
+    record_index, so a file can be split up by record. The checkpoint is the
+    offset of the next record.
+    '''
+    checkpoint_attrs = ('records_fetched', 'file_offset')
 
-    def __init__(self, url_harvest, extra_data, **kwargs):
+    def __init__(self, url_harvest, extra_data, batch_size=100, **kwargs):
         '''Grab file and copy to local temp file'''
         super(MARCFetcher, self).__init__(url_harvest, extra_data, **kwargs)
         self.url_marc_file = url_harvest
+        self.batch_size = int(batch_size)
         self.marc_file = tempfile.TemporaryFile()
-        self.marc_file.write(urllib.urlopen(self.url_marc_file).read())
+        http_client.download(self.url_marc_file, self.marc_file)
         self.marc_file.seek(0)
         self.marc_reader = MARCReader(
             self.marc_file, to_unicode=True, utf8_handling='replace')
+        self.records_fetched = 0
+        self.file_offset = 0
+        self.record_index = []
+
+    def resume(self, checkpoint):
+        super(MARCFetcher, self).resume(checkpoint)
+        self.marc_file.seek(self.file_offset)
 
     def next(self):
-        '''Return MARC record by record to the controller'''
-        return self.marc_reader.next().as_dict()
+        '''Return a batch of MARC records to the controller'''
+        recs = []
+        while len(recs) < self.batch_size:
+            offset = self.marc_file.tell()
+            try:
+                rec = self.marc_reader.next()
+            except StopIteration:
+                break
+            self.record_index.append((offset,
+                                      self.marc_file.tell() - offset))
+            recs.append(rec.as_dict())
+        if not recs:
+            raise StopIteration
+        self.records_fetched += len(recs)
+        self.file_offset = self.marc_file.tell()
+        return recs
 
 
-class AlephMARCXMLFetcher(Fetcher):
+class AlephMARCXMLFetcher(PagedFetcher):
     '''Harvest a MARC XML feed from Aleph. Currently used for the
-    UCSB cylinders project'''
+    UCSB cylinders project.
+    Pages are addressed by startRecord, so they can be fetched
+    concurrently, see PagedFetcher. While a page is being handled the
+    following pages, up to a window of concurrency pages, are fetched in the
+    background.
+    The first page, fetched to find the number of records, is kept and
+    returned by the first call to next().
+    '''
+    concurrency = 4
 
     def __init__(self, url_harvest, extra_data, page_size=500, **kwargs):
         '''Grab file and copy to local temp file'''
@@ -39,43 +134,55 @@ class AlephMARCXMLFetcher(Fetcher):
         self.current_record = 1
         tree_current = self.get_current_xml_tree()
         self.num_records = self.get_total_records(tree_current)
+        self.page_last = int(math.ceil(self.num_records /
+                                       float(self.page_size)))
+        if self.num_records:
+            self._pages_done[self.page_first] = self.records_from_tree(
+                self.page_first, tree_current)
+
+    def get_url_chunk(self, start_record):
+        '''Return the URL for the page of records from start_record'''
+        return ''.join((self.url_base, '&startRecord=', str(start_record)))
 
     def get_url_current_chunk(self):
         '''Set the next URL to retrieve according to page size and current
         record'''
-        return ''.join((self.url_base, '&startRecord=',
-                        str(self.current_record)))
+        return self.get_url_chunk(self.current_record)
 
     def get_current_xml_tree(self):
         '''Return an ElementTree for the next xml_page'''
         url = self.get_url_current_chunk()
-        return ET.fromstring(urllib.urlopen(url).read())
+        return ET.fromstring(http_client.get_content(url))
 
     def get_total_records(self, tree):
         '''Return the total number of records from the etree passed in'''
         return int(tree.find('.//zs:numberOfRecords', self.ns).text)
 
-    def next(self):
-        '''Return MARC records in sets to controller.
-        Break when last record position == num_records
+    def fetch_page(self, page):
+        '''Return the MARC records for the page.'''
+        start_record = (page - 1) * self.page_size + 1
+        tree = ET.fromstring(http_client.get_content(
+            self.get_url_chunk(start_record)))
+        return self.records_from_tree(page, tree)
+
+    def records_from_tree(self, page, tree):
+        '''Return the MARC records in the tree for the page.
+        The offsets of the pages assume every page but the last is full,
+        so a server that returns fewer records than asked for is an error.
         '''
-        if self.current_record >= self.num_records:
-            raise StopIteration
-        # get chunk from self.current_record to self.current_record + page_size
-        tree = self.get_current_xml_tree()
+        start_record = (page - 1) * self.page_size + 1
         recs_xml = tree.findall('.//zs:record', self.ns)
-        # advance current record to end of set
-        self.current_record = int(recs_xml[-1].find('.//zs:recordPosition',
-                                                    self.ns).text)
-        self.current_record += 1
-        # translate to pymarc records & return
-        marc_xml_file = tempfile.TemporaryFile()
-        marc_xml_file.write(ET.tostring(tree))
-        marc_xml_file.seek(0)
-        recs = [
-            rec.as_dict() for rec in pymarc.parse_xml_to_array(marc_xml_file)
-            if rec is not None
-        ]
+        if page < self.page_last and len(recs_xml) != self.page_size:
+            raise ValueError(
+                'Got {} records from startRecord {}, expected {}. Set a '
+                'smaller page_size'.format(len(recs_xml), start_record,
+                                           self.page_size))
+        return marc_xml_to_dicts(tree)
+
+    def next(self):
+        '''Return MARC records in sets to controller.'''
+        recs = super(AlephMARCXMLFetcher, self).next()
+        self.current_record = (self.page_current - 1) * self.page_size + 1
         return recs
 
 
@@ -1,9 +1,15 @@
 # -*- coding: utf-8 -*-
 import urlparse
 import json
+import threading
+from collections import defaultdict
+from itertools import islice
+from multiprocessing.pool import ThreadPool
 import pynux.utils
 import boto
+from botocore.exceptions import ClientError
 from .fetcher import Fetcher
+from harvester.media_json_cache import get_media_json_cache
 from deepharvest.deepharvest_nuxeo import DeepHarvestNuxeo
 
 STRUCTMAP_S3_BUCKET = 'static.ucldc.cdlib.org/media_json'
@@ -14,9 +20,21 @@ NUXEO_S3_THUMB_URL_FORMAT = "https://s3.amazonaws.com/" \
 
 
 class NuxeoFetcher(Fetcher):
-    '''Harvest a Nuxeo FILE. Can be local or at a URL'''
+    '''Harvest a Nuxeo FILE. Can be local or at a URL
+
+    With batch_size set, objects are returned in lists of batch_size: the
+    metadata for a batch comes from one NXQL query, the media json is read
+    by media_concurrency threads, and the first image or thumbnail
+    components of the objects without an image of their own come from one
+    more NXQL query.
+    Each thread keeps its S3 connection.
+    '''
+    supports_since = True
+    batch_size = None
+    media_concurrency = 8
 
-    def __init__(self, url_harvest, extra_data, conf_pynux={}, **kwargs):
+    def __init__(self, url_harvest, extra_data, conf_pynux={}, since=None,
+                 batch_size=None, media_concurrency=None, **kwargs):
         '''
         uses pynux (https://github.com/ucldc/pynux) to grab objects from
         the Nuxeo API
@@ -26,6 +44,9 @@ class NuxeoFetcher(Fetcher):
 
         the pynux config file should have user & password
         and X-NXDocumemtProperties values filled in.
+
+        if since is set, only objects modified since then, or with a
+        component modified since then, are harvested.
         '''
         super(NuxeoFetcher, self).__init__(url_harvest, extra_data, **kwargs)
         self._url = url_harvest
@@ -33,12 +54,41 @@ class NuxeoFetcher(Fetcher):
         self._nx = pynux.utils.Nuxeo(conf=conf_pynux)
         self._nx.conf['api'] = self._url
         self._structmap_bucket = STRUCTMAP_S3_BUCKET
+        self._s3 = threading.local()
+        self._media_pool = None
+        if batch_size:
+            self.batch_size = int(batch_size)
+        if media_concurrency:
+            self.media_concurrency = int(media_concurrency)
 
         # get harvestable child objects
         conf_pynux['api'] = self._url
         self._dh = DeepHarvestNuxeo(self._path, '', conf_pynux=conf_pynux)
 
-        self._children = iter(self._dh.fetch_objects())
+        children = self._dh.fetch_objects()
+        if since:
+            children = self._modified_since(children, since)
+        self._children = iter(children)
+        self._position = 0
+
+    def _modified_since(self, children, since):
+        '''Filter the harvestable objects to those modified since the
+        datetime. One NXQL query finds the documents under the path modified
+        since then, an object is harvested if it or one of its components
+        is in that list.
+        '''
+        query = "SELECT * FROM Document WHERE ecm:path STARTSWITH '{}' " \
+                "AND dc:modified >= TIMESTAMP '{}' AND " \
+                "ecm:currentLifeCycleState != 'deleted'".format(
+                    self._path, since.strftime('%Y-%m-%dT%H:%M:%S'))
+        modified = set()
+        for doc in self._nx.nxql(query):
+            modified.add(doc['uid'])
+            modified.add(doc.get('parentRef'))
+        children = [c for c in children if c['uid'] in modified]
+        self.logger.info('{} objects modified since {}'.format(
+            len(children), since.isoformat()))
+        return children
 
     def _get_structmap_url(self, bucket, obj_key):
         '''Get structmap_url property for object'''
@@ -46,21 +96,42 @@ class NuxeoFetcher(Fetcher):
                                                  '-media.json')
         return structmap_url
 
+    def _get_bucket(self, bucketbase):
+        '''Return the bucket, connecting to S3 once per thread'''
+        buckets = getattr(self._s3, 'buckets', None)
+        if buckets is None:
+            self._s3.conn = boto.connect_s3()
+            buckets = self._s3.buckets = {}
+        if bucketbase not in buckets:
+            buckets[bucketbase] = self._s3.conn.get_bucket(bucketbase)
+        return buckets[bucketbase]
+
     def _get_structmap_text(self, structmap_url):
         '''
            Get structmap_text for object. This is all the words from 'label'
            in the json.
            See https://github.com/ucldc/ucldc-docs/wiki/media.json
+           The parsed json comes from the media json cache when it is
+           turned on.
         '''
         structmap_text = ""
 
+        cache = get_media_json_cache()
+        if cache:
+            try:
+                entry = cache.get_url(structmap_url)
+            except ClientError as e:
+                self.logger.error('Media json at: {} missing. {}'.format(
+                    structmap_url, e))
+                return structmap_text
+            return ' '.join(entry['labels'])
+
         bucketpath = self._structmap_bucket.strip("/")
         bucketbase = bucketpath.split("/")[0]
         parts = urlparse.urlsplit(structmap_url)
 
         # get contents of <nuxeo_id>-media.json file
-        conn = boto.connect_s3()
-        bucket = conn.get_bucket(bucketbase)
+        bucket = self._get_bucket(bucketbase)
         key = bucket.get_key(parts.path)
         if not key:  # media_json hasn't been harvested yet for this record
             self.logger.error('Media json at: {} missing.'.format(parts.path))
@@ -76,7 +147,7 @@ class NuxeoFetcher(Fetcher):
         structmap_text = ' '.join(labels)
         return structmap_text
 
-    def _get_isShownBy(self, nuxeo_metadata):
+    def _get_isShownBy(self, nuxeo_metadata, components=None):
         '''
             Get isShownBy value for object
             1) if object has image at parent level, use this
@@ -85,6 +156,8 @@ class NuxeoFetcher(Fetcher):
                 use image stashed on S3
             4) if component(s) have PDF or video, use first component image stashed on S3 we can find
             5) return None
+        components is the list of the object's component documents, if
+        already fetched.
         '''
         is_shown_by = None
         uid = nuxeo_metadata['uid']
@@ -101,7 +174,7 @@ class NuxeoFetcher(Fetcher):
 
         # 2) if component(s) have image, use first one we can find
         first_image_component_uid = self._get_first_image_component(
-            nuxeo_metadata)
+            nuxeo_metadata, components)
         self.logger.info("first_image_component_uid: {}".format(
             first_image_component_uid))
         if first_image_component_uid:
@@ -124,7 +197,7 @@ class NuxeoFetcher(Fetcher):
 
         # 4) if component(s) have PDF or video, use first component image stashed on S3 we can find
         first_thumb_component_uid = self._get_first_thumb_component(
-            nuxeo_metadata)
+            nuxeo_metadata, components)
         self.logger.info("first_thumb_component_uid: {}".format(
             first_thumb_component_uid))
         if first_thumb_component_uid:
@@ -171,39 +244,122 @@ class NuxeoFetcher(Fetcher):
         else:
             return False
 
-    def _get_first_image_component(self, parent_metadata):
-        ''' get first image component we can find '''
-        component_uid = None
-
+    def _iter_components(self, parent_metadata):
+        '''Yield the metadata of the components of the object in order'''
         query = "SELECT * FROM Document WHERE ecm:parentId = '{}' AND " \
                 "ecm:currentLifeCycleState != 'deleted' ORDER BY " \
                 "ecm:pos".format(parent_metadata['uid'])
         for child in self._nx.nxql(query):
-            child_metadata = self._nx.get_metadata(uid=child['uid'])
+            yield self._nx.get_metadata(uid=child['uid'])
+
+    def _get_first_image_component(self, parent_metadata, components=None):
+        ''' get first image component we can find '''
+        component_uid = None
+
+        if components is None:
+            components = self._iter_components(parent_metadata)
+        for child_metadata in components:
             if self._has_image(child_metadata):
                 component_uid = child_metadata['uid']
                 break
 
         return component_uid
 
-    def _get_first_thumb_component(self, parent_metadata):
+    def _get_first_thumb_component(self, parent_metadata, components=None):
         ''' get first non-image component with thumbnail we can find '''
         component_uid = None
 
-        query = "SELECT * FROM Document WHERE ecm:parentId = '{}' AND " \
-                "ecm:currentLifeCycleState != 'deleted' ORDER BY " \
-                "ecm:pos".format(parent_metadata['uid'])
-        for child in self._nx.nxql(query):
-            child_metadata = self._nx.get_metadata(uid=child['uid'])
+        if components is None:
+            components = self._iter_components(parent_metadata)
+        for child_metadata in components:
             if self._has_s3_thumbnail(child_metadata):
                 component_uid = child_metadata['uid']
                 break
 
         return component_uid
 
+    def _get_metadata_batch(self, uids):
+        '''Return the metadata for the uids, in order, from one NXQL
+        query. Documents the query doesn't return are fetched by uid.'''
+        query = "SELECT * FROM Document WHERE ecm:uuid IN ({})".format(
+            ', '.join("'{}'".format(uid) for uid in uids))
+        found = dict((doc['uid'], doc) for doc in self._nx.nxql(query))
+        return [found[uid] if uid in found else
+                self._nx.get_metadata(uid=uid) for uid in uids]
+
+    def _get_components_batch(self, parents):
+        '''Return a dict of parent uid to the components _get_isShownBy
+        uses, the first image component & the first component with a
+        thumbnail on S3, in order.
+        One NXQL query gets the picture, file & video components of the
+        parents by position, it is read until each parent has an image
+        component, so the rest of the pages of big objects aren't fetched.
+        '''
+        components = defaultdict(list)
+        if not parents:
+            return components
+        query = "SELECT * FROM Document WHERE ecm:parentId IN ({}) AND " \
+                "ecm:primaryType IN ('SampleCustomPicture', 'CustomFile', " \
+                "'CustomVideo') AND " \
+                "ecm:currentLifeCycleState != 'deleted' ORDER BY " \
+                "ecm:pos".format(', '.join("'{}'".format(parent['uid'])
+                                           for parent in parents))
+        unresolved = set(parent['uid'] for parent in parents)
+        with_thumb = set()
+        for child in self._nx.nxql(query):
+            parent_uid = child['parentRef']
+            if parent_uid not in unresolved:
+                continue
+            if self._has_image(child):
+                components[parent_uid].append(child)
+                unresolved.remove(parent_uid)
+                if not unresolved:
+                    break
+            elif parent_uid not in with_thumb and \
+                    self._has_s3_thumbnail(child):
+                components[parent_uid].append(child)
+                with_thumb.add(parent_uid)
+        return components
+
+    def _next_batch(self):
+        '''Return the next batch_size objects'''
+        docs = list(islice(self._children, self.batch_size))
+        if not docs:
+            self.close()
+            raise StopIteration
+        batch = self._get_metadata_batch([doc['uid'] for doc in docs])
+        components = self._get_components_batch(
+            [metadata for metadata in batch if not self._has_image(metadata)])
+        structmap_urls = [
+            self._get_structmap_url(self._structmap_bucket, metadata['uid'])
+            for metadata in batch]
+        if not self._media_pool:
+            self._media_pool = ThreadPool(self.media_concurrency)
+        structmap_texts = self._media_pool.map(self._get_structmap_text,
+                                               structmap_urls)
+        for metadata, structmap_url, structmap_text in zip(
+                batch, structmap_urls, structmap_texts):
+            metadata['structmap_url'] = structmap_url
+            metadata['structmap_text'] = structmap_text
+            metadata['isShownBy'] = self._get_isShownBy(
+                metadata, components.get(metadata['uid'], []))
+        self._position += len(docs)
+        return batch
+
+    def close(self):
+        '''Stop the threads that get the media json'''
+        if self._media_pool:
+            self._media_pool.terminate()
+            self._media_pool.join()
+            self._media_pool = None
+
     def next(self):
-        '''Return Nuxeo record by record to the controller'''
+        '''Return Nuxeo record by record to the controller, or in lists of
+        batch_size'''
+        if self.batch_size:
+            return self._next_batch()
         doc = self._children.next()
+        self._position += 1
         self.metadata = self._nx.get_metadata(uid=doc['uid'])
         self.structmap_url = self._get_structmap_url(self._structmap_bucket,
                                                      doc['uid'])
@@ -214,6 +370,17 @@ class NuxeoFetcher(Fetcher):
 
         return self.metadata
 
+    def get_checkpoint(self):
+        '''The number of documents already returned from the list of
+        harvestable objects'''
+        return {'position': self._position}
+
+    def resume(self, checkpoint):
+        '''Skip the documents already returned, the object list is
+        fetched again but their metadata is not'''
+        self._position = checkpoint['position']
+        self._children = islice(self._children, self._position, None)
+
 
 class UCLDCNuxeoFetcher(NuxeoFetcher):
     '''A nuxeo fetcher that verifies headers required for UCLDC metadata
@@ -1,14 +1,17 @@
 # -*- coding: utf-8 -*-
-import urllib
+import time
 from collections import defaultdict
 from xml.etree import ElementTree as ET
-import time
 import logbook
-import requests
-from requests.packages.urllib3.exceptions import DecodeError
+from requests.packages.urllib3.exceptions import ProtocolError, DecodeError
 from .fetcher import Fetcher
+from .fetcher import PagedFetcher
+from . import http_client
 
 CONTENT_SERVER = 'http://content.cdlib.org/'
+# errors reading a streamed page, the page is fetched again
+PAGE_RETRY_EXCEPTIONS = http_client.RETRY_EXCEPTIONS + (
+    ProtocolError, DecodeError, ET.ParseError)
 
 
 class BunchDict(dict):
@@ -17,16 +20,23 @@ class BunchDict(dict):
         self.__dict__ = self
 
 
-class OAC_XML_Fetcher(Fetcher):
+class OAC_XML_Fetcher(PagedFetcher):
     '''Fetcher for the OAC
     The results are returned in 3 groups, image, text and website.
     Image and text are the ones we care about.
+
+    With concurrency > 1 (see PagedFetcher) the startDoc & group of every
+    page are worked out from the group totals in the first response, and a
+    window of pages is fetched ahead. The docHits of the first response are
+    kept as the first page.
+    The docHits of a response are converted as they are parsed.
     '''
 
     def __init__(self, url_harvest, extra_data, docsPerPage=100, **kwargs):
-        super(OAC_XML_Fetcher, self).__init__(url_harvest, extra_data)
+        super(OAC_XML_Fetcher, self).__init__(url_harvest, extra_data,
+                                              **kwargs)
         self.logger = logbook.Logger('FetcherOACXML')
-        self.docsPerPage = docsPerPage
+        self.docsPerPage = int(docsPerPage)
         self.url = self.url + '&docsPerPage=' + str(self.docsPerPage)
         self._url_current = self.url
         self.currentDoc = 0
@@ -34,7 +44,8 @@ class OAC_XML_Fetcher(Fetcher):
         # this will be used to track counts for the 3 groups
         self.groups = dict(
             image=BunchDict(), text=BunchDict(), website=BunchDict())
-        facet_type_tab = self._get_next_result_set()
+        facet_type_tab, objset = self._get_result_set(
+            self._url_current, convert_docs=self.concurrency > 1)
         # set total number of hits across the 3 groups
         self.totalDocs = int(facet_type_tab.attrib['totalDocs'])
         if self.totalDocs <= 0:
@@ -51,6 +62,15 @@ class OAC_XML_Fetcher(Fetcher):
             self.currentGroup = 'text'
         else:
             self.currentGroup = None
+        self.pages = [(group, start) for group in ('image', 'text')
+                      for start in range(1, self.groups[group].get('total', 0)
+                                         + 1, self.docsPerPage)]
+        self.page_last = len(self.pages)
+        # the first response has the docHits of the first page
+        if objset and self.pages:
+            group, start = self.pages[0]
+            if self.groups[group].start == start:
+                self._pages_done[self.page_first] = objset
 
     def _get_doc_ark(self, docHit):
         '''Return the object's ark from the xml etree docHit'''
@@ -142,30 +162,96 @@ class OAC_XML_Fetcher(Fetcher):
             self.groups[v].start = int(g.attrib['startDoc'])
             self.groups[v].end = int(g.attrib['endDoc'])
 
-    def _get_next_result_set(self):
-        '''get the next result set
-        Return the facet element, only one were interested in'''
-        n_tries = 0
-        pause = 5
+    def _get_result_set(self, url, retries=None, convert_docs=True):
+        '''Return the first facet element of the crossQuery result and the
+        objset for its docHits, see _parse_result_set.
+        A page that breaks off or can't be parsed is fetched & parsed again
+        from the start, with backoff between the attempts.
+        '''
+        if retries is None:
+            retries = http_client.MAX_RETRIES
+        attempt = 0
         while True:
             try:
-                resp = urllib.urlopen(self._url_current)
-                break
-            except DecodeError as e:
-                n_tries += 1
-                if n_tries > 5:
-                    raise e
-                # backoff
+                return self._parse_result_set(url, convert_docs)
+            except PAGE_RETRY_EXCEPTIONS as e:
+                if attempt >= retries:
+                    raise
+                pause = http_client.backoff(attempt)
+                self.logger.warning(
+                    'Reading {} failed with {}, retry {} of {} in {:.1f}s'.
+                    format(url, repr(e), attempt + 1, retries, pause))
                 time.sleep(pause)
-                pause = pause * 2
-        # resp.encoding = 'utf-8'  # thinks it's ISO-8859-1
-        crossQueryResult = ET.fromstring(resp.read())
-        # crossQueryResult = ET.fromstring(resp.text.encode('utf-8'))
-        return crossQueryResult.find('facet')
+                attempt += 1
+
+    def _parse_result_set(self, url, convert_docs=True):
+        '''Get the page & parse the response as it is read, each docHit is
+        converted & dropped from the tree once it ends. With convert_docs
+        False the docHits are only dropped and the objset is empty.
+        '''
+        resp = http_client.get(url, stream=True)
+        try:
+            resp.raise_for_status()
+            resp.raw.decode_content = True
+            facet = group = None
+            in_facet = False
+            objset = []
+            depth = 0
+            for event, elem in ET.iterparse(resp.raw,
+                                            events=('start', 'end')):
+                if event == 'start':
+                    depth += 1
+                    if depth == 2 and elem.tag == 'facet' and facet is None:
+                        facet = elem
+                        in_facet = True
+                    elif depth == 3 and in_facet and elem.tag == 'group':
+                        group = elem
+                    continue
+                if elem is facet:
+                    in_facet = False
+                elif elem is group:
+                    group = None
+                elif depth == 4 and group is not None and \
+                        elem.tag == 'docHit':
+                    if convert_docs:
+                        objset.extend(self._docHits_to_objset([elem]))
+                    group.remove(elem)
+                depth -= 1
+        finally:
+            resp.close()
+        return facet, objset
+
+    def url_page(self, group, start):
+        '''Return the URL for the page of the group starting at start'''
+        return ''.join((self.url, '&startDoc=', str(start), '&group=', group))
+
+    def fetch_page(self, page):
+        group, start = self.pages[page - 1]
+        return self._get_result_set(self.url_page(group, start))[1]
+
+    def get_checkpoint(self):
+        '''The group being fetched & the startDoc counts for the groups'''
+        return {
+            'currentDoc': self.currentDoc,
+            'currentGroup': self.currentGroup,
+            'groups': dict((key, dict(hitgroup))
+                           for key, hitgroup in self.groups.items())
+        }
+
+    def resume(self, checkpoint):
+        self.currentDoc = checkpoint['currentDoc']
+        self.currentGroup = checkpoint['currentGroup']
+        for key, hitgroup in checkpoint['groups'].items():
+            self.groups[key] = BunchDict(**hitgroup)
+        self.page_current = self.page_first + len(
+            [(group, start) for group, start in self.pages
+             if start < self.groups[group].get('currentDoc', 1)])
 
     def next(self):
         '''Get the next page of search results
         '''
+        if self.concurrency > 1:
+            return self._next_prefetched()
         if self.currentDoc >= self.totalDocs:
             raise StopIteration
         if self.currentGroup == 'image':
@@ -173,18 +259,24 @@ class OAC_XML_Fetcher(Fetcher):
                 self.currentGroup = 'text'
                 if self.groups['text']['total'] == 0:
                     raise StopIteration
-        self._url_current = ''.join(
-            (self.url, '&startDoc=',
-             str(self.groups[self.currentGroup]['currentDoc']), '&group=',
-             self.currentGroup))
-        facet_type_tab = self._get_next_result_set()
+        self._url_current = self.url_page(
+            self.currentGroup, self.groups[self.currentGroup]['currentDoc'])
+        facet_type_tab, objset = self._get_result_set(self._url_current)
         self._update_groups(facet_type_tab.findall('group'))
-        objset = self._docHits_to_objset(
-            facet_type_tab.findall('./group/docHit'))
         self.currentDoc += len(objset)
         self.groups[self.currentGroup]['currentDoc'] += len(objset)
         return objset
 
+    def _next_prefetched(self):
+        '''Get the next page from the pages worked out from the totals'''
+        objset = super(OAC_XML_Fetcher, self).next()
+        group, start = self.pages[self.page_current - self.page_first - 1]
+        self.currentGroup = group
+        self._url_current = self.url_page(group, start)
+        self.currentDoc += len(objset)
+        self.groups[group]['currentDoc'] = start + len(objset)
+        return objset
+
 
 class OAC_JSON_Fetcher(Fetcher):
     '''Fetcher for oac, using the JSON objset interface
@@ -195,7 +287,7 @@ class OAC_JSON_Fetcher(Fetcher):
         self.oac_findaid_ark = self._parse_oac_findaid_ark(self.url)
         self.headers = {'content-type': 'application/json'}
         self.objset_last = False
-        self.resp = requests.get(self.url, headers=self.headers)
+        self.resp = http_client.get(self.url, headers=self.headers)
         api_resp = self.resp.json()
         # for key in api_resp.keys():
         #    self.__dict__[key] = api_resp[key]
@@ -230,7 +322,7 @@ class OAC_JSON_Fetcher(Fetcher):
                     raise StopIteration
             url_next = ''.join((self.url, '&startDoc=',
                                 unicode(self.objset_end + 1)))
-            self.resp = requests.get(url_next, headers=self.headers)
+            self.resp = http_client.get(url_next, headers=self.headers)
             self.api_resp = self.resp.json()
             # self.objset_total = api_resp['objset_total']
             self.objset_start = self.api_resp['objset_start']
@@ -255,7 +347,7 @@ class OAC_JSON_Fetcher(Fetcher):
         else:
             url_next = ''.join((self.url, '&startDoc=',
                                 unicode(self.objset_end + 1)))
-            self.resp = requests.get(url_next, headers=self.headers)
+            self.resp = http_client.get(url_next, headers=self.headers)
             self.api_resp = self.resp.json()
             self.objset_start = self.api_resp['objset_start']
             self.objset_end = self.api_resp['objset_end']
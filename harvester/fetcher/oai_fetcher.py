@@ -1,12 +1,12 @@
 # -*- coding: utf-8 -*-
 import re
-import tempfile
 from urlparse import parse_qs
 from .fetcher import Fetcher
+from . import http_client
+from .marc_fetcher import marc_xml_to_dicts
 from sickle import Sickle
+from sickle.response import OAIResponse
 from sickle.models import Record as SickleDCRecord
-from pymarc import parse_xml_to_array
-from lxml import etree
 
 
 def etree_to_dict(t):
@@ -15,13 +15,37 @@ def etree_to_dict(t):
     d['text'] = t.text
     return d
 
+class CheckpointSickle(Sickle):
+    '''Sickle client that remembers the resumptionToken used to get the
+    current response, and OAIFetcher counts the records it has returned
+    from that response. Together they are the checkpoint for the fetch.
+    Requests go through the shared http_client, which pools connections
+    and retries failures.
+    '''
+    page_token = None
+    page_offset = 0
+
+    def harvest(self, **kwargs):
+        self.page_token = kwargs.get('resumptionToken')
+        self.page_offset = 0
+        if self.http_method == 'GET':
+            http_response = http_client.get(self.endpoint, params=kwargs,
+                                            **self.request_args)
+        else:
+            http_response = http_client.post(self.endpoint, data=kwargs,
+                                             **self.request_args)
+        http_response.raise_for_status()
+        if self.encoding:
+            http_response.encoding = self.encoding
+        return OAIResponse(http_response, params=kwargs)
+
+
 class SickleMARCRecord(SickleDCRecord):
-    '''Extend the sickle Record to handle oai marc xml
-    using pymarc's parse_xml_to_array function.
+    '''Extend the sickle Record to handle oai marc xml,
+    converting the record in the metadata element to pymarc's
+    Record.as_dict() structure.
 
-    parse_xml_to_array takes a file and returns an array
-    of all records in the file, but in this case it's
-    guaranteed to be just one record per file, because
+    There is just one record in the metadata, because
     Sickle is handling iterating through the oai feed.
 
     SickleDCRecord definition:
@@ -31,14 +55,9 @@ class SickleMARCRecord(SickleDCRecord):
         super(SickleMARCRecord, self).__init__(
             record_element, strip_ns=strip_ns)
         if not self.deleted:
-            marc_file = tempfile.TemporaryFile()
             metadata = self.xml.find(
                 ".//" + self._oai_namespace + "metadata/")
-            marc_file.write(
-                etree.tostring(metadata, encoding='utf-8'))
-            marc_file.seek(0)
-            records = parse_xml_to_array(marc_file)
-            self.metadata = records[0].as_dict()
+            self.metadata = marc_xml_to_dicts(metadata)[0]
 
 class SickleDIDLRecord(SickleDCRecord):
     '''Extend the Sickle Record to handle oai didl xml.
@@ -68,19 +87,26 @@ class SickleDIDLRecord(SickleDCRecord):
 
 class OAIFetcher(Fetcher):
     '''Fetcher for oai'''
+    supports_since = True
 
-    def __init__(self, url_harvest, extra_data, **kwargs):
+    def __init__(self, url_harvest, extra_data, since=None, **kwargs):
+        '''If since is set, only records with a datestamp on or after that
+        day are harvested. Day granularity is supported by all OAI
+        providers.
+        '''
         super(OAIFetcher, self).__init__(url_harvest, extra_data, **kwargs)
         # TODO: check extra_data?
-        self.oai_client = Sickle(self.url)
+        self.oai_client = CheckpointSickle(self.url)
         self._metadataPrefix = self.get_metadataPrefix(extra_data)
         # ensure not cached in module?
         self.oai_client.class_mapping['ListRecords'] = SickleDCRecord
         self.oai_client.class_mapping['GetRecord'] = SickleDCRecord
+        params = {'metadataPrefix': self._metadataPrefix}
+        if since:
+            params['from'] = since.strftime('%Y-%m-%d')
         if extra_data:  # extra data is set spec
             if 'set' in extra_data:
-                params = parse_qs(extra_data)
-                self._set = params['set'][0]
+                self._set = parse_qs(extra_data)['set'][0]
             else:
                 self._set = extra_data
             # if metadataPrefix=didl, use didlRecord for parsing
@@ -90,13 +116,9 @@ class OAIFetcher(Fetcher):
             elif self._metadataPrefix.lower() == 'marcxml':
                 self.oai_client.class_mapping['ListRecords'] = SickleMARCRecord
                 self.oai_client.class_mapping['GetRecord'] = SickleMARCRecord
-            self.records = self.oai_client.ListRecords(
-                metadataPrefix=self._metadataPrefix,
-                set=self._set,
-                ignore_deleted=True)
-        else:
-            self.records = self.oai_client.ListRecords(
-                metadataPrefix=self._metadataPrefix, ignore_deleted=True)
+            params['set'] = self._set
+        self.records = self.oai_client.ListRecords(ignore_deleted=True,
+                                                   **params)
 
     def get_metadataPrefix(self, extra_data):
         '''Set the metadata format for the feed.
@@ -125,6 +147,7 @@ class OAIFetcher(Fetcher):
         '''
         while True:
             sickle_rec = self.records.next()
+            self.oai_client.page_offset += 1
             if not sickle_rec.deleted:
                 break  # good record to harvest, don't do deleted
                 # update process looks for deletions
@@ -133,6 +156,27 @@ class OAIFetcher(Fetcher):
         rec['id'] = sickle_rec.header.identifier
         return rec
 
+    def get_checkpoint(self):
+        '''The resumptionToken for the current OAI response and the number
+        of records already returned from it'''
+        return {
+            'resumptionToken': self.oai_client.page_token,
+            'offset': self.oai_client.page_offset
+        }
+
+    def resume(self, checkpoint):
+        '''Request the OAI response for the resumptionToken & skip the
+        records already returned from it. Resumption tokens expire, so
+        this only works for a while after the checkpoint was taken.
+        '''
+        if checkpoint['resumptionToken']:
+            self.records = self.oai_client.ListRecords(
+                resumptionToken=checkpoint['resumptionToken'],
+                ignore_deleted=True)
+        for n in range(checkpoint['offset']):
+            self.records.next()
+        self.oai_client.page_offset = checkpoint['offset']
+
 
 # Copyright © 2016, Regents of the University of California
 # All rights reserved.
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+import io
+import gzip
+import json
+
+# S3 multipart parts must be at least 5MB, except for the last one
+PART_SIZE = 8 * 1024 * 1024
+
+
+class S3PageWriter(object):
+    '''Stream a page of objects to an S3 key as JSONL.
+
+    Each object is serialized straight into a buffer, optionally through a
+    gzip stream. Pages that stay under part_size are saved with a single
+    put_object. Once the buffer passes part_size, a multipart upload is
+    started and the buffer is shipped as a part, so memory use is bounded
+    by part_size no matter how big the page gets.
+
+    Objects are serialized with dumps if given, else json.dumps with the
+    default handler.
+
+    Use as a context manager, the upload is finished on a clean exit and
+    aborted if an exception is raised.
+    '''
+
+    def __init__(self, bucket, key, compress=False, part_size=PART_SIZE,
+                 default=None, dumps=None):
+        self.bucket = bucket
+        self.key = key
+        self.compress = compress
+        self.part_size = part_size
+        self.default = default
+        self.dumps = dumps
+        self.num_records = 0
+        self._buffer = io.BytesIO()
+        self._stream = self._buffer
+        if self.compress:
+            self._stream = gzip.GzipFile(
+                fileobj=self._buffer, mode='wb', mtime=0)
+        self._upload = None
+        self._parts = []
+
+    @property
+    def extra_args(self):
+        '''Object metadata for the S3 key'''
+        if self.compress:
+            return dict(
+                ContentType='application/x-ndjson', ContentEncoding='gzip')
+        return {}
+
+    def write(self, obj):
+        '''Serialize one object as a line of the page'''
+        if self.dumps:
+            self.write_json(self.dumps(obj))
+        else:
+            self.write_json(json.dumps(obj, default=self.default))
+
+    def write_json(self, obj_json):
+        '''Add the JSON of an object, already serialized, as a line of the
+        page'''
+        self._stream.write(obj_json)
+        self._stream.write('\n')
+        self.num_records += 1
+        if self._buffer.tell() >= self.part_size:
+            self._upload_part()
+
+    def _upload_part(self):
+        '''Ship the current buffer as the next part of a multipart upload'''
+        if not self._upload:
+            self._upload = self.bucket.Object(
+                self.key).initiate_multipart_upload(**self.extra_args)
+        part_number = len(self._parts) + 1
+        resp = self._upload.Part(part_number).upload(
+            Body=self._buffer.getvalue())
+        self._parts.append({'ETag': resp['ETag'], 'PartNumber': part_number})
+        self._buffer.seek(0)
+        self._buffer.truncate()
+
+    def close(self):
+        '''Flush the stream and save the page'''
+        if self._stream is not self._buffer:
+            self._stream.close()
+        if not self._upload:
+            self.bucket.put_object(
+                Body=self._buffer.getvalue(), Key=self.key,
+                **self.extra_args)
+            return
+        if self._buffer.tell():
+            self._upload_part()
+        self._upload.complete(MultipartUpload={'Parts': self._parts})
+
+    def abort(self):
+        '''Throw away any parts already uploaded'''
+        if self._upload:
+            self._upload.abort()
+            self._upload = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self.abort()
+        else:
+            self.close()
+        return False
+
+
+# Copyright © 2016, Regents of the University of California
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+# - Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# - Neither the name of the University of California nor the names of its
+#   contributors may be used to endorse or promote products derived from this
+#   software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
@@ -1,17 +1,161 @@
 # -*- coding: utf-8 -*-
+import sys
+import re
+import time
+import json
+import codecs
+import threading
+import Queue
+import urllib
+from itertools import islice
 import solr
 import pysolr
 from .fetcher import Fetcher
 import urlparse
-import requests
+from . import http_client
+
+SOLR_DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+RE_DOCS_START = re.compile(r'"response"\s*:\s*\{.*?"docs"\s*:\s*\[', re.S)
+
+
+def since_filter_query(since_field, since):
+    '''Return the solr filter query for docs modified since the datetime'''
+    return '{}:[{} TO *]'.format(since_field,
+                                 since.strftime(SOLR_DATE_FORMAT))
+
+
+def range_filter_query(field, lower, upper, desc=False):
+    '''Return the filter query for values of field from lower up to, but
+    not including, upper. With desc the range includes upper and not lower,
+    for the slices of a descending sort. None is an open end.'''
+    def term(value):
+        if value is None:
+            return '*'
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return '"{}"'.format(
+            str(value).replace('\\', '\\\\').replace('"', '\\"'))
+    if desc:
+        return '{}:{}{} TO {}]'.format(field, '[' if lower is None else '{',
+                                       term(lower), term(upper))
+    return '{}:[{} TO {}{}'.format(field, term(lower), term(upper),
+                                   ']' if upper is None else '}')
+
+
+class AdaptiveRows(object):
+    '''Tunes the number of rows asked for per request from the size &
+    latency of the pages returned so far. Rows grow until a page takes about
+    target_seconds or holds max_bytes, and change by at most a factor of 2
+    per page.'''
+    def __init__(self, rows_min=10, rows_max=10000, target_seconds=5.0,
+                 max_bytes=32 * 1024 * 1024):
+        self.rows_min = rows_min
+        self.rows_max = rows_max
+        self.target_seconds = target_seconds
+        self.max_bytes = max_bytes
+
+    def update(self, rows, docs, nbytes, seconds):
+        '''Return the rows for the next request after one for rows got
+        docs in nbytes and seconds'''
+        if not docs:
+            return rows
+        rows_time = self.target_seconds * docs / max(seconds, 0.001)
+        rows_size = self.max_bytes * docs / max(nbytes, 1)
+        new_rows = min(rows_time, rows_size, rows * 2)
+        new_rows = max(new_rows, rows / 2, self.rows_min)
+        return int(min(new_rows, self.rows_max))
+
+
+class SolrDocsStream(object):
+    '''Decode the docs of a Solr JSON response as the body arrives.
+    Iterating yields the docs one by one, only the doc being decoded is
+    held as text. Once the docs are done, response holds the rest of the
+    response, the header, numFound & nextCursorMark, and nbytes the size
+    of the body.
+    A body without a response.docs list is decoded whole.
+    '''
+    def __init__(self, response, chunk_size=64 * 1024):
+        self._chunks = response.iter_content(chunk_size)
+        self._decode = codecs.getincrementaldecoder('utf-8')().decode
+        self._buffer = u''
+        self.nbytes = 0
+        self.response = None
+
+    def _read(self):
+        '''Add the next chunk of the body to the buffer, returns False at
+        the end of the body'''
+        try:
+            chunk = next(self._chunks)
+        except StopIteration:
+            self._buffer += self._decode('', True)
+            return False
+        self.nbytes += len(chunk)
+        self._buffer += self._decode(chunk)
+        return True
+
+    def _read_more(self):
+        '''Grow the buffer to twice its size, so a big doc is decoded
+        in a few tries'''
+        size = len(self._buffer) * 2
+        if not self._read():
+            return False
+        while len(self._buffer) < size and self._read():
+            pass
+        return True
+
+    def __iter__(self):
+        decoder = json.JSONDecoder()
+        match = RE_DOCS_START.search(self._buffer)
+        while not match:
+            if not self._read():
+                self.response = json.loads(self._buffer)
+                docs = self.response.get('response', {}).pop('docs', [])
+                for doc in docs:
+                    yield doc
+                return
+            match = RE_DOCS_START.search(self._buffer)
+        head = self._buffer[:match.end()]
+        self._buffer = self._buffer[match.end():]
+        pos = 0
+        while True:
+            while pos < len(self._buffer) and \
+                    self._buffer[pos] in u' \t\r\n,':
+                pos += 1
+            if pos == len(self._buffer):
+                if not self._read():
+                    raise ValueError('Solr response ends in the docs')
+                continue
+            if self._buffer[pos] == u']':
+                break
+            try:
+                doc, end = decoder.raw_decode(self._buffer, pos)
+            except ValueError:
+                if not self._read_more():
+                    raise
+                continue
+            self._buffer = self._buffer[end:]
+            pos = 0
+            yield doc
+        while self._read():
+            pass
+        self.response = json.loads(head + self._buffer[pos:])
 
 
 class SolrFetcher(Fetcher):
-    def __init__(self, url_harvest, query, **query_params):
+    supports_since = True
+
+    def __init__(self, url_harvest, query, since=None,
+                 since_field='timestamp', **query_params):
+        '''If since is set, only docs with since_field on or after it are
+        fetched'''
         super(SolrFetcher, self).__init__(url_harvest, query)
         self.solr = solr.Solr(url_harvest)  # , debug=True)
         self.query = query
-        self.resp = self.solr.select(self.query)
+        if since:
+            self.resp = self.solr.select(
+                self.query, fq=since_filter_query(since_field, since))
+        else:
+            self.resp = self.solr.select(self.query)
         self.numFound = self.resp.numFound
         self.index = 0
 
@@ -27,13 +171,23 @@ class SolrFetcher(Fetcher):
 
 
 class PySolrFetcher(Fetcher):
+    '''Harvest a Solr index with cursorMarks using pysolr.
+    Unless rows is given in the query parameters, the rows per request are
+    tuned by AdaptiveRows.
+    '''
+    supports_since = True
+
     def __init__(self,
                  url_harvest,
                  query,
                  handler_path='select',
+                 since=None,
+                 since_field='timestamp',
                  **query_params):
         super(PySolrFetcher, self).__init__(url_harvest, query, **query_params)
-        self.solr = pysolr.Solr(url_harvest, timeout=1)
+        self.solr = pysolr.Solr(url_harvest,
+                                timeout=http_client.TIMEOUT_READ)
+        self._rows = None if 'rows' in query_params else AdaptiveRows()
         self._handler_path = handler_path
         self._query_params = {
             'q': query,
@@ -43,6 +197,12 @@ class PySolrFetcher(Fetcher):
             'cursorMark': '*'
         }
         self._query_params.update(query_params)
+        if since:
+            fq = self._query_params.get('fq', [])
+            if isinstance(fq, basestring):
+                fq = [fq]
+            self._query_params['fq'] = fq + [
+                since_filter_query(since_field, since)]
         self._nextCursorMark = '*'
         self.get_next_results()
         self.numFound = self.results['response'].get('numFound')
@@ -50,20 +210,48 @@ class PySolrFetcher(Fetcher):
 
     @property
     def _query_path(self):
-        self._query_params_encoded = pysolr.safe_urlencode(self._query_params)
+        self._query_params_encoded = pysolr.safe_urlencode(
+            self._query_params, True)
         return '{}?{}'.format(self._handler_path, self._query_params_encoded)
 
     def get_next_results(self):
         self._query_params['cursorMark'] = self._nextCursorMark
+        start = time.time()
         resp = self.solr._send_request('get', path=self._query_path)
         self.results = self.solr.decoder.decode(resp)
+        if self._rows:
+            self._query_params['rows'] = self._rows.update(
+                self._query_params['rows'],
+                len(self.results['response']['docs']), len(resp),
+                time.time() - start)
         self._nextCursorMark = self.results.get('nextCursorMark')
         self.iter = self.results['response']['docs'].__iter__()
+        self._page_offset = 0
+
+    def get_checkpoint(self):
+        '''The cursorMark for the current page of results, the number of
+        docs already returned from it and the total returned'''
+        return {
+            'cursorMark': self._query_params['cursorMark'],
+            'offset': self._page_offset,
+            'index': self.index
+        }
+
+    def resume(self, checkpoint):
+        '''Get the page for the cursorMark & skip the docs already
+        returned from it'''
+        self._nextCursorMark = checkpoint['cursorMark']
+        self.get_next_results()
+        for n in range(checkpoint['offset']):
+            self.iter.next()
+        self._page_offset = checkpoint['offset']
+        self.index = checkpoint['index']
 
     def next(self):
         try:
             next_result = self.iter.next()
             self.index += 1
+            self._page_offset += 1
             return next_result
         except StopIteration:
             if self.index >= self.numFound:
@@ -75,6 +263,7 @@ class PySolrFetcher(Fetcher):
         if len(self.results['response']['docs']) == 0:
             raise StopIteration
         self.index += 1
+        self._page_offset += 1
         return self.iter.next()
 
 
@@ -97,9 +286,31 @@ class RequestsSolrFetcher(Fetcher):
         q=<query>&header=<name>:<value>&header=<name>:<value>
     The auth parameter will be parsed to figure out type of authentication
     needed, right now just deal with "header" token authentication
+    For incremental harvests the date field to filter on can be set with
+    since_field=<name>, default is "timestamp".
+    The rows per request are tuned by AdaptiveRows.
+
+    With slices=<n> in the extra_data, or the slices keyword argument, the
+    values of the first sort field are split into n ranges of about the
+    same number of docs, in the direction of the sort. The ranges are
+    harvested at the same time, each with its own cursorMark, and their
+    pages are returned in sort order. close() stops the slice threads.
+
+    With streaming=true in the extra_data, or the streaming keyword
+    argument, the docs of a page are decoded as the body arrives and
+    returned in objsets of stream_batch docs, so a page of big docs is
+    never held in memory whole.
     '''
+    checkpoint_attrs = ('_cursorMark', '_nextCursorMark')
+    supports_since = True
+    slices = 1
+    slice_pages_ahead = 2
+    slice_put_seconds = 0.5
+    streaming = False
+    stream_batch = 100
 
-    def __init__(self, url_harvest, extra_data, **kwargs):
+    def __init__(self, url_harvest, extra_data, since=None, slices=None,
+                 streaming=None, **kwargs):
         super(RequestsSolrFetcher, self).__init__(url_harvest, extra_data,
                                                   **kwargs)
         # will need to change URLs for existing to add /select in general
@@ -110,6 +321,7 @@ class RequestsSolrFetcher(Fetcher):
         if not self._query_params:  # Old style, just "q" bit of query
             self._query_params = {'q': [extra_data]}
         self._page_size = 1000
+        self._rows = AdaptiveRows()
         self._cursorMark = None
         self._nextCursorMark = '*'
         self._headers = {}
@@ -119,44 +331,281 @@ class RequestsSolrFetcher(Fetcher):
                     header_name, header_value = value.split(':', 1)
                     self._headers[header_name] = header_value
                 del self._query_params[name]
+        since_field = self._query_params.pop('since_field', ['timestamp'])[0]
+        if since:
+            self._query_params.setdefault('fq', []).append(
+                since_filter_query(since_field, since))
         if 'wt' not in self._query_params:
             self._query_params.update({'wt': ['json']})
         if 'sort' not in self._query_params:
             self._query_params.update({'sort': ['id asc']})
+        slices_param = self._query_params.pop('slices', [None])[0]
+        slices = slices or slices_param
+        if slices:
+            self.slices = int(slices)
+        self._slice = 0
+        self._bounds = None
+        self._slice_queues = None
+        self._slice_threads = []
+        self._slice_stop = threading.Event()
+        streaming_param = self._query_params.pop('streaming', [None])[0]
+        if streaming is None and streaming_param:
+            streaming = streaming_param.lower() in ('true', '1', 'yes')
+        if streaming is not None:
+            self.streaming = streaming
+        self._stream = None
+        self._stream_docs = None
+        self._stream_response = None
+        self._stream_started = None
+        self._page_offset = 0
+        self._skip_docs = 0
 
     @property
     def end_of_feed(self):
         return self._cursorMark == self._nextCursorMark
 
+    def _url(self, query_iter, fq=None):
+        '''Return the URL for the query string start and any filter query
+        added to the query parameters'''
+        url_request = ''.join((self.url, query_iter))
+        # join 'q' and all other params
+        for name, values in self._query_params.items():
+            for value in values:
+                url_request = ''.join((url_request, '&', name, '=', value))
+        if fq:
+            url_request = ''.join((url_request, '&fq=',
+                                   urllib.quote(fq, safe='')))
+        return url_request
+
     @property
     def url_request(self):
         # build current URL
-        url_request = ''.join((
-            self.url,
-            self._query_iter_template.format(
-                rows=self._page_size, cursorMark=self._cursorMark), ))
-        # join 'q' and all other params
-        for name, value in self._query_params.items():
-            url_request = ''.join((url_request, '&', name, '=', value[0]))
-        return url_request
+        return self._url(self._query_iter_template.format(
+            rows=self._page_size, cursorMark=self._cursorMark))
 
-    def get_response(self):
+    def get_response(self, **kwargs):
         '''Get the correct response for the given combo of params'''
-        return requests.get(self.url_request, headers=self._headers)
+        return http_client.get(self.url_request, headers=self._headers,
+                               **kwargs)
+
+    def _get_json(self, url):
+        '''Return the decoded response for the url, with the size of the
+        body in bytes'''
+        resp = http_client.get(url, headers=self._headers)
+        resp.raise_for_status()
+        return resp.json(), len(resp.content)
 
     def next(self):
         '''get the next page of solr data, using the cursor mark to build
         URL
         '''
+        if self.slices > 1:
+            return self._next_sliced()
+        if self.streaming:
+            return self._next_streamed()
         if (self.end_of_feed):
             raise StopIteration
         # get resp
         self._cursorMark = self._nextCursorMark
+        start = time.time()
         resp = self.get_response()
         resp.raise_for_status()
         resp_obj = resp.json()
         self._nextCursorMark = resp_obj['nextCursorMark']
-        return resp_obj['response']['docs']
+        docs = resp_obj['response']['docs']
+        self._page_size = self._rows.update(
+            self._page_size, len(docs), len(resp.content),
+            time.time() - start)
+        return docs
+
+    def _start_stream(self):
+        '''Request the page for the next cursorMark & start decoding it,
+        skipping the docs returned before a resume'''
+        self._cursorMark = self._nextCursorMark
+        self._nextCursorMark = None
+        self._stream_started = time.time()
+        resp = self.get_response(stream=True)
+        resp.raise_for_status()
+        self._stream = SolrDocsStream(resp)
+        self._stream_response = resp
+        self._stream_docs = iter(self._stream)
+        self._page_offset = self._skip_docs
+        for doc in islice(self._stream_docs, self._skip_docs):
+            pass
+        self._skip_docs = 0
+
+    def _finish_stream(self):
+        '''Take the nextCursorMark from the end of the page'''
+        self._stream_response.close()
+        self._nextCursorMark = self._stream.response['nextCursorMark']
+        self._page_size = self._rows.update(
+            self._page_size, self._page_offset, self._stream.nbytes,
+            time.time() - self._stream_started)
+        self._stream = self._stream_docs = self._stream_response = None
+
+    def _next_streamed(self):
+        '''Return the next stream_batch docs of the page being decoded'''
+        while True:
+            if self._stream is None:
+                if self.end_of_feed:
+                    raise StopIteration
+                self._start_stream()
+            docs = list(islice(self._stream_docs, self.stream_batch))
+            self._page_offset += len(docs)
+            if len(docs) < self.stream_batch:
+                self._finish_stream()
+            if docs:
+                return docs
+
+    @property
+    def _sort_clause(self):
+        '''The field & direction of the first sort clause'''
+        clause = self._query_params['sort'][0].split(',')[0].split()
+        return clause[0], len(clause) > 1 and clause[1].lower() == 'desc'
+
+    @property
+    def _sort_field(self):
+        return self._sort_clause[0]
+
+    def _get_bounds(self):
+        '''Return the values of the sort field that split the results
+        into slices of about the same size'''
+        resp_obj, size = self._get_json(self._url('?rows=0'))
+        num_found = resp_obj['response']['numFound']
+        bounds = []
+        for n in range(1, self.slices):
+            start = num_found * n / self.slices
+            if not start:
+                continue
+            resp_obj, size = self._get_json(self._url(
+                '?rows=1&start={}&fl={}'.format(start, self._sort_field)))
+            docs = resp_obj['response']['docs']
+            if docs and docs[0][self._sort_field] not in bounds:
+                bounds.append(docs[0][self._sort_field])
+        self.logger.info('{} docs split into {} slices'.format(
+            num_found, len(bounds) + 1))
+        return bounds
+
+    def _put_page(self, pages, page):
+        '''Put the page on the queue of a slice, waiting for room until the
+        fetcher is closed. Returns False if it was closed.'''
+        while not self._slice_stop.is_set():
+            try:
+                pages.put(page, timeout=self.slice_put_seconds)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _harvest_slice(self, start, end, cursor, pages):
+        '''Put the pages for the range of sort values from start to end,
+        in sort order, on the queue, with the cursorMarks for them. Runs in
+        a thread for each slice, until the slice is done or the fetcher is
+        closed.'''
+        field, desc = self._sort_clause
+        if desc:
+            fq = range_filter_query(field, end, start, desc=True)
+        else:
+            fq = range_filter_query(field, start, end)
+        rows = self._page_size
+        try:
+            while not self._slice_stop.is_set():
+                start = time.time()
+                resp_obj, size = self._get_json(self._url(
+                    self._query_iter_template.format(
+                        rows=rows, cursorMark=urllib.quote(cursor, safe='')),
+                    fq=fq))
+                docs = resp_obj['response']['docs']
+                rows = self._rows.update(rows, len(docs), size,
+                                         time.time() - start)
+                cursor_next = resp_obj['nextCursorMark']
+                if docs and not self._put_page(
+                        pages, (docs, cursor, cursor_next, None)):
+                    return
+                if cursor_next == cursor:
+                    break
+                cursor = cursor_next
+            self._put_page(pages, None)
+        except Exception:
+            self._put_page(pages, (None, None, None, sys.exc_info()))
+
+    def _start_slices(self):
+        '''Start the threads for the slices from the current one on'''
+        bounds = [None] + list(self._bounds) + [None]
+        self._slice_queues = {}
+        for index in range(self._slice, len(bounds) - 1):
+            cursor = self._nextCursorMark if index == self._slice else '*'
+            pages = Queue.Queue(self.slice_pages_ahead)
+            thread = threading.Thread(
+                target=self._harvest_slice,
+                args=(bounds[index], bounds[index + 1], cursor, pages))
+            thread.daemon = True
+            thread.start()
+            self._slice_threads.append(thread)
+            self._slice_queues[index] = pages
+
+    def _next_sliced(self):
+        '''Return the next page of the current slice, moving on to the
+        next slice when it is done'''
+        if self._bounds is None:
+            self._bounds = self._get_bounds()
+        while self._slice <= len(self._bounds):
+            if self._slice_queues is None:
+                self._start_slices()
+            page = self._slice_queues[self._slice].get()
+            if page is None:
+                del self._slice_queues[self._slice]
+                self._slice += 1
+                self._cursorMark = None
+                self._nextCursorMark = '*'
+                continue
+            docs, self._cursorMark, self._nextCursorMark, exc_info = page
+            if exc_info:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            return docs
+        raise StopIteration
+
+    def close(self):
+        '''Stop the slice threads, dropping the pages they fetched ahead,
+        and close a page being streamed'''
+        self._slice_stop.set()
+        for pages in (self._slice_queues or {}).values():
+            while True:
+                try:
+                    pages.get_nowait()
+                except Queue.Empty:
+                    break
+        for thread in self._slice_threads:
+            thread.join()
+        self._slice_threads = []
+        self._slice_queues = None
+        if self._stream_response is not None:
+            self._stream_response.close()
+            self._stream = self._stream_docs = self._stream_response = None
+
+    def get_checkpoint(self):
+        '''The cursorMarks, and for a sliced harvest the slice bounds and
+        the current slice. In the middle of a streamed page the
+        nextCursorMark isn't known yet, the number of docs returned from
+        the page is kept instead.'''
+        checkpoint = super(RequestsSolrFetcher, self).get_checkpoint()
+        if self.slices > 1:
+            checkpoint.update({'slice': self._slice, 'bounds': self._bounds})
+        if self._nextCursorMark is None:
+            checkpoint['page_offset'] = self._page_offset
+        return checkpoint
+
+    def resume(self, checkpoint):
+        '''Carry on from the cursorMark, in the same slice'''
+        super(RequestsSolrFetcher, self).resume(checkpoint)
+        if self.slices > 1:
+            self._slice = checkpoint.get('slice', 0)
+            self._bounds = checkpoint.get('bounds')
+        if self._nextCursorMark is None:
+            # ask for the page again & skip the docs already returned
+            self._nextCursorMark = self._cursorMark
+            self._cursorMark = None
+            self._skip_docs = checkpoint['page_offset']
 
 
 # Copyright © 2017, Regents of the University of California
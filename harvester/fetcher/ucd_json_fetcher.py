@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
+import math
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 from collections import defaultdict
-from .fetcher import Fetcher
-import urllib
+from .fetcher import PagedFetcher
+from . import http_client
 import extruct
-import requests
 import re
 from xml.etree import ElementTree as ET
 from w3lib.html import get_base_url
@@ -11,14 +13,47 @@ from rdflib.plugin import register, Serializer
 register('json-ld', Serializer, 'rdflib_jsonld.serializer', 'JsonLDSerializer')
 
 
-class UCD_JSON_Fetcher(Fetcher):
+def json_ld_metadata(html):
+    '''Return the metadata dict from the first JSON-LD object in the
+    page. A module function so it can run in a process pool.'''
+    # get JSON-LD from the page
+    base_url = get_base_url(html)
+    data = extruct.extract(html, base_url)
+    jsld = data.get('json-ld')[0]
+    obj_mdata = defaultdict(list)
+    for mdata in jsld:
+        obj_mdata[mdata] = jsld[mdata]
+    return dict(obj_mdata)
+
+
+class UCD_JSON_Fetcher(PagedFetcher):
     '''Retrieve JSON from each page listed on
-    UC Davis XML sitemap given as url_harvest'''
+    UC Davis XML sitemap given as url_harvest
 
-    def __init__(self, url_harvest, extra_data, **kwargs):
+    The pages are returned in objsets of page_size records. The record pages
+    for an objset are downloaded by fetch_concurrency threads and their
+    JSON-LD is extracted in the fetch thread, or by a pool of
+    extract_processes processes if that is more than 1. The pool is started
+    when the fetcher is created, forking once the fetch threads are running
+    can deadlock.
+    '''
+    checkpoint_attrs = ('page_current', 'docs_fetched')
+    fetch_concurrency = 8
+    extract_processes = 1
+
+    def __init__(self, url_harvest, extra_data, page_size=100,
+                 fetch_concurrency=None, extract_processes=None, **kwargs):
+        super(UCD_JSON_Fetcher, self).__init__(url_harvest, extra_data,
+                                               **kwargs)
         self.url_base = url_harvest
+        self.page_size = int(page_size)
+        if fetch_concurrency:
+            self.fetch_concurrency = int(fetch_concurrency)
+        if extract_processes:
+            self.extract_processes = int(extract_processes)
+        self._extract_pool = None
         self.docs_fetched = 0
-        xml = urllib.urlopen(self.url_base).read()
+        xml = http_client.get_content(self.url_base)
         total = re.findall('<url>', xml)
         self.docs_total = len(total)
 
@@ -26,34 +61,54 @@ class UCD_JSON_Fetcher(Fetcher):
         tree = ET.fromstring(xml)
         namespaces = {'xmlns': 'http://www.sitemaps.org/schemas/sitemap/0.9'}
         self.hits = tree.findall('.//xmlns:url/xmlns:loc', namespaces)
+        self.page_last = int(math.ceil(self.docs_total /
+                                       float(self.page_size)))
+        if self.extract_processes > 1:
+            self._extract_pool = multiprocessing.Pool(self.extract_processes)
+
+    def _get_html(self, url):
+        return http_client.get(url).text
+
+    def _extract(self, pages_html):
+        '''Extract the metadata from the pages, in the process pool if
+        there is one'''
+        pool = self._extract_pool
+        if not pool or len(pages_html) <= 1:
+            return map(json_ld_metadata, pages_html)
+        return pool.map(json_ld_metadata, pages_html)
 
     def _dochits_to_objset(self, docHits):
-        '''Returns list of objects.
+        '''Returns list of objects, in the order of the docHits.
         '''
+        urls = [d.text for d in docHits]
+        if self.fetch_concurrency <= 1 or len(urls) <= 1:
+            pages_html = map(self._get_html, urls)
+        else:
+            pool = ThreadPool(min(self.fetch_concurrency, len(urls)))
+            try:
+                pages_html = pool.map(self._get_html, urls)
+            finally:
+                pool.close()
+        return [{'metadata': metadata}
+                for metadata in self._extract(pages_html)]
 
-        objset = []
-        for d in docHits:
-            r = requests.get(d.text)
-
-            # get JSON-LD from the page
-            base_url = get_base_url(r.text)
-            data = extruct.extract(r.text, base_url)
-            jsld = data.get('json-ld')[0]
+    def fetch_page(self, page):
+        start = (page - 1) * self.page_size
+        return self._dochits_to_objset(
+            self.hits[start:start + self.page_size])
 
-            obj = {}
-            obj_mdata = defaultdict(list)
-            for mdata in jsld:
-                obj_mdata[mdata] = jsld[mdata]
-            obj['metadata'] = dict(obj_mdata)
-            objset.append(obj)
-            self.docs_fetched += 1
-        return objset
+    def _close_pool(self):
+        super(UCD_JSON_Fetcher, self)._close_pool()
+        if self._extract_pool:
+            self._extract_pool.terminate()
+            self._extract_pool.join()
+            self._extract_pool = None
 
     def next(self):
-        '''get next objset, use etree to pythonize'''
-        if self.docs_fetched >= self.docs_total:
-            raise StopIteration
-        return self._dochits_to_objset(self.hits)
+        '''get next objset of page_size records'''
+        objset = super(UCD_JSON_Fetcher, self).next()
+        self.docs_fetched += len(objset)
+        return objset
 
 # Copyright © 2016, Regents of the University of California
 # All rights reserved.
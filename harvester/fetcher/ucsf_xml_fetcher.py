@@ -1,28 +1,33 @@
 # -*- coding: utf-8 -*-
-import urllib
 import re
 from xml.etree import ElementTree as ET
 from collections import defaultdict
-from .fetcher import Fetcher
+from .fetcher import PagedFetcher
+from . import http_client
 
 
-class UCSF_XML_Fetcher(Fetcher):
+class UCSF_XML_Fetcher(PagedFetcher):
+    checkpoint_attrs = ('page_current', 'docs_fetched')
+
     def __init__(self, url_harvest, extra_data, page_size=100, **kwargs):
+        super(UCSF_XML_Fetcher, self).__init__(url_harvest, extra_data,
+                                               **kwargs)
         self.url_base = url_harvest
         self.page_size = page_size
-        self.page_current = 1
-        self.doc_current = 1
         self.docs_fetched = 0
-        xml = urllib.urlopen(self.url_current).read()
+        xml = http_client.get_content(self.url_current)
         total = re.search('search-hits pages="(?P<pages>\d+)" page="'
                           '(?P<page>\d+)" total="(?P<total>\d+)"', xml)
         self.docs_total = int(total.group('total'))
+        self.page_last = int(total.group('pages'))
         self.re_ns_strip = re.compile('{.*}(?P<tag>.*)$')
 
     @property
     def url_current(self):
-        return '{0}&ps={1}&p={2}'.format(self.url_base, self.page_size,
-                                         self.page_current)
+        return self.url_page(self.page_current)
+
+    def url_page(self, page):
+        return '{0}&ps={1}&p={2}'.format(self.url_base, self.page_size, page)
 
     def _dochits_to_objset(self, docHits):
         '''Returns list of objecs.
@@ -46,26 +51,28 @@ class UCSF_XML_Fetcher(Fetcher):
                 key = self.re_ns_strip.match(md.tag).group('tag')
                 obj_mdata[key].append(md.text)
             obj['metadata'] = obj_mdata
-            self.docs_fetched += 1
             objset.append(obj)
         return objset
 
+    def fetch_page(self, page):
+        '''get objset for the page, use etree to pythonize'''
+        tree = ET.fromstring(http_client.get_content(self.url_page(page)))
+        hits = tree.findall(
+            ".//{http://legacy.library.ucsf.edu/search/1.0}search-hit")
+        return self._dochits_to_objset(hits)
+
     def next(self):
-        '''get next objset, use etree to pythonize'''
-        if self.doc_current == self.docs_total:
+        try:
+            objset = super(UCSF_XML_Fetcher, self).next()
+        except StopIteration:
             if self.docs_fetched != self.docs_total:
                 raise ValueError(
                     "Number of documents fetched ({0}) doesn't match \
                     total reported by server ({1})"
                     .format(self.docs_fetched, self.docs_total))
-            else:
-                raise StopIteration
-        tree = ET.fromstring(urllib.urlopen(self.url_current).read())
-        hits = tree.findall(
-            ".//{http://legacy.library.ucsf.edu/search/1.0}search-hit")
-        self.page_current += 1
-        self.doc_current = int(hits[-1].attrib['number'])
-        return self._dochits_to_objset(hits)
+            raise
+        self.docs_fetched += len(objset)
+        return objset
 
 
 # Copyright © 2016, Regents of the University of California
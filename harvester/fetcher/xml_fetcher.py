@@ -1,28 +1,64 @@
 # -*- coding: utf-8 -*-
-import urllib
 import re
+import tempfile
 from xml.etree import ElementTree as ET
 from collections import defaultdict
 from .fetcher import Fetcher
+from . import http_client
 from itertools import islice
 
 
 
 class XML_Fetcher(Fetcher):
     '''Harvests 1,000 records at a time from
-    static XML document at url_harvest'''
+    static XML document at url_harvest
 
-    def __init__(self, url_harvest, extra_data, **kwargs):
+    In streaming mode, set with the streaming keyword or "streaming" in the
+    extra_data, the document is downloaded to a temporary file and the
+    <record> elements are parsed one at a time with iterparse and then
+    dropped, so memory use doesn't grow with the size of the document.
+    '''
+    objset_size = 1000
+    re_streaming = re.compile(r'\bstreaming\b')
+
+    def __init__(self, url_harvest, extra_data, streaming=False, **kwargs):
         self.url_base = url_harvest
         self.doc_current = 1
         self.docs_fetched = 0
-        xml = urllib.urlopen(self.url_base).read()
+        self.re_ns_strip = re.compile('{.*}(?P<tag>.*)$')
+        self.streaming = streaming or bool(
+            extra_data and self.re_streaming.search(extra_data))
+        if self.streaming:
+            self.xml_file = tempfile.TemporaryFile()
+            http_client.download(self.url_base, self.xml_file)
+            self.xml_file.seek(0)
+            self.objsets = self._stream_objsets()
+            return
+        xml = http_client.get_content(self.url_base)
         total = re.findall('<record>', xml)
         self.docs_total = len(total)
         # Use etree to pythonize
         tree = ET.fromstring(xml)
         self.hits = tree.findall(".//record")
-        self.re_ns_strip = re.compile('{.*}(?P<tag>.*)$')
+
+    def _record_to_obj(self, d):
+        '''Return the object for a record element'''
+        obj = {}
+        obj_mdata = defaultdict(list)
+        for mdata in d.iter():
+            # Find elements w/ text value and no children
+            if mdata.text and (len(mdata) is 0):
+                if self.re_ns_strip.match(mdata.tag):
+                    key = self.re_ns_strip.match(mdata.tag).group('tag')
+                else:
+                    key = mdata.tag
+                obj_mdata[key].append(mdata.text)
+            # Find elements w/ attribute value and no children
+            if mdata.attrib and (len(mdata) is 0):
+                for elem in mdata.attrib:
+                    obj_mdata[elem].append(mdata.get(elem))
+        obj['metadata'] = dict(obj_mdata)
+        return obj
 
     def _dochits_to_objset(self, docHits):
         '''Returns list of objects.
@@ -30,22 +66,7 @@ class XML_Fetcher(Fetcher):
         objset = []
         # Use islice w/ self.docs_fetched  to iterate through docHits
         for d in islice(docHits, self.docs_fetched, None):
-            obj = {}
-            obj_mdata = defaultdict(list)
-            for mdata in d.iter():
-                # Find elements w/ text value and no children
-                if mdata.text and (len(mdata) is 0):
-                    if self.re_ns_strip.match(mdata.tag):
-                        key = self.re_ns_strip.match(mdata.tag).group('tag')
-                    else:
-                        key = mdata.tag
-                    obj_mdata[key].append(mdata.text)
-                # Find elements w/ attribute value and no children
-                if mdata.attrib and (len(mdata) is 0):
-                    for elem in mdata.attrib:
-                        obj_mdata[elem].append(mdata.get(elem))
-            obj['metadata'] = dict(obj_mdata)
-            objset.append(obj)
+            objset.append(self._record_to_obj(d))
             self.docs_fetched += 1
             self.doc_current += 1
             # Once 1000 records in objset, reset self.doc_current & break/return
@@ -54,8 +75,36 @@ class XML_Fetcher(Fetcher):
                 break
         return objset
 
+    def _stream_objsets(self):
+        '''Generate objsets of objset_size records from the downloaded
+        document. Each record element is removed from its parent once it is
+        converted.'''
+        objset = []
+        parents = []
+        try:
+            for event, elem in ET.iterparse(self.xml_file,
+                                            events=('start', 'end')):
+                if event == 'start':
+                    parents.append(elem)
+                    continue
+                parents.pop()
+                if elem.tag != 'record' or not parents:
+                    continue
+                objset.append(self._record_to_obj(elem))
+                parents[-1].remove(elem)
+                self.docs_fetched += 1
+                if len(objset) == self.objset_size:
+                    yield objset
+                    objset = []
+            if objset:
+                yield objset
+        finally:
+            self.xml_file.close()
+
     def next(self):
         '''get next objset, use etree to pythonize'''
+        if self.streaming:
+            return next(self.objsets)
         if self.docs_fetched >= self.docs_total:
             raise StopIteration
         return self._dochits_to_objset(self.hits)
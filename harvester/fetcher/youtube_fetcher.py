@@ -1,8 +1,8 @@
 # -*- coding: utf-8 -*-
 import os
-import urllib
 import json
 from .fetcher import Fetcher
+from . import http_client
 
 class YouTube_Fetcher(Fetcher):
     '''A fetcher for the youtube API.
@@ -39,25 +39,25 @@ class YouTube_Fetcher(Fetcher):
         # Single video harvesting, don't need playlist page
         if self.url_base.lower() == 'http://single.edu':
             video_items = json.loads(
-                urllib.urlopen(self.url_video.format(
-                    api_key=self.api_key, video_ids=self.playlist_id)).read())['items']
+                http_client.get_content(self.url_video.format(
+                    api_key=self.api_key, video_ids=self.playlist_id)))['items']
             # Delete nextPageToken to stop iteration
             del self.playlistitems['nextPageToken']
             return video_items
         else:
             self.playlistitems = json.loads(
-                urllib.urlopen(
+                http_client.get_content(
                     self.url_playlistitems.format(
                         api_key=self.api_key,
                         page_size=self.page_size,
                         playlist_id=self.playlist_id,
-                        page_token=nextPageToken)).read())
+                        page_token=nextPageToken)))
             video_ids = [
                 i['contentDetails']['videoId'] for i in self.playlistitems['items']
             ]
             video_items = json.loads(
-                urllib.urlopen(self.url_video.format(
-                    api_key=self.api_key, video_ids=','.join(video_ids))).read())['items']
+                http_client.get_content(self.url_video.format(
+                    api_key=self.api_key, video_ids=','.join(video_ids))))['items']
             return video_items
 
 
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+'''A bounded cache of computed values for the hot spots of the solr mapping.
+'''
+import os
+import threading
+import tempfile
+import cPickle as pickle
+from collections import OrderedDict
+
+MISSING = object()
+
+
+class LRUCache(object):
+    '''A mapping of at most maxsize items, the least recently used item is
+    dropped to make room for a new one. hits & misses count the lookups
+    with get. The items added since the last pop_new_items are tracked, so
+    the caches of worker processes can be merged back with update.
+    '''
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._new = set()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=MISSING):
+        '''Return the value for key, marking it as recently used, or
+        default if it isn't cached'''
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._items[key] = value
+            self.hits += 1
+            return value
+
+    def __setitem__(self, key, value):
+        self._set(key, value, new=True)
+
+    def _set(self, key, value, new):
+        with self._lock:
+            if self._items.pop(key, MISSING) is MISSING and new:
+                self._new.add(key)
+            self._items[key] = value
+            while len(self._items) > self.maxsize:
+                self._new.discard(self._items.popitem(last=False)[0])
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def items(self):
+        '''The cached items, least recently used first'''
+        with self._lock:
+            return self._items.items()
+
+    def update(self, items):
+        '''Add the (key, value) items'''
+        for key, value in items:
+            self[key] = value
+
+    def pop_new_items(self):
+        '''Return the items added since the last call, that are still
+        cached'''
+        with self._lock:
+            items = [(key, self._items[key]) for key in self._new]
+            self._new.clear()
+            return items
+
+    def clear(self):
+        '''Drop the items and reset the counters'''
+        with self._lock:
+            self._items.clear()
+            self._new.clear()
+            self.hits = self.misses = 0
+
+    def load(self, path):
+        '''Add the items saved to path, a missing or unreadable file is
+        ignored. These aren't new items for pop_new_items.'''
+        try:
+            with open(path, 'rb') as f:
+                items = pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return
+        for key, value in items:
+            self._set(key, value, new=False)
+
+    def save(self, path):
+        '''Save the items to path, atomically so a run that is killed
+        leaves the previous file in place'''
+        fd, path_tmp = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(self.items(), f, pickle.HIGHEST_PROTOCOL)
+        os.rename(path_tmp, path)
+
+    def stats(self):
+        '''Return the hits, misses & size, to see if the cache pays off'''
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._items)}
+
+
+# Copyright © 2016, Regents of the University of California
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+# - Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# - Neither the name of the University of California nor the names of its
+#   contributors may be used to endorse or promote products derived from this
+#   software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
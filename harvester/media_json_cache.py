@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+'''A local cache of the parsed Nuxeo media json files on S3.
+
+Entries are keyed by the bucket & key of the media json and hold the ETag of
+the object they were parsed from. A lookup sends a conditional GET with
+If-None-Match, so an unchanged media json costs a 304 and is not downloaded
+or parsed again.
+
+Each entry is a small JSON file in the cache directory. Lookups touch the
+file, and once the directory grows past max_bytes the least recently used
+entries are removed.
+
+The cache is shared by the Nuxeo fetcher and the solr updater, which checks
+the files listed in the entry exist instead of getting the media json again.
+It is turned on by setting MEDIA_JSON_CACHE_DIR, MEDIA_JSON_CACHE_MB limits
+its size (512 by default).
+'''
+import os
+import json
+import hashlib
+import tempfile
+import threading
+from urlparse import urlparse
+import logbook
+import boto3
+from botocore.exceptions import ClientError
+
+logger = logbook.Logger('MediaJsonCache')
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def parse_media_json(media_json):
+    '''Return the parts of a media json dict the harvester uses: the
+    labels of the object & its components and the files they refer to'''
+    labels = [media_json['label']]
+    files = []
+    if media_json.get('href'):
+        files.append(media_json['href'])
+    for component in media_json.get('structMap', []):
+        labels.append(component['label'])
+        if component.get('href'):
+            files.append(component['href'])
+    return {'labels': labels, 'files': files}
+
+
+def split_s3_url(url):
+    '''Return the bucket & key for an s3://bucket/key URL'''
+    parts = urlparse(url)
+    return parts.netloc, parts.path.lstrip('/')
+
+
+class MediaJsonCache(object):
+    '''On disk cache of parsed media json, see the module docstring'''
+    evict_every = 100
+
+    def __init__(self, cache_dir, max_bytes=512 * 1024 * 1024, s3=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._s3 = s3
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    @property
+    def s3(self):
+        if self._s3 is None:
+            self._s3 = boto3.client('s3')
+        return self._s3
+
+    def _path(self, bucket, key):
+        name = hashlib.sha1('/'.join((bucket, key))).hexdigest()
+        return os.path.join(self.cache_dir, name + '.json')
+
+    def _read(self, path):
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return entry
+
+    def _write(self, path, entry):
+        '''Write the entry atomically, other threads or processes may be
+        reading it'''
+        fd, path_tmp = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entry, f)
+        os.rename(path_tmp, path)
+        with self._lock:
+            self._writes += 1
+            evict = self._writes % self.evict_every == 0
+        if evict:
+            self.evict()
+
+    def get(self, bucket, key):
+        '''Return the entry for the media json, fetching it only if it
+        changed since it was cached. Raises ClientError if the object is
+        missing.'''
+        path = self._path(bucket, key)
+        entry = self._read(path)
+        kwargs = {}
+        if entry:
+            kwargs['IfNoneMatch'] = entry['etag']
+        try:
+            resp = self.s3.get_object(Bucket=bucket, Key=key, **kwargs)
+        except ClientError as e:
+            if entry and e.response['Error']['Code'] in ('304',
+                                                         'NotModified'):
+                with self._lock:
+                    self.hits += 1
+                return entry
+            raise
+        with self._lock:
+            self.misses += 1
+        entry = {
+            'bucket': bucket,
+            'key': key,
+            'etag': resp['ETag'],
+        }
+        entry.update(parse_media_json(json.loads(resp['Body'].read())))
+        self._write(path, entry)
+        return entry
+
+    def get_url(self, url):
+        '''Return the entry for an s3:// URL'''
+        return self.get(*split_s3_url(url))
+
+    def check_files(self, entry):
+        '''Check that the files the media json refers to exist, with a
+        HEAD of each. Raises ValueError for the first one missing.
+        HTTP files are checked with the shared http_client session.'''
+        # imported here, the fetcher package imports this module
+        from harvester.fetcher import http_client
+        for url in entry['files']:
+            if url.startswith('s3://'):
+                bucket, key = split_s3_url(url)
+                try:
+                    self.s3.head_object(Bucket=bucket, Key=key)
+                except ClientError as e:
+                    raise ValueError('{} {}'.format(url, e))
+                continue
+            resp = http_client.head(url, allow_redirects=True)
+            if not resp.ok:
+                raise ValueError('{} HTTP {}'.format(url, resp.status_code))
+
+    def evict(self):
+        '''Remove least recently used entries until the cache is under 90%
+        of max_bytes'''
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        if total <= self.max_bytes:
+            return
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+        logger.info('Evicted media json cache entries, {} bytes left'.format(
+            total))
+
+
+def get_media_json_cache():
+    '''Return the cache for the process, None if MEDIA_JSON_CACHE_DIR isn't
+    set'''
+    global _cache
+    cache_dir = os.environ.get('MEDIA_JSON_CACHE_DIR')
+    if not cache_dir:
+        return None
+    with _cache_lock:
+        if _cache is None or _cache.cache_dir != cache_dir:
+            _cache = MediaJsonCache(
+                cache_dir,
+                int(os.environ.get('MEDIA_JSON_CACHE_MB', 512)) * 1024 * 1024)
+    return _cache
+
+
+# Copyright © 2016, Regents of the University of California
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+# - Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# - Neither the name of the University of California nor the names of its
+#   contributors may be used to endorse or promote products derived from this
+#   software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
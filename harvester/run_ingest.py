@@ -125,6 +125,18 @@ def main(user_email,
     logger.info("INGEST DOC ID:{0}".format(ingest_doc_id))
     logger.info('HARVESTED {0} RECORDS'.format(num_recs))
     logger.info('IN DIR:{0}'.format(dir_save))
+    if harvester.incremental:
+        logger.info('CHANGED {0} RECORDS'.format(
+            harvester.num_records_changed))
+        if not harvester.num_records_changed:
+            publish_to_harvesting(
+                format_results_subject(collection.id,
+                                       'Harvest to CouchDB {env} '),
+                'No new or changed records for CID: {}\n'
+                'Fetched: {}'.format(collection.id, num_recs))
+            log_handler.pop_application()
+            mail_handler.pop_application()
+            return
     resp = enrich_records.main([None, ingest_doc_id])
     if not resp == 0:
         logger.error("Error enriching records {0}".format(resp))
@@ -138,10 +150,13 @@ def main(user_email,
     num_saved = resp
     logger.info("SAVED RECS : {}".format(num_saved))
 
-    resp = remove_deleted_records.main([None, ingest_doc_id])
-    if not resp == 0:
-        logger.error("Error deleting records {0}".format(resp))
-        raise Exception("Error deleting records {0}".format(resp))
+    # an incremental harvest doesn't fetch the unchanged records, they
+    # would look deleted
+    if not harvester.incremental:
+        resp = remove_deleted_records.main([None, ingest_doc_id])
+        if not resp == 0:
+            logger.error("Error deleting records {0}".format(resp))
+            raise Exception("Error deleting records {0}".format(resp))
 
     resp = check_ingestion_counts.main([None, ingest_doc_id])
     if not resp == 0:
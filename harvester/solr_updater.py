@@ -7,7 +7,11 @@ import argparse
 import re
 import hashlib
 import json
-from collections import defaultdict
+import threading
+from collections import defaultdict, deque
+from itertools import islice
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from urlparse import urlparse
 import requests
 import boto3
@@ -17,6 +21,8 @@ from harvester.couchdb_init import get_couchdb
 from harvester.post_processing.couchdb_runner import CouchDBCollectionFilter
 from harvester.sns_message import publish_to_harvesting
 from harvester.sns_message import format_results_subject
+from harvester.media_json_cache import get_media_json_cache
+from harvester.lru_cache import LRUCache, MISSING
 from facet_decade import facet_decade
 from mediajson import MediaJson
 import datetime
@@ -25,17 +31,23 @@ reload(sys)
 sys.setdefaultencoding('utf8')
 
 S3_BUCKET = 'solr.ucldc'
+# processes mapping couch docs in a collection sync, 0 for one per CPU
+MAP_PROCESSES = int(os.environ.get('SOLR_MAP_PROCESSES', 1)) or None
 
 RE_ARK_FINDER = re.compile('(ark:/\d\d\d\d\d/[^/|\s]*)')
 RE_ALPHANUMSPACE = re.compile(r'[^0-9A-Za-z\s]*')  # \W include "_" as does A-z
-
-
-def dict_for_data_field(field_src, data, field_dest):
-    '''For a given field_src  in the data, create a dictionary to
-    update the field_dest with.
-    If no values, make the dict {}, this will avoid empty data values
-    '''
-    ddict = {}
+JSON_WHITESPACE = ' \t\n\r'
+# unpacked values of the JSON strings found in the couch docs
+DEJSON_CACHE = LRUCache(int(os.environ.get('DEJSON_CACHE_SIZE', 10000)))
+dejson_skipped = 0
+dejson_skipped_lock = threading.Lock()
+# parsed dates & decades for the raw date values, see cached_date_value
+DATE_CACHE = LRUCache(int(os.environ.get('DATE_CACHE_SIZE', 10000)))
+
+
+def non_blank_values(field_src, data):
+    '''Return the values of field_src in the data, de-jsonfied, without
+    blanks. A string or a list, empty if there are no values'''
     items_not_blank = []
     items = data.get(field_src)
 
@@ -49,89 +61,123 @@ def dict_for_data_field(field_src, data, field_dest):
             for i in items:
                 if i:
                     items_not_blank.append(i)
-    if items_not_blank:
-        ddict = {field_dest: items_not_blank}
-    return ddict
-
-
-def dict_for_data_to_fields(field_src, data, field_dests):
-    '''Copy sourceResource field to 2 or more solr doc fields'''
-    data_dict = {}
-    for field in field_dests:
-        data_dict.update(dict_for_data_field(field_src, data, field))
-    return data_dict
-
-COUCHDOC_TO_SOLR_MAPPING = {
-    '_id': lambda d: {'harvest_id_s': d['_id']},
-    'object': lambda d: {'reference_image_md5': d['object']},
-    'object_dimensions': lambda d: {'reference_image_dimensions':
-                                    '{0}:{1}'.format(
-                                        d['object_dimensions'][0],
-                                        d['object_dimensions'][1])},
-    'isShownAt': lambda d: {'url_item': d['isShownAt']},
-    # NOTE: if no item_count field, this will be omitted from solr doc
-    'item_count': lambda d: {'item_count': d.get('item_count', 0)},
-}
+    return items_not_blank
+
+
+def copy_value(*fields_dest):
+    '''Plan step that copies the value to the solr fields'''
+    def build(field_src):
+        def write(data, solr_doc):
+            value = data[field_src]
+            for field_dest in fields_dest:
+                solr_doc[field_dest] = value
+        return write
+    return build
+
+
+def copy_non_blank(*fields_dest):
+    '''Plan step that sets the solr fields to the non blank values, if
+    there are any'''
+    def build(field_src):
+        def write(data, solr_doc):
+            values = non_blank_values(field_src, data)
+            if values:
+                for field_dest in fields_dest:
+                    solr_doc[field_dest] = values if isinstance(
+                        values, basestring) else list(values)
+        return write
+    return build
+
+
+def write_with(function):
+    '''Plan step that calls function(data, solr_doc)'''
+    return lambda field_src: function
+
+
+def write_dimensions(data, solr_doc):
+    solr_doc['reference_image_dimensions'] = '{0}:{1}'.format(
+        data['object_dimensions'][0], data['object_dimensions'][1])
+
+
+def write_registry_data(data, solr_doc):
+    solr_doc.update(map_registry_data(data['collection']))
+
+
+def write_date(data, solr_doc):
+    solr_doc.update(map_date(data))
+
 
+def write_language(data, solr_doc):
+    solr_doc['language'] = [
+        l.get('name', l.get('iso639_3', None))
+        if isinstance(l, dict) else l for l in data['language']]
+
+
+def write_subject(data, solr_doc):
+    solr_doc['subject'] = [s['name'] if isinstance(s, dict)
+                           else dejson('subject', s)
+                           for s in data['subject']]
+
+
+def write_temporal(data, solr_doc):
+    solr_doc['temporal'] = unpack_date(data.get('temporal', None))[0]
+
+
+# How the couch doc fields map to the solr doc, as an ordered list of
+# (part of the couch doc, source field, step) for map_couch_to_solr_doc.
+# A source field of None runs the step for every doc.
 # So no "coverage" has been in the sourceResource, it's always mapped to
 # spatial. With QDC we have a better fidelity.
-# for the interim, spatial needs to map to coverage & spatial.
-# Will this wind up wiping out any sourceResource coverage values?
-COUCHDOC_SRC_RESOURCE_TO_SOLR_MAPPING = {
-    'alternativeTitle': lambda d: dict_for_data_field('alternativeTitle', d,
-                                                      'alternative_title'),
-    'contributor': lambda d: dict_for_data_field('contributor', d,
-                                                 'contributor'),
-    'coverage': lambda d: dict_for_data_field('coverage', d, 'coverage'),
-    'spatial': lambda d: dict_for_data_to_fields('spatial', d, ('spatial',
-                                                                'coverage')),
-    'creator': lambda d: dict_for_data_field('creator', d, 'creator'),
-    'date': lambda d:  map_date(d),
-    'description': lambda d: dict_for_data_field('description', d,
-                                                 'description'),
-    'extent': lambda d: dict_for_data_field('extent', d, 'extent'),
-    'format': lambda d: dict_for_data_field('format', d, 'format'),
-    'genre': lambda d: dict_for_data_field('genre', d, 'genre'),
-    'identifier': lambda d: dict_for_data_field('identifier', d, 'identifier'),
-    'language': lambda d: {
-        'language': [
-            l.get('name', l.get('iso639_3', None))
-            if isinstance(l, dict) else l for l in d['language']]},
-    'publisher': lambda d: dict_for_data_field('publisher', d, 'publisher'),
-    'relation': lambda d: dict_for_data_field('relation', d, 'relation'),
-    'rights': lambda d: dict_for_data_field('rights', d, 'rights'),
-    'rightsURI': lambda d: dict_for_data_field('rightsURI', d, 'rights_uri'),
-    'subject': lambda d: {'subject': [s['name']
-                                      if isinstance(s, dict)
-                                      else dejson('subject', s)
-                                      for s in d['subject']]},
-    'temporal': lambda d: {'temporal': unpack_date(d.get('temporal',
-                                                         None))[0]},
-    'title': lambda d: dict_for_data_field('title', d, 'title'),
-    'type': lambda d: dict_for_data_field('type', d, 'type'),
-    'provenance': lambda d: dict_for_data_field('provenance', d, 'provenance'),
-}
-
-COUCHDOC_ORIGINAL_RECORD_TO_SOLR_MAPPING = {
-    #    'location': lambda d: {'location': d.get('location', None)},
-    'dateCopyrighted':
-    lambda d: dict_for_data_field('dateCopyrighted', d, 'rights_date'),
-    'rightsHolder':
-    lambda d: dict_for_data_field('rightsHolder', d, 'rights_holder'),
-    'rightsNote':
-    lambda d: dict_for_data_field('rightsNote', d, 'rights_note'),
-    'source': lambda d: dict_for_data_field('source', d, 'source'),
-    'structmap_text':
-    lambda d: dict_for_data_field('structmap_text', d, 'structmap_text'),
-    'structmap_url':
-    lambda d: dict_for_data_field('structmap_url', d, 'structmap_url'),
-    'transcription':
-    lambda d: dict_for_data_field('transcription', d, 'transcription'),
-
-    # UCLDC/DC metadata: use schema prefix & d['properties']
-    'ucldc_schema:physlocation':
-    lambda d: dict_for_data_field('ucldc_schema:physlocation', d['properties'], 'location'),
-}
+# for the interim, spatial maps to coverage & spatial. "coverage" comes
+# after "spatial" so coverage values aren't replaced by the spatial ones.
+SOLR_FIELD_MAP = (
+    ('doc', '_id', copy_value('harvest_id_s')),
+    ('doc', 'object', copy_value('reference_image_md5')),
+    ('doc', 'object_dimensions', write_with(write_dimensions)),
+    ('doc', 'isShownAt', copy_value('url_item')),
+    ('doc', 'item_count', copy_value('item_count')),
+    ('originalRecord', None, write_with(write_registry_data)),
+    ('sourceResource', 'alternativeTitle',
+     copy_non_blank('alternative_title')),
+    ('sourceResource', 'contributor', copy_non_blank('contributor')),
+    ('sourceResource', 'spatial', copy_non_blank('spatial', 'coverage')),
+    ('sourceResource', 'coverage', copy_non_blank('coverage')),
+    ('sourceResource', 'creator', copy_non_blank('creator')),
+    ('sourceResource', 'date', write_with(write_date)),
+    ('sourceResource', 'description', copy_non_blank('description')),
+    ('sourceResource', 'extent', copy_non_blank('extent')),
+    ('sourceResource', 'format', copy_non_blank('format')),
+    ('sourceResource', 'genre', copy_non_blank('genre')),
+    ('sourceResource', 'identifier', copy_non_blank('identifier')),
+    ('sourceResource', 'language', write_with(write_language)),
+    ('sourceResource', 'publisher', copy_non_blank('publisher')),
+    ('sourceResource', 'relation', copy_non_blank('relation')),
+    ('sourceResource', 'rights', copy_non_blank('rights')),
+    ('sourceResource', 'rightsURI', copy_non_blank('rights_uri')),
+    ('sourceResource', 'subject', write_with(write_subject)),
+    ('sourceResource', 'temporal', write_with(write_temporal)),
+    ('sourceResource', 'title', copy_non_blank('title')),
+    ('sourceResource', 'type', copy_non_blank('type')),
+    ('sourceResource', 'provenance', copy_non_blank('provenance')),
+    ('originalRecord', 'dateCopyrighted', copy_non_blank('rights_date')),
+    ('originalRecord', 'rightsHolder', copy_non_blank('rights_holder')),
+    ('originalRecord', 'rightsNote', copy_non_blank('rights_note')),
+    ('originalRecord', 'source', copy_non_blank('source')),
+    ('originalRecord', 'structmap_text', copy_non_blank('structmap_text')),
+    ('originalRecord', 'structmap_url', copy_non_blank('structmap_url')),
+    ('originalRecord', 'transcription', copy_non_blank('transcription')),
+    ('properties', 'ucldc_schema:physlocation', copy_non_blank('location')),
+)
+
+
+def compile_field_map(field_map):
+    '''Return the plan for the field map, (part, source field, write)
+    steps where write(data, solr_doc) sets the solr fields'''
+    return tuple((part, field_src, build(field_src))
+                 for part, field_src, build in field_map)
+
+
+SOLR_FIELD_PLAN = compile_field_map(SOLR_FIELD_MAP)
 
 
 def getjobj(data):
@@ -143,11 +189,17 @@ def getjobj(data):
     return jobj
 
 
-def unpack_if_json(field, data):
-    '''If data is a valid json object, attempt to flatten data to a string.
-    All the json data at this point should be a scalar or a dict
-    In general if there is a field 'name' that is the data
-    '''
+def looks_like_json_object(data):
+    '''Cheap check that a string could be a JSON object, the only JSON
+    unpack_if_json changes'''
+    first = data[:1]
+    if first == '{':
+        return True
+    return bool(first) and first in JSON_WHITESPACE and \
+        data.lstrip(JSON_WHITESPACE)[:1] == '{'
+
+
+def _unpack_json(data):
     flatdata = data
     j = getjobj(data)
     if j:
@@ -158,6 +210,43 @@ def unpack_if_json(field, data):
     return flatdata
 
 
+def unpack_if_json(field, data):
+    '''If data is a valid json object, attempt to flatten data to a string.
+    All the json data at this point should be a scalar or a dict
+    In general if there is a field 'name' that is the data
+    Strings that can't be a JSON object are returned without parsing, the
+    string results for those that can are kept in DEJSON_CACHE.
+    '''
+    global dejson_skipped
+    if not isinstance(data, basestring):
+        return _unpack_json(data)
+    if not looks_like_json_object(data):
+        with dejson_skipped_lock:
+            dejson_skipped += 1
+        return data
+    flatdata = DEJSON_CACHE.get(data)
+    if flatdata is MISSING:
+        flatdata = _unpack_json(data)
+        if isinstance(flatdata, basestring):
+            DEJSON_CACHE[data] = flatdata
+    return flatdata
+
+
+def dejson_stats():
+    '''Return the number of strings unpack_if_json didn't need to parse
+    and the hits & misses of DEJSON_CACHE'''
+    stats = DEJSON_CACHE.stats()
+    stats['skipped'] = dejson_skipped
+    return stats
+
+
+def dejson_counts_since(stats):
+    '''Return the hits, misses & skipped counted since the dejson_stats'''
+    now = dejson_stats()
+    return dict((key, now[key] - stats[key])
+                for key in ('hits', 'misses', 'skipped'))
+
+
 def dejson(field, data):
     '''de-jsonfy the data.
     For valid json strings, unpack in sensible way?
@@ -238,8 +327,7 @@ def get_dates_from_date_obj(date_obj):
         return None, None, None
 
 
-def unpack_date(date_obj):
-    '''Unpack a couchdb date object'''
+def _unpack_date(date_obj):
     dates = []
     dates_start = []
     dates_end = []
@@ -268,6 +356,45 @@ def unpack_date(date_obj):
     return dates, dates_start, dates_end
 
 
+def date_cache_key(kind, date_obj):
+    '''Key for a value computed from a raw couchdb date structure'''
+    return kind + json.dumps(date_obj, sort_keys=True)
+
+
+def cached_date_value(kind, date_obj, compute):
+    '''Return compute(date_obj), from DATE_CACHE if it was computed for an
+    equal date structure before. Exceptions are not cached.'''
+    key = date_cache_key(kind, date_obj)
+    value = DATE_CACHE.get(key)
+    if value is MISSING:
+        value = compute(date_obj)
+        DATE_CACHE[key] = value
+    return value
+
+
+def load_date_cache():
+    '''Fill DATE_CACHE from the DATE_CACHE_FILE of a previous run, if the
+    env var is set'''
+    if os.environ.get('DATE_CACHE_FILE'):
+        DATE_CACHE.load(os.environ['DATE_CACHE_FILE'])
+
+
+def save_date_cache():
+    '''Save DATE_CACHE to DATE_CACHE_FILE, if the env var is set'''
+    if os.environ.get('DATE_CACHE_FILE'):
+        DATE_CACHE.save(os.environ['DATE_CACHE_FILE'])
+
+
+def unpack_date(date_obj):
+    '''Unpack a couchdb date object
+    The results are cached, the lists returned are new for each call.
+    '''
+    if not date_obj or not len(date_obj):
+        return None, None, None
+    dates = cached_date_value('dates', date_obj, _unpack_date)
+    return tuple(list(values) for values in dates)
+
+
 def map_date(d):
     date_map = {}
     date_source = d.get('date', None)
@@ -479,7 +606,7 @@ def add_slash(url):
 
 
 class OldCollectionException(Exception):
-    pass
+    dict_key = 'Old Collection'
 
 
 def map_registry_data(collections):
@@ -544,18 +671,20 @@ def map_registry_data(collections):
     return registry_dict
 
 
-def get_facet_decades(date):
-    '''Return set of decade string for given date structure.
-    date is a dict with a "displayDate" key.
-    '''
+def _get_facet_decades(date):
     if isinstance(date, dict):
         facet_decades = facet_decade(date.get('displayDate', ''))
     else:
         facet_decades = facet_decade(str(date))
-    facet_decade_set = set()  # don't repeat values
-    for decade in facet_decades:
-        facet_decade_set.add(decade)
-    return facet_decade_set
+    return frozenset(facet_decades)  # don't repeat values
+
+
+def get_facet_decades(date):
+    '''Return set of decade string for given date structure.
+    date is a dict with a "displayDate" key.
+    The decades are cached, the set returned is new for each call.
+    '''
+    return set(cached_date_value('facet', date, _get_facet_decades))
 
 
 def normalize_sort_field(sort_field,
@@ -665,12 +794,18 @@ class MissingMediaJSON(ValueError):
 def check_nuxeo_media(doc):
     '''Check that the media_json and jp2000 exist for a given solr doc.
     Raise exception if not
+    With the media json cache turned on, the files listed in the cached
+    media json are checked, the media json is only fetched if it changed.
     '''
     if 'structmap_url' not in doc:
         return
+    cache = get_media_json_cache()
     # check that there is an object at the structmap_url
     try:
-        MediaJson(doc['structmap_url']).check_media()
+        if cache:
+            cache.check_files(cache.get_url(doc['structmap_url']))
+        else:
+            MediaJson(doc['structmap_url']).check_media()
     except ClientError as e:
         message = '---- OMITTED: Doc:{} missing media json {}'.format(
             doc['harvest_id_s'],
@@ -687,57 +822,26 @@ def check_nuxeo_media(doc):
 
 def map_couch_to_solr_doc(doc):
     '''Return a json document suitable for updating the solr index
-    how to make schema aware mapping?'''
+    The fields are mapped by the steps of SOLR_FIELD_PLAN, in order.'''
     solr_doc = {}
-    for p in doc.keys():
-        if p in COUCHDOC_TO_SOLR_MAPPING:
-            try:
-                solr_doc.update(COUCHDOC_TO_SOLR_MAPPING[p](doc))
-            except TypeError as e:
-                print(
-                    'TypeError for doc {} on COUCHDOC_TO_SOLR_MAPPING {}'.
-                    format(doc['_id'], p),
-                    file=sys.stderr)
-                raise e
-
-    reg_data_dict = map_registry_data(doc['originalRecord']['collection'])
-    solr_doc.update(reg_data_dict)
-    sourceResource = doc['sourceResource']
-    for p in sourceResource.keys():
-        if p in COUCHDOC_SRC_RESOURCE_TO_SOLR_MAPPING:
-            try:
-                solr_doc.update(COUCHDOC_SRC_RESOURCE_TO_SOLR_MAPPING[p](
-                    sourceResource))
-            except TypeError as e:
-                print(
-                    'TypeError for doc {} on sourceResource {}'.format(
-                        doc['_id'], p),
-                    file=sys.stderr)
-                raise e
     originalRecord = doc['originalRecord']
-    for k in originalRecord.keys():
-        if k in COUCHDOC_ORIGINAL_RECORD_TO_SOLR_MAPPING:
+    parts = {
+        'doc': doc,
+        'sourceResource': doc['sourceResource'],
+        'originalRecord': originalRecord,
+        'properties': originalRecord.get('properties', {}),
+    }
+    for part, field_src, write in SOLR_FIELD_PLAN:
+        data = parts[part]
+        if field_src is None or field_src in data:
             try:
-                solr_doc.update(COUCHDOC_ORIGINAL_RECORD_TO_SOLR_MAPPING[k](originalRecord))
-
+                write(data, solr_doc)
             except TypeError as e:
                 print(
-                    'TypeError for doc {} on originalRecord {}'.format(
-                        doc['_id'], k),
+                    'TypeError for doc {} on {} {}'.format(
+                        doc['_id'], part, field_src),
                     file=sys.stderr)
                 raise e
-        if k == 'properties':
-            for p in originalRecord['properties']:
-                if p in COUCHDOC_ORIGINAL_RECORD_TO_SOLR_MAPPING:
-                    try:
-                        solr_doc.update(COUCHDOC_ORIGINAL_RECORD_TO_SOLR_MAPPING[p](
-                            originalRecord))
-                    except TypeError as e:
-                        print(
-                            'TypeError for doc {} on originalRecord {}'.format(
-                                doc['_id'], p),
-                            file=sys.stderr)
-                        raise e
     normalize_type(solr_doc)
     add_sort_title(doc, solr_doc)
     add_facet_decade(doc, solr_doc)
@@ -745,6 +849,75 @@ def map_couch_to_solr_doc(doc):
     return solr_doc
 
 
+def map_couch_docs(couch_docs):
+    '''Map a chunk of couch docs to solr docs.
+    Returns the solr docs, a report of the docs left out, counted by the
+    dict_key of the error, the dejson counts for the chunk and the items it
+    added to DATE_CACHE. Runs in the processes of the mapping pool.
+    '''
+    solr_docs = []
+    report = defaultdict(int)
+    stats = dejson_stats()
+    for doc in couch_docs:
+        try:
+            fill_in_title(doc)
+            has_required_fields(doc)
+        except (KeyError, ValueError) as e:
+            report[e.dict_key] += 1
+            print(e.message, file=sys.stderr)
+            continue
+        try:
+            solr_docs.append(map_couch_to_solr_doc(doc))
+        except OldCollectionException as e:
+            report[e.dict_key] += 1
+            print('---- ERROR: OLD COLLECTION FOR:{}'.format(doc['_id']),
+                  file=sys.stderr)
+        except TypeError as e:
+            report['TypeError'] += 1
+            print('TypeError for {0} : {1}'.format(doc['_id'], e),
+                  file=sys.stderr)
+    return solr_docs, dict(report), dejson_counts_since(stats), \
+        DATE_CACHE.pop_new_items()
+
+
+def merge_date_items(result):
+    '''Add the DATE_CACHE items of a map_couch_docs result to the
+    DATE_CACHE of this process, return the rest of the result'''
+    solr_docs, report, dejson_counts, date_items = result
+    DATE_CACHE.update(date_items)
+    return solr_docs, report, dejson_counts
+
+
+def map_couch_docs_parallel(couch_docs, processes=None, chunk_size=200):
+    '''Generate the (solr docs, report, dejson counts) from map_couch_docs
+    for chunks of chunk_size couch docs, mapped by a pool of processes, by
+    default one per CPU. The chunks come back in order, up to 2 per process
+    are mapped ahead of the one returned. With processes=1 the docs are
+    mapped inline. The dates the processes cache are merged into DATE_CACHE,
+    so save_date_cache keeps them for the next run.
+    '''
+    couch_docs = iter(couch_docs)
+    chunks = iter(lambda: list(islice(couch_docs, chunk_size)), [])
+    if processes == 1:
+        for chunk in chunks:
+            yield merge_date_items(map_couch_docs(chunk))
+        return
+    pool = Pool(processes)
+    ahead = 2 * pool._processes
+    pending = deque()
+    try:
+        for chunk in chunks:
+            pending.append(pool.apply_async(map_couch_docs, (chunk, )))
+            if len(pending) > ahead:
+                yield merge_date_items(pending.popleft().get())
+        while pending:
+            yield merge_date_items(pending.popleft().get())
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
 def push_doc_to_solr(solr_doc, solr_db):
     '''Push one couch doc to solr'''
     n = 1
@@ -766,6 +939,107 @@ def push_doc_to_solr(solr_doc, solr_db):
     return n
 
 
+class SolrBulkIndexer(object):
+    '''Buffer solr docs & add them to solr in batches.
+    A batch is sent when it has batch_docs docs or batch_bytes of JSON.
+    With in_flight > 1 that many batches are sent at once, each thread
+    with its own connection to the solr at solr_db.url.
+    A batch rejected with a 400 is split in halves until the bad docs are
+    found, these are reported one by one as push_doc_to_solr does. Other
+    errors are raised from add or flush, the batches still in flight are
+    dropped and the threads stopped.
+    '''
+    def __init__(self, solr_db, batch_docs=500, batch_bytes=8 * 1024 * 1024,
+                 in_flight=4):
+        self.solr_db = solr_db
+        self.batch_docs = batch_docs
+        self.batch_bytes = batch_bytes
+        self.in_flight = in_flight
+        self.num_added = 0
+        self._batch = []
+        self._batch_size = 0
+        self._pending = []
+        self._pool = None
+        self._local = threading.local()
+
+    def _get_solr(self):
+        '''Return the connection for the thread'''
+        if self.in_flight <= 1:
+            return self.solr_db
+        if not hasattr(self._local, 'solr'):
+            self._local.solr = Solr(self.solr_db.url)
+        return self._local.solr
+
+    def _add_batch(self, solr_docs):
+        '''Add the docs, returns the number added'''
+        solr_db = self._get_solr()
+        if len(solr_docs) == 1:
+            return push_doc_to_solr(solr_docs[0], solr_db=solr_db)
+        try:
+            solr_db.add_many(solr_docs)
+        except SolrException as e:
+            if not e.httpcode == 400:
+                raise e
+            half = len(solr_docs) / 2
+            return self._add_batch(solr_docs[:half]) + \
+                self._add_batch(solr_docs[half:])
+        for solr_doc in solr_docs:
+            print(
+                "++++ ADDED: {} :harvest_id_s {}".format(
+                    solr_doc['id'], solr_doc['harvest_id_s']),
+                file=sys.stderr)
+        return len(solr_docs)
+
+    def _send(self):
+        '''Send the buffered docs, waiting for the oldest batch in flight
+        if in_flight batches are already going'''
+        batch = self._batch
+        self._batch = []
+        self._batch_size = 0
+        if self.in_flight <= 1:
+            self.num_added += self._add_batch(batch)
+            return
+        if not self._pool:
+            self._pool = ThreadPool(self.in_flight)
+        try:
+            while len(self._pending) >= self.in_flight:
+                self.num_added += self._pending.pop(0).get()
+        except Exception:
+            self.close()
+            raise
+        self._pending.append(self._pool.apply_async(self._add_batch,
+                                                    (batch, )))
+
+    def add(self, solr_doc):
+        '''Buffer the doc, sending the batch once it is full'''
+        self._batch.append(solr_doc)
+        if self.batch_bytes:
+            self._batch_size += len(json.dumps(solr_doc, default=str))
+        if len(self._batch) >= self.batch_docs or \
+                (self.batch_bytes and self._batch_size >= self.batch_bytes):
+            self._send()
+
+    def flush(self):
+        '''Send the buffered docs & wait for all batches, returns the
+        number of docs added so far'''
+        if self._batch:
+            self._send()
+        try:
+            while self._pending:
+                self.num_added += self._pending.pop(0).get()
+        finally:
+            self.close()
+        return self.num_added
+
+    def close(self):
+        '''Stop the threads, batches still in flight are dropped'''
+        self._pending = []
+        if self._pool:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+
 def get_key_for_env():
     '''Get key based on DATA_BRANCH env var'''
     if 'DATA_BRANCH' not in os.environ:
@@ -826,32 +1100,28 @@ def sync_couch_collection_to_solr(collection_key):
     v = CouchDBCollectionFilter(
         couchdb_obj=get_couchdb(), collection_key=collection_key)
     solr_db = Solr(URL_SOLR)
+    indexer = SolrBulkIndexer(solr_db)
+    load_date_cache()
     updated_docs = []
-    num_added = 0
     report = defaultdict(int)
-    for r in v:
-        try:
-            fill_in_title(r.doc)
-            has_required_fields(r.doc)
-        except KeyError as e:
-            report[e.dict_key] += 1
-            print(e.message, file=sys.stderr)
-            continue
-        except ValueError as e:
-            report[e.dict_key] += 1
-            print(e.message, file=sys.stderr)
-            continue
-        solr_doc = map_couch_to_solr_doc(r.doc)
-        # TODO: here is where to check if existing and compare collection vals
-        try:
-            check_nuxeo_media(solr_doc)
-        except ValueError as e:
-            print(e.message, file=sys.stderr)
-            report[e.dict_key] += 1
-            continue
-        updated_docs.append(solr_doc)
-        num_added += push_doc_to_solr(solr_doc, solr_db=solr_db)
+    for solr_docs, chunk_report, _ in map_couch_docs_parallel(
+            (r.doc for r in v), processes=MAP_PROCESSES):
+        for key, count in chunk_report.items():
+            report[key] += count
+        for solr_doc in solr_docs:
+            # TODO: here is where to check if existing and compare
+            # collection vals
+            try:
+                check_nuxeo_media(solr_doc)
+            except ValueError as e:
+                print(e.message, file=sys.stderr)
+                report[e.dict_key] += 1
+                continue
+            updated_docs.append(solr_doc)
+            indexer.add(solr_doc)
+    num_added = indexer.flush()
     solr_db.commit()
+    save_date_cache()
     publish_to_harvesting(
         'Synced collection {} to solr'.format(collection_key),
         harvesting_report(
@@ -866,17 +1136,20 @@ def main(url_couchdb=None,
          dbname=None,
          url_solr=None,
          all_docs=False,
-         since=None):
+         since=None,
+         map_processes=None):
     '''Use the _changes feed with a "since" parameter to only catch new
     changes to docs. The _changes feed will only have the *last* event on
     a document and does not retain intermediate changes.
     Setting the "since" to 0 will result in getting a _changes record for
     each document, essentially dumping the db to solr
+    The docs are mapped by map_processes processes, one per CPU by default.
     '''
     print('Solr update PID: {}'.format(os.getpid()))
     dt_start = datetime.datetime.now()
     print('Start time:{}'.format(dt_start))
     sys.stdout.flush()  # put pd
+    load_date_cache()
     db = get_couchdb(url=url_couchdb, dbname=dbname)
     s3_seq_cache = CouchdbLastSeq_S3()
     if not since:
@@ -894,54 +1167,48 @@ def main(url_couchdb=None,
     results = changes['results']
     n_up = n_design = n_delete = 0
     solr_db = Solr(url_solr)
+    indexer = SolrBulkIndexer(solr_db)
     start_time = datetime.datetime.now()
+    update_ids = []
+    dejson_counts = defaultdict(int)
     for row in results:
         cur_id = row['id']
         if '_design' in cur_id:
             n_design += 1
             print("Skip {0}".format(cur_id))
             continue
-        if row.get('deleted', False):
-            # need to get the solr doc for this couch
-            resp = solr_db.select(q=''.join(('harvest_id_s:"', cur_id, '"')))
-            if resp.numFound == 1:
-                sdoc = resp.results[0]
-                print('====DELETING: {0} -- {1}'.format(cur_id, sdoc['id']))
-                solr_db.delete(id=sdoc['id'])
-                n_delete += 1
-            else:
-                print("-----DELETION of {} - FOUND {} docs".format(
-                    cur_id, resp.numFound))
+        if not row.get('deleted', False):
+            update_ids.append(cur_id)
+            continue
+        # need to get the solr doc for this couch
+        resp = solr_db.select(q=''.join(('harvest_id_s:"', cur_id, '"')))
+        if resp.numFound == 1:
+            sdoc = resp.results[0]
+            print('====DELETING: {0} -- {1}'.format(cur_id, sdoc['id']))
+            solr_db.delete(id=sdoc['id'])
+            n_delete += 1
         else:
-            doc = db.get(cur_id)
+            print("-----DELETION of {} - FOUND {} docs".format(
+                cur_id, resp.numFound))
+        n_up += 1
+    # the docs changed are mapped by a pool of processes
+    for solr_docs, report, chunk_counts in map_couch_docs_parallel(
+            (db.get(cur_id) for cur_id in update_ids),
+            processes=map_processes):
+        for key, count in chunk_counts.items():
+            dejson_counts[key] += count
+        for solr_doc in solr_docs:
             try:
-                doc = fill_in_title(doc)
-                has_required_fields(doc)
-            except KeyError as e:
-                print(e.message)
-                continue
+                check_nuxeo_media(solr_doc)
             except ValueError as e:
                 print(e.message)
                 continue
-            try:
-                try:
-                    solr_doc = map_couch_to_solr_doc(doc)
-                except OldCollectionException:
-                    print('---- ERROR: OLD COLLECTION FOR:{}'.format(cur_id))
-                    continue
-                try:
-                    check_nuxeo_media(solr_doc)
-                except ValueError as e:
-                    print(e.message)
-                    continue
-                solr_doc = push_doc_to_solr(solr_doc, solr_db=solr_db)
-            except TypeError as e:
-                print('TypeError for {0} : {1}'.format(cur_id, e))
-                continue
-        n_up += 1
-        if n_up % 1000 == 0:
-            elapsed_time = datetime.datetime.now() - start_time
-            print("Updated {} so far in {}".format(n_up, elapsed_time))
+            indexer.add(solr_doc)
+            n_up += 1
+            if n_up % 1000 == 0:
+                elapsed_time = datetime.datetime.now() - start_time
+                print("Updated {} so far in {}".format(n_up, elapsed_time))
+    indexer.flush()
     solr_db.commit()
     if not all_docs:
         s3_seq_cache.last_seq = last_since
@@ -950,6 +1217,9 @@ def main(url_couchdb=None,
     print("LAST SINCE:{0}".format(last_since))
     run_time = datetime.datetime.now() - dt_start
     print("RUN TIME:{}".format(run_time))
+    print("DEJSON STATS:{}".format(dict(dejson_counts)))
+    print("DATE CACHE STATS:{}".format(DATE_CACHE.stats()))
+    save_date_cache()
 
 
 if __name__ == '__main__':
@@ -967,6 +1237,10 @@ if __name__ == '__main__':
         action='store_true',
         help=''.join(('Harvest all couchdb docs. Safest bet. ',
                       'Will not set last sequence in s3')))
+    parser.add_argument(
+        '--map_processes',
+        type=int,
+        help='Number of processes mapping couch docs. Defaults to the CPUs')
 
     args = parser.parse_args()
     print('Warning: this may take some time')
@@ -975,4 +1249,5 @@ if __name__ == '__main__':
         dbname=args.dbname,
         url_solr=args.url_solr,
         all_docs=args.all_docs,
-        since=args.since)
+        since=args.since,
+        map_processes=args.map_processes)
@@ -59,6 +59,14 @@ def def_args():
         type=str,
         default=None,
         help='The page range as a comma separated pair of numbers')
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help='Resume from the last checkpoint saved for the collection')
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help='Only ingest records new or changed since the last harvest')
     return parser
 
 
@@ -73,7 +81,9 @@ def main(
         job_timeout=86400,  # 24 hrs
         rq_queue=None,
         run_image_harvest=False,
-        page_range=None):
+        page_range=None,
+        resume=False,
+        incremental=False):
     timeout_dt = datetime.timedelta(seconds=timeout) if timeout else \
         datetime.timedelta(seconds=TIMEOUT)
     start_time = datetime.datetime.now()
@@ -97,7 +107,9 @@ def main(
             kwargs={
                 'run_image_harvest': run_image_harvest,
                 'rq_queue': rq_queue,
-                'page_range': page_range
+                'page_range': page_range,
+                'resume': resume,
+                'incremental': incremental
             },
             timeout=job_timeout, )
         results.append(result)
@@ -120,4 +132,6 @@ if __name__ == '__main__':
         rq_queue=args.rq_queue,
         job_timeout=args.job_timeout,
         run_image_harvest=args.run_image_harvest,
-        page_range=args.page_range)
+        page_range=args.page_range,
+        resume=args.resume,
+        incremental=args.incremental)
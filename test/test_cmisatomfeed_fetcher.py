@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 from unittest import TestCase
+from xml.etree import ElementTree as ET
+from xmljson import badgerfish
 from mypretty import httpretty
 # import httpretty
 import harvester.fetcher as fetcher
@@ -35,6 +37,73 @@ class CMISAtomFeedFetcherTestCase(LogOverrideMixin, TestCase):
         self.assertEqual(num_fetched, 42)
 
 
+class CMISAtomFeedFetcherPagedTestCase(LogOverrideMixin, TestCase):
+    '''Test the paged, streaming harvest of a CMIS feed'''
+    def setUp(self):
+        super(CMISAtomFeedFetcherPagedTestCase, self).setUp()
+        feed = open(DIR_FIXTURES+'/cmis-atom-descendants.xml').read()
+        self.expected = [
+            badgerfish.data(x)
+            for x in ET.fromstring(feed).findall(
+                './{http://www.w3.org/2005/Atom}entry/'
+                '{http://docs.oasis-open.org/ns/cmis/restatom/200908/}'
+                'children//{http://www.w3.org/2005/Atom}entry')]
+        link_next = '<atom:link rel="next" href="{}"/>\n  <atom:entry>'
+        self.page_1 = feed.replace(
+            '<atom:entry>', link_next.format(
+                'http://cmis-atom-endpoint/descendants'
+                '?maxItems=1&amp;skipCount=1'), 1)
+        self.page_2 = feed
+
+    @httpretty.activate
+    def testPaged(self):
+        '''The next link is followed & the entries are the same as for the
+        whole feed'''
+        httpretty.register_uri(
+            httpretty.GET,
+            'http://cmis-atom-endpoint/descendants',
+            responses=[
+                httpretty.Response(body=self.page_1),
+                httpretty.Response(body=self.page_2),
+            ])
+        h = fetcher.CMISAtomFeedFetcher(
+                'http://cmis-atom-endpoint/descendants',
+                'uname, pswd, 1')
+        self.assertEqual(h.url_page, 'http://cmis-atom-endpoint/descendants'
+                         '?maxItems=1&skipCount=0')
+        self.assertEqual(len(httpretty.core.httpretty.latest_requests), 0)
+        objs = list(h)
+        self.assertEqual(objs, self.expected * 2)
+        requests = httpretty.core.httpretty.latest_requests
+        self.assertEqual(len(requests), 2)
+        self.assertEqual(requests[1].querystring,
+                         {'maxItems': ['1'], 'skipCount': ['1']})
+
+    @httpretty.activate
+    def testResume(self):
+        '''A paged harvest carries on from the page & offset'''
+        httpretty.register_uri(
+            httpretty.GET,
+            'http://cmis-atom-endpoint/descendants',
+            responses=[
+                httpretty.Response(body=self.page_1),
+                httpretty.Response(body=self.page_1),
+                httpretty.Response(body=self.page_2),
+            ])
+        h = fetcher.CMISAtomFeedFetcher(
+                'http://cmis-atom-endpoint/descendants',
+                'uname, pswd, 1')
+        objs = [h.next(), h.next()]
+        checkpoint = h.get_checkpoint()
+        self.assertEqual(checkpoint['page_offset'], 2)
+        h = fetcher.CMISAtomFeedFetcher(
+                'http://cmis-atom-endpoint/descendants',
+                'uname, pswd, 1')
+        h.resume(checkpoint)
+        objs.extend(h)
+        self.assertEqual(objs, self.expected * 2)
+
+
 # Copyright © 2016, Regents of the University of California
 # All rights reserved.
 # Redistribution and use in source and binary forms, with or without
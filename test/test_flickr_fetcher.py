@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function
+import time
+import urlparse
+from urlparse import parse_qs
 from unittest import TestCase
+from mock import patch
 import harvester.fetcher as fetcher
 from test.utils import DIR_FIXTURES
 from test.utils import LogOverrideMixin
@@ -490,6 +494,34 @@ class FlickrFetcherTestCase(LogOverrideMixin, TestCase):
         for k, v in key_list_values.items():
             self.assertEqual(photo_obj[k], v)
 
+    def test_photo_info_concurrent(self):
+        '''getInfo calls for a page are made concurrently, the photos stay
+        in page order'''
+        pages = dict((str(i), open(
+            DIR_FIXTURES + '/flickr-public-photos-{}.xml'.format(i)).read())
+            for i in range(1, 5))
+        info = open(DIR_FIXTURES + '/flickr-photo-info-0.xml').read()
+
+        def api_get(url):
+            query = parse_qs(urlparse.urlsplit(url).query)
+            if query['method'][0] == 'flickr.photos.getInfo':
+                photo_id = query['photo_id'][0]
+                # answer the first photos of a page last
+                time.sleep(0.01 * (3 - int(photo_id) % 3))
+                return info.replace(
+                    'photo id="34394586825"', 'photo id="{}"'.format(photo_id))
+            return pages[query['page'][0]]
+
+        with patch.object(fetcher.Flickr_Fetcher, 'api_get',
+                          side_effect=api_get):
+            h = fetcher.Flickr_Fetcher('https://example.edu', 'testuser',
+                                       page_size=3, info_concurrency=3)
+            self.assertEqual(h.info_concurrency, 3)
+            ids = [obj['id'] for objset in h for obj in objset]
+        self.assertEqual(ids, ['1', '2', '3', '34394586825', '34264179471',
+                               '33552707114', '33584631403', '34394583185',
+                               '33552702654', '34264171481'])
+
 # Copyright © 2017, Regents of the University of California
 # All rights reserved.
 # Redistribution and use in source and binary forms, with or without
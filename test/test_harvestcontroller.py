@@ -4,10 +4,16 @@ from unittest import skip
 import shutil
 import re
 import json
+import gzip
+import hashlib
 import datetime
+import time
+import StringIO
 from mypretty import httpretty
 # import httpretty
 from mock import patch
+from mock import MagicMock
+from botocore.exceptions import ClientError
 from test.utils import ConfigFileOverrideMixin, LogOverrideMixin
 from test.utils import DIR_FIXTURES, TEST_COUCH_DASHBOARD, TEST_COUCH_DB
 import harvester.fetcher as fetcher
@@ -121,6 +127,14 @@ class HarvestControllerTestCase(ConfigFileOverrideMixin, LogOverrideMixin,
                 Body='{"xxxx": "yyyy"}\n',
             Key='data-fetched/197/2017-07-14-1201/page-0.jsonl')
 
+    @patch('boto3.resource', autospec=True)
+    def testSaveToS3Compressed(self, mock_boto3):
+        self.controller_oai.s3_compress = True
+        self.controller_oai.save_objset_s3([{"xxxx": "yyyy"}])
+        kwargs = mock_boto3().Bucket().put_object.call_args[1]
+        self.assertTrue(kwargs['Key'].endswith('/page-0.jsonl.gz'))
+        self.assertEqual(kwargs['ContentEncoding'], 'gzip')
+
     def testOAIFetcherType(self):
         '''Check the correct object returned for type of harvest'''
         self.assertIsInstance(self.controller_oai.fetcher, fetcher.OAIFetcher)
@@ -285,6 +299,20 @@ class HarvestControllerTestCase(ConfigFileOverrideMixin, LogOverrideMixin,
         self.assertEqual(obj['collection'][0]['repository'][0]['@id'],
                          'https://registry.cdlib.org/api/v1/repository/37/')
 
+    def testRegistryBlockSplicedJSON(self):
+        '''The registry block is built once and its cached JSON is spliced
+        into the JSON for each object'''
+        obj1 = self.controller_oai._add_registry_data({'id': 'one'})
+        obj2 = self.controller_oai._add_registry_data(
+            {'id': 'two', 'collection': 'source name'})
+        self.assertIs(obj1['collection'], obj2['collection'])
+        self.assertEqual(obj2['source_collection_name'], 'source name')
+        for obj in (obj1, obj2, {'collection': obj1['collection']}):
+            self.assertEqual(
+                json.loads(self.controller_oai.dumps(obj)),
+                json.loads(json.dumps(obj)))
+        self.assertEqual(self.controller_oai.dumps({'x': 'y'}), '{"x": "y"}')
+
     @patch('boto3.resource', autospec=True)
     def testObjectsHaveRegistryData(self, mock_boto3):
         '''Test that the registry data is being attached to objects from
@@ -327,7 +355,398 @@ class HarvestControllerTestCase(ConfigFileOverrideMixin, LogOverrideMixin,
         }])
 
     @httpretty.activate
-    def testFailsIfNoRecords(self):
+    @patch('boto3.resource', autospec=True)
+    def testHarvestPipelined(self, mock_boto3):
+        '''Test that the pipelined harvest writes every objset with page
+        numbers in fetch order'''
+        httpretty.register_uri(
+            httpretty.GET,
+            re.compile("http://content.cdlib.org/oai?.*"),
+            body=open(DIR_FIXTURES + '/testOAI-128-records.xml').read())
+        # mock call counts are not thread safe, list.append is
+        keys = []
+        mock_boto3().Bucket().put_object.side_effect = \
+            lambda **kwargs: keys.append(kwargs['Key'])
+        controller = fetcher.HarvestController(
+            'email@example.com',
+            self.collection,
+            config_file=self.config_file,
+            profile_path=self.profile_path,
+            pipeline_workers=3,
+            pipeline_queue_size=2)
+        self.assertEqual(controller.harvest(), 128)
+        self.assertEqual(len(os.listdir(controller.dir_save)), 128)
+        keys = [key for key in keys if '/page-' in key]
+        self.assertEqual(len(keys), 128)
+        self.assertEqual(set(keys), set(
+            'data-fetched/197/2017-07-14-1201/page-{}.jsonl'.format(n)
+            for n in range(128)))
+        shutil.rmtree(controller.dir_save)
+
+    @httpretty.activate
+    @patch('boto3.resource', autospec=True)
+    def testHarvestPipelinedWriterError(self, mock_boto3):
+        '''Test that an error in a writer thread stops the harvest'''
+        httpretty.register_uri(
+            httpretty.GET,
+            re.compile("http://content.cdlib.org/oai?.*"),
+            body=open(DIR_FIXTURES + '/testOAI-128-records.xml').read())
+        mock_boto3().Bucket().put_object.side_effect = ValueError('Boom!')
+        controller = fetcher.HarvestController(
+            'email@example.com',
+            self.collection,
+            config_file=self.config_file,
+            profile_path=self.profile_path,
+            pipeline_workers=2)
+        self.assertRaises(ValueError, controller.harvest)
+        shutil.rmtree(controller.dir_save)
+
+    @httpretty.activate
+    @patch('boto3.resource', autospec=True)
+    def testHarvestCoalescesPages(self, mock_boto3):
+        '''Test that single record objsets are saved in pages'''
+        httpretty.register_uri(
+            httpretty.GET,
+            re.compile("http://content.cdlib.org/oai?.*"),
+            body=open(DIR_FIXTURES + '/testOAI-128-records.xml').read())
+        controller = fetcher.HarvestController(
+            'email@example.com',
+            self.collection,
+            config_file=self.config_file,
+            profile_path=self.profile_path,
+            page_records=50)
+        self.assertEqual(controller.harvest(), 128)
+        pages = [json.load(open(os.path.join(controller.dir_save, f)))
+                 for f in os.listdir(controller.dir_save)]
+        self.assertEqual(sorted(len(p) for p in pages), [28, 50, 50])
+        put_object = mock_boto3().Bucket().put_object
+        page_calls = [c for c in put_object.call_args_list
+                      if '/page-' in c[1]['Key']]
+        self.assertEqual(len(page_calls), 3)
+        body = page_calls[-1][1]['Body']
+        self.assertEqual(len(body.splitlines()), 28)
+        self.assertTrue(page_calls[-1][1]['Key'].endswith('/page-2.jsonl'))
+        shutil.rmtree(controller.dir_save)
+
+    def testPagesByBytes(self):
+        '''Test page flushing by size of the JSON'''
+        self.controller_oai.fetcher = iter(
+            [{'n': n, 'text': 'x' * 90} for n in range(10)])
+        obj_size = len(HarvestController.jsonl(
+            self.controller_oai._add_registry_data(
+                {'n': 0, 'text': 'x' * 90})))
+        self.controller_oai.page_bytes = 3 * obj_size
+        with patch.object(self.controller_oai, 'dumps',
+                          wraps=self.controller_oai.dumps) as mock_dumps:
+            pages = list(self.controller_oai._pages())
+            self.assertEqual([len(p) for p in pages], [3, 3, 3, 1])
+            self.assertEqual(self.controller_oai.num_records, 10)
+            # the JSON is reused to save the page to disk & S3
+            self.controller_oai.save_objset(pages[0])
+            self.controller_oai.save_objset_s3(pages[0], s3=MagicMock())
+        self.assertEqual(mock_dumps.call_count, 10)
+        saved = [json.load(open(os.path.join(self.controller_oai.dir_save,
+                                             f)))
+                 for f in os.listdir(self.controller_oai.dir_save)]
+        self.assertEqual([obj['n'] for obj in saved[0]], [0, 1, 2])
+
+    @httpretty.activate
+    @patch('boto3.resource', autospec=True)
+    def testHarvestClosesFetcher(self, mock_boto3):
+        '''The fetcher is closed when the harvest fails'''
+        httpretty.register_uri(
+            httpretty.GET,
+            re.compile("http://content.cdlib.org/oai?.*"),
+            body=open(DIR_FIXTURES + '/testOAI-128-records.xml').read())
+        controller = fetcher.HarvestController(
+            'email@example.com',
+            self.collection,
+            config_file=self.config_file,
+            profile_path=self.profile_path)
+        with patch.object(type(controller.fetcher), 'next',
+                          side_effect=ValueError('bad page')), \
+                patch.object(controller.fetcher, 'close') as mock_close:
+            self.assertRaises(ValueError, controller.harvest)
+        self.assertEqual(mock_close.call_count, 1)
+        shutil.rmtree(controller.dir_save)
+
+    @httpretty.activate
+    @patch('boto3.resource', autospec=True)
+    def testHarvestSavesCheckpoint(self, mock_boto3):
+        '''Test that the fetch position is saved with the pages'''
+        httpretty.register_uri(
+            httpretty.GET,
+            re.compile("http://content.cdlib.org/oai?.*"),
+            body=open(DIR_FIXTURES + '/testOAI-128-records.xml').read())
+        controller = fetcher.HarvestController(
+            'email@example.com',
+            self.collection,
+            config_file=self.config_file,
+            profile_path=self.profile_path,
+            page_records=50,
+            checkpoint_interval=0)
+        controller.harvest()
+        checkpoints = [
+            json.loads(c[1]['Body'])
+            for c in mock_boto3().Bucket().put_object.call_args_list
+            if c[1]['Key'] == 'data-fetched/197/checkpoint.json'
+        ]
+        self.assertEqual([c['page'] for c in checkpoints], [0, 1, 2])
+        self.assertEqual(checkpoints[-1], {
+            'harvest_type': 'OAI',
+            'url_harvest': self.collection.url_harvest,
+            'datetime_start': '2017-07-14-1201',
+            'harvested_at': controller.harvested_at.strftime(
+                '%Y-%m-%dT%H:%M:%SZ'),
+            'page': 2,
+            'num_records': 128,
+            'cursor': {'resumptionToken': None, 'offset': 128}
+        })
+        self.assertEqual(controller.checkpoint, checkpoints[-1])
+        # the new harvest & the completed harvest remove the checkpoint
+        self.assertEqual(
+            [c[0][0] for c in mock_boto3().Bucket().Object.call_args_list
+             ].count('data-fetched/197/checkpoint.json'), 2)
+        shutil.rmtree(controller.dir_save)
+
+    @httpretty.activate
+    @patch('boto3.resource', autospec=True)
+    def testHarvestResume(self, mock_boto3):
+        '''Test that a harvest picks up from the saved checkpoint'''
+        httpretty.register_uri(
+            httpretty.GET,
+            re.compile("http://content.cdlib.org/oai?.*"),
+            body=open(DIR_FIXTURES + '/testOAI-128-records.xml').read())
+        s3_objects = {
+            'data-fetched/197/checkpoint.json': json.dumps({
+                'harvest_type': 'OAI',
+                'url_harvest': self.collection.url_harvest,
+                'datetime_start': '2017-07-10-0900',
+                'page': 0,
+                'num_records': 50,
+                'cursor': {'resumptionToken': None, 'offset': 50}
+            }),
+            'data-fetched/197/last-harvest.json': json.dumps({
+                'datetime_start': '2017-07-01-0900'}),
+        }
+
+        def get_object(key):
+            s3_object = MagicMock()
+            s3_object.get.return_value = {
+                'Body': StringIO.StringIO(s3_objects.get(key))}
+            return s3_object
+
+        bucket = mock_boto3().Bucket()
+        bucket.Object.side_effect = get_object
+        saved_page = MagicMock()
+        saved_page.key = 'data-fetched/197/2017-07-10-0900/page-0.jsonl'
+        saved_page.get.return_value = {
+            'Body': StringIO.StringIO('{"id": "a"}\n{"id": "b"}\n')}
+        bucket.objects.filter.return_value = [saved_page]
+        controller = fetcher.HarvestController(
+            'email@example.com',
+            self.collection,
+            config_file=self.config_file,
+            profile_path=self.profile_path,
+            page_records=50,
+            resume=True)
+        self.assertEqual(controller.harvest(), 128)
+        bucket.objects.filter.assert_called_with(
+            Prefix='data-fetched/197/2017-07-10-0900/')
+        pages = [json.load(open(os.path.join(controller.dir_save, f)))
+                 for f in os.listdir(controller.dir_save)]
+        self.assertEqual(sorted(len(p) for p in pages), [2, 28, 50])
+        self.assertIn([{'id': 'a'}, {'id': 'b'}], pages)
+        self.assertEqual(
+            [c[1]['Key'] for c in bucket.put_object.call_args_list
+             if '/page-' in c[1]['Key']],
+            ['data-fetched/197/2017-07-10-0900/page-1.jsonl',
+             'data-fetched/197/2017-07-10-0900/page-2.jsonl'])
+        last_harvest = [c[1]['Body'] for c in bucket.put_object.call_args_list
+                        if c[1]['Key'].endswith('last-harvest.json')][0]
+        self.assertEqual(json.loads(last_harvest)['datetime_start'],
+                         '2017-07-10-0900')
+        shutil.rmtree(controller.dir_save)
+        # the checkpoint of a completed harvest isn't resumed
+        s3_objects['data-fetched/197/last-harvest.json'] = last_harvest
+        bucket.put_object.reset_mock()
+        controller = fetcher.HarvestController(
+            'email@example.com',
+            self.collection,
+            config_file=self.config_file,
+            profile_path=self.profile_path,
+            page_records=50,
+            resume=True)
+        self.assertEqual(controller.harvest(), 128)
+        self.assertEqual(len(os.listdir(controller.dir_save)), 3)
+        self.assertEqual(
+            [c[1]['Key'] for c in bucket.put_object.call_args_list
+             if '/page-' in c[1]['Key']][0],
+            'data-fetched/197/2017-07-14-1201/page-0.jsonl')
+        shutil.rmtree(controller.dir_save)
+
+    @httpretty.activate
+    @patch('boto3.resource', autospec=True)
+    def testHarvestResumeIncremental(self, mock_boto3):
+        '''Test that a resumed incremental harvest counts & digests the
+        records saved before the checkpoint'''
+        httpretty.register_uri(
+            httpretty.GET,
+            re.compile("http://content.cdlib.org/oai?.*"),
+            body=open(DIR_FIXTURES + '/testOAI-128-records.xml').read())
+        s3_objects = {
+            'data-fetched/197/checkpoint.json': json.dumps({
+                'harvest_type': 'OAI',
+                'url_harvest': self.collection.url_harvest,
+                'datetime_start': '2017-07-10-0900',
+                'page': 0,
+                'num_records': 50,
+                'cursor': {'resumptionToken': None, 'offset': 50}
+            }),
+        }
+
+        def put_object(**kwargs):
+            s3_objects[kwargs['Key']] = kwargs['Body']
+
+        def get_object(key):
+            s3_object = MagicMock()
+            if key not in s3_objects:
+                s3_object.get.side_effect = ClientError(
+                    {'Error': {'Code': 'NoSuchKey', 'Message': ''}},
+                    'GetObject')
+            else:
+                s3_object.get.return_value = {
+                    'Body': StringIO.StringIO(s3_objects[key])}
+            return s3_object
+
+        bucket = mock_boto3().Bucket()
+        bucket.put_object.side_effect = put_object
+        bucket.Object.side_effect = get_object
+        saved_page = MagicMock()
+        saved_page.key = 'data-fetched/197/2017-07-10-0900/page-0.jsonl'
+        saved_page.get.return_value = {'Body': StringIO.StringIO(
+            '{"id": "a", "harvest_delta": "changed", "collection": {}}\n'
+            '{"id": "b", "harvest_delta": "unchanged", "collection": {}, '
+            '"source_collection_name": "b-set"}\n')}
+        bucket.objects.filter.return_value = [saved_page]
+        controller = fetcher.HarvestController(
+            'email@example.com',
+            self.collection,
+            config_file=self.config_file,
+            profile_path=self.profile_path,
+            page_records=50,
+            resume=True,
+            incremental=True)
+        self.assertEqual(controller.harvest(), 128)
+        self.assertEqual(controller.num_records_changed, 79)
+        pages = [json.load(open(os.path.join(controller.dir_save, f)))
+                 for f in os.listdir(controller.dir_save)]
+        self.assertEqual(sorted(len(p) for p in pages), [1, 28, 50])
+        digests = gzip.GzipFile(fileobj=StringIO.StringIO(
+            s3_objects['data-fetched/197/digests.txt.gz'])).read()
+        lines = digests.splitlines()
+        self.assertEqual(len(lines), 80)
+        self.assertIn('\t'.join((
+            'b', hashlib.md5('{"collection": "b-set", "id": "b"}').hexdigest()
+        )), lines)
+        self.assertIn('\t'.join((
+            'a', hashlib.md5('{"id": "a"}').hexdigest())), lines)
+        shutil.rmtree(controller.dir_save)
+
+    @httpretty.activate
+    @patch('boto3.resource', autospec=True)
+    def testHarvestIncremental(self, mock_boto3):
+        '''Test that an incremental harvest asks for records since the last
+        harvest and only saves the changed ones to disk'''
+        httpretty.register_uri(
+            httpretty.GET,
+            re.compile("http://content.cdlib.org/oai?.*"),
+            body=open(DIR_FIXTURES + '/testOAI-128-records.xml').read())
+        s3_objects = {}
+
+        def put_object(**kwargs):
+            s3_objects[kwargs['Key']] = kwargs['Body']
+
+        def get_object(key):
+            s3_object = MagicMock()
+            if key not in s3_objects:
+                s3_object.get.side_effect = ClientError(
+                    {'Error': {'Code': 'NoSuchKey', 'Message': ''}},
+                    'GetObject')
+            else:
+                s3_object.get.return_value = {
+                    'Body': StringIO.StringIO(s3_objects[key])}
+            return s3_object
+
+        bucket = mock_boto3().Bucket()
+        bucket.put_object.side_effect = put_object
+        bucket.Object.side_effect = get_object
+        controller = fetcher.HarvestController(
+            'email@example.com',
+            self.collection,
+            config_file=self.config_file,
+            profile_path=self.profile_path,
+            page_records=50,
+            incremental=True)
+        self.assertIsNone(controller.since)
+        self.assertEqual(controller.harvest(), 128)
+        self.assertEqual(controller.num_records_changed, 128)
+        self.assertEqual(len(os.listdir(controller.dir_save)), 3)
+        last_harvest = json.loads(
+            s3_objects['data-fetched/197/last-harvest.json'])
+        self.assertEqual(last_harvest['num_records_changed'], 128)
+        self.assertTrue(last_harvest['incremental'])
+        self.assertIn('data-fetched/197/digests.txt.gz', s3_objects)
+        shutil.rmtree(controller.dir_save)
+        controller = fetcher.HarvestController(
+            'email@example.com',
+            self.collection,
+            config_file=self.config_file,
+            profile_path=self.profile_path,
+            page_records=50,
+            incremental=True)
+        self.assertEqual(controller.since.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                         last_harvest['harvested_at'])
+        self.assertEqual(httpretty.last_request().querystring['from'],
+                         [controller.since.strftime('%Y-%m-%d')])
+        self.assertEqual(controller.harvest(), 128)
+        self.assertEqual(controller.num_records_changed, 0)
+        self.assertEqual(os.listdir(controller.dir_save), [])
+        page = s3_objects['data-fetched/197/2017-07-14-1201/page-0.jsonl']
+        self.assertEqual(
+            json.loads(page.splitlines()[0])['harvest_delta'], 'unchanged')
+        shutil.rmtree(controller.dir_save)
+        # digests are replaced by record id, a record that goes back to an
+        # earlier version is changed
+        digests = s3_objects['data-fetched/197/digests.txt.gz']
+        lines = gzip.GzipFile(
+            fileobj=StringIO.StringIO(digests)).read().splitlines()
+        self.assertEqual(len(lines), 128)
+        record_id, digest = lines[0].split('\t')
+        lines[0] = '\t'.join((record_id, 'earlier-version'))
+        body = StringIO.StringIO()
+        with gzip.GzipFile(fileobj=body, mode='wb') as gzfoo:
+            gzfoo.write('\n'.join(lines))
+        s3_objects['data-fetched/197/digests.txt.gz'] = body.getvalue()
+        controller = fetcher.HarvestController(
+            'email@example.com',
+            self.collection,
+            config_file=self.config_file,
+            profile_path=self.profile_path,
+            page_records=50,
+            incremental=True)
+        self.assertEqual(controller.harvest(), 128)
+        self.assertEqual(controller.num_records_changed, 1)
+        digests = s3_objects['data-fetched/197/digests.txt.gz']
+        lines = gzip.GzipFile(
+            fileobj=StringIO.StringIO(digests)).read().splitlines()
+        self.assertEqual(len(lines), 128)
+        self.assertIn('\t'.join((record_id, digest)), lines)
+        shutil.rmtree(controller.dir_save)
+
+    @httpretty.activate
+    @patch('boto3.resource', autospec=True)
+    def testFailsIfNoRecords(self, mock_boto3):
         '''Test that the Controller throws an error if no records come back
         from fetcher
         '''
@@ -356,3 +775,71 @@ class FetcherClassTestCase(TestCase):
     def testClassExists(self):
         h = fetcher.Fetcher
         h = h('url_harvest', 'extra_data')
+
+    def testNoCheckpoint(self):
+        '''Fetchers can't resume unless they say how'''
+        h = fetcher.Fetcher('url_harvest', 'extra_data')
+        self.assertIsNone(h.get_checkpoint())
+        self.assertRaises(NotImplementedError, h.resume, {})
+
+    def testRecordId(self):
+        '''The record id is the first string id key of the record'''
+        h = fetcher.Fetcher('url_harvest', 'extra_data')
+        self.assertEqual(h.record_id({'_id': 'b', 'uid': 'c'}), 'b')
+        self.assertEqual(h.record_id({'id': 5, 'uid': 'c'}), 'c')
+        self.assertIsNone(h.record_id({'title': 'a'}))
+
+
+class PagedFetcherTestCase(TestCase):
+    '''Test the base class for page numbered sources'''
+
+    class NumberedFetcher(fetcher.PagedFetcher):
+        page_last = 10
+
+        def fetch_page(self, page):
+            # later pages in a window finish first
+            time.sleep(0.01 * (self.concurrency - page % self.concurrency))
+            if page == 7 and self.extra_data == 'fail':
+                raise ValueError('Boom!')
+            if page > 5 and self.extra_data == 'unknown':
+                return []
+            return [{'page': page}]
+
+    def testPagesInOrder(self):
+        '''Test that concurrently fetched pages come back in order'''
+        h = self.NumberedFetcher('url_harvest', None, concurrency=4)
+        self.assertEqual([objset[0]['page'] for objset in h], range(1, 11))
+        self.assertEqual(h.get_checkpoint(), {'page_current': 11})
+
+    def testUnknownPageTotal(self):
+        '''Test that the fetch stops at the first empty page'''
+        h = self.NumberedFetcher('url_harvest', 'unknown', concurrency=3)
+        h.page_last = None
+        self.assertEqual([objset[0]['page'] for objset in h], range(1, 6))
+
+    def testPageError(self):
+        '''Test that an error fetching a page is raised in order'''
+        h = self.NumberedFetcher('url_harvest', 'fail', concurrency=4)
+        pages = []
+        with self.assertRaises(ValueError):
+            for objset in h:
+                pages.append(objset[0]['page'])
+        self.assertEqual(pages, range(1, 7))
+
+    def testResume(self):
+        '''Test resuming from a page'''
+        h = self.NumberedFetcher('url_harvest', None, concurrency=2)
+        h.resume({'page_current': 8})
+        self.assertEqual([objset[0]['page'] for objset in h], [8, 9, 10])
+
+    def testConcurrencyFromExtraData(self):
+        '''Test that the concurrency can be set in the extra_data'''
+        h = self.NumberedFetcher('url_harvest', 'q=foo&concurrency=3')
+        self.assertEqual(h.concurrency, 3)
+        self.assertEqual(h.extra_data, 'q=foo')
+        h = self.NumberedFetcher('url_harvest', 'concurrency=3',
+                                 concurrency=5)
+        self.assertEqual(h.concurrency, 5)
+        self.assertEqual(h.extra_data, '')
+        h = self.NumberedFetcher('url_harvest', None)
+        self.assertEqual(h.concurrency, 1)
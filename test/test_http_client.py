@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+import os
+from StringIO import StringIO
+from unittest import TestCase
+from mock import patch, Mock
+import requests
+from test.utils import LogOverrideMixin, DIR_FIXTURES
+from harvester.fetcher import http_client
+from mypretty import httpretty
+
+
+class HTTPClientTestCase(LogOverrideMixin, TestCase):
+    '''Test the HTTP client shared by the fetchers'''
+    def testSessionShared(self):
+        '''One session is used for every request'''
+        session = http_client.get_session()
+        self.assertIsInstance(session, requests.Session)
+        self.assertIs(http_client.get_session(), session)
+
+    @patch('time.sleep')
+    @httpretty.activate
+    def testRetryStatus(self, mock_sleep):
+        '''A 503 is retried, waiting for the Retry-After'''
+        httpretty.register_uri(
+            httpretty.GET,
+            'http://example.edu/feed',
+            responses=[
+                httpretty.Response(body='busy', status=503,
+                                   adding_headers={'Retry-After': '7'}),
+                httpretty.Response(body='busy', status=500),
+                httpretty.Response(body='the feed', status=200),
+            ])
+        self.assertEqual(http_client.get_content('http://example.edu/feed'),
+                         'the feed')
+        self.assertEqual(mock_sleep.call_count, 2)
+        self.assertEqual(mock_sleep.call_args_list[0][0][0], 7.0)
+        self.assertLessEqual(mock_sleep.call_args_list[1][0][0],
+                             http_client.BACKOFF * 2)
+
+    @patch('time.sleep')
+    @httpretty.activate
+    def testRetriesUsedUp(self, mock_sleep):
+        '''The last response is returned once the retries are used up and
+        get_content raises for it'''
+        httpretty.register_uri(
+            httpretty.GET,
+            'http://example.edu/feed',
+            body='down', status=502)
+        resp = http_client.get('http://example.edu/feed', retries=2)
+        self.assertEqual(resp.status_code, 502)
+        self.assertEqual(mock_sleep.call_count, 2)
+        self.assertRaises(requests.exceptions.HTTPError,
+                          http_client.get_content, 'http://example.edu/feed',
+                          retries=0)
+        self.assertEqual(mock_sleep.call_count, 2)
+
+    @patch('time.sleep')
+    def testRetryConnectionError(self, mock_sleep):
+        '''Connection errors are retried then raised'''
+        with patch.object(http_client.get_session(), 'request',
+                          side_effect=requests.exceptions.ConnectionError(
+                              'refused')) as mock_request:
+            self.assertRaises(requests.exceptions.ConnectionError,
+                              http_client.get, 'http://example.edu/feed',
+                              retries=3)
+        self.assertEqual(mock_request.call_count, 4)
+        self.assertEqual(mock_sleep.call_count, 3)
+
+    def testBackoff(self):
+        '''Backoff is capped and a bad Retry-After is ignored'''
+        for attempt in range(20):
+            self.assertLessEqual(http_client.backoff(attempt),
+                                 http_client.BACKOFF_MAX)
+        resp = requests.Response()
+        resp.headers['Retry-After'] = 'Wed, 21 Oct 2015 07:28:00 GMT'
+        self.assertLessEqual(http_client.backoff(0, resp),
+                             http_client.BACKOFF)
+
+    @patch('time.sleep')
+    @patch('time.time')
+    def testTokenBucket(self, mock_time, mock_sleep):
+        '''The bucket allows a burst, then waits for tokens to be added'''
+        clock = [1000.0]
+        mock_time.side_effect = lambda: clock[0]
+
+        def sleep(seconds):
+            clock[0] += seconds
+        mock_sleep.side_effect = sleep
+        bucket = http_client.TokenBucket(2, capacity=3)
+        for i in range(3):
+            bucket.take()
+        self.assertEqual(mock_sleep.call_count, 0)
+        bucket.take()
+        self.assertEqual(mock_sleep.call_count, 1)
+        self.assertAlmostEqual(mock_sleep.call_args[0][0], 0.5)
+        clock[0] += 10
+        for i in range(3):
+            bucket.take()
+        self.assertEqual(mock_sleep.call_count, 1)
+        bucket.take(2)
+        self.assertAlmostEqual(mock_sleep.call_args[0][0], 1.0)
+        self.assertEqual(clock[0], 1011.5)
+
+    @httpretty.activate
+    def testDownload(self):
+        '''download writes the body to a file in chunks'''
+        body = 'x' * 2500
+        httpretty.register_uri(
+            httpretty.GET,
+            'http://example.edu/export.xml',
+            body=body)
+        out = StringIO()
+        out.write('head')
+        self.assertEqual(http_client.download('http://example.edu/export.xml',
+                                              out, chunk_size=1000), 2500)
+        self.assertEqual(out.getvalue(), 'head' + body)
+        path = os.path.join(DIR_FIXTURES, 'marc-test')
+        out = StringIO()
+        http_client.download('file:' + path, out)
+        self.assertEqual(out.getvalue(), open(path).read())
+
+    @patch('time.sleep')
+    def testDownloadResume(self, mock_sleep):
+        '''A broken download carries on with a Range request, or starts
+        over if the server ignores the Range'''
+        def response(status, chunks):
+            def iter_content(chunk_size):
+                for chunk in chunks:
+                    if isinstance(chunk, Exception):
+                        raise chunk
+                    yield chunk
+            resp = requests.Response()
+            resp.status_code = status
+            resp.raw = Mock()
+            resp.iter_content = iter_content
+            return resp
+        broken = requests.exceptions.ChunkedEncodingError('broken')
+        with patch.object(http_client, 'get', side_effect=[
+                response(200, ['abc', 'def', broken]),
+                response(206, ['ghi', broken]),
+                response(200, ['abcdefghijkl']),
+                ]) as mock_get:
+            out = StringIO()
+            self.assertEqual(http_client.download(
+                'http://example.edu/big.mrc', out,
+                headers={'User-Agent': 'test'}), 12)
+        self.assertEqual(out.getvalue(), 'abcdefghijkl')
+        self.assertEqual(mock_sleep.call_count, 2)
+        self.assertNotIn('Range', mock_get.call_args_list[0][1]['headers'])
+        self.assertEqual(mock_get.call_args_list[1][1]['headers'],
+                         {'User-Agent': 'test', 'Range': 'bytes=6-'})
+        self.assertEqual(mock_get.call_args_list[2][1]['headers']['Range'],
+                         'bytes=9-')
+        with patch.object(http_client, 'get', side_effect=[
+                response(200, ['abc', broken]),
+                response(416, []),
+                ]):
+            out = StringIO()
+            self.assertEqual(http_client.download(
+                'http://example.edu/big.mrc', out), 3)
+        with patch.object(http_client, 'get', side_effect=[
+                response(200, ['abc', broken]),
+                response(206, [broken]),
+                ]):
+            self.assertRaises(requests.exceptions.ChunkedEncodingError,
+                              http_client.download,
+                              'http://example.edu/big.mrc', StringIO(),
+                              retries=1)
+
+    def testFileURL(self):
+        '''URLs that aren't http are read with urllib'''
+        path = os.path.join(DIR_FIXTURES, 'marc-test')
+        self.assertEqual(http_client.get_content('file:' + path),
+                         open(path).read())
+
+
+# Copyright © 2016, Regents of the University of California
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+# - Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# - Neither the name of the University of California nor the names of its
+#   contributors may be used to endorse or promote products derived from this
+#   software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
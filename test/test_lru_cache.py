@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from harvester.lru_cache import LRUCache, MISSING
+
+
+class LRUCacheTestCase(TestCase):
+    '''Test the bounded cache'''
+    def testLRU(self):
+        '''The least recently used item is dropped when full'''
+        cache = LRUCache(maxsize=2)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(cache.get('a'), 1)
+        cache['c'] = 3
+        self.assertEqual(len(cache), 2)
+        self.assertNotIn('b', cache)
+        self.assertIs(cache.get('b'), MISSING)
+        self.assertEqual(cache.get('b', None), None)
+        self.assertEqual(cache.items(), [('a', 1), ('c', 3)])
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 2, 'size': 2})
+        cache.clear()
+        self.assertEqual(cache.stats(), {'hits': 0, 'misses': 0, 'size': 0})
+
+    def testSaveLoad(self):
+        '''Items saved to a file are loaded into another cache, within its
+        size'''
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, 'cache.pkl')
+        cache = LRUCache()
+        cache.load(path)
+        self.assertEqual(len(cache), 0)
+        for i in range(5):
+            cache[i] = str(i)
+        cache.save(path)
+        self.assertEqual(os.listdir(tmpdir), ['cache.pkl'])
+        cache_loaded = LRUCache(maxsize=3)
+        cache_loaded.load(path)
+        self.assertEqual(cache_loaded.items(), [(2, '2'), (3, '3'), (4, '4')])
+        self.assertEqual(cache_loaded.pop_new_items(), [])
+        shutil.rmtree(tmpdir)
+
+    def testNewItems(self):
+        '''The items added since the last pop_new_items can be merged into
+        another cache'''
+        cache = LRUCache(maxsize=3)
+        cache['a'] = 1
+        self.assertEqual(cache.pop_new_items(), [('a', 1)])
+        self.assertEqual(cache.pop_new_items(), [])
+        for key in 'abcd':
+            cache[key] = key
+        self.assertEqual(sorted(cache.pop_new_items()),
+                         [('b', 'b'), ('c', 'c'), ('d', 'd')])
+        cache_merged = LRUCache()
+        cache['e'] = 'e'
+        cache_merged.update(cache.pop_new_items())
+        self.assertEqual(cache_merged.items(), [('e', 'e')])
+
+
+# Copyright © 2016, Regents of the University of California
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+# - Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# - Neither the name of the University of California nor the names of its
+#   contributors may be used to endorse or promote products derived from this
+#   software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
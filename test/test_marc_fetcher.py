@@ -8,6 +8,11 @@ from test.utils import DIR_FIXTURES
 from mypretty import httpretty
 # import httpretty
 import harvester.fetcher as fetcher
+from harvester.fetcher.marc_fetcher import marc_xml_to_dicts
+from xml.etree import ElementTree as ET
+from lxml import etree
+from StringIO import StringIO
+import pymarc
 import pprint
 
 class MARCFetcherTestCase(LogOverrideMixin, TestCase):
@@ -26,7 +31,8 @@ class MARCFetcherTestCase(LogOverrideMixin, TestCase):
 
     def testLocalFileLoad(self):
         h = fetcher.MARCFetcher('file:' + DIR_FIXTURES + '/marc-test', None)
-        for n, rec in enumerate(h):  # enum starts at 0
+        recs = [rec for batch in h for rec in batch]
+        for n, rec in enumerate(recs):  # enum starts at 0
             pass
             # print("NUM->{}:{}".format(n,rec))
         self.assertEqual(n, 9)
@@ -34,6 +40,30 @@ class MARCFetcherTestCase(LogOverrideMixin, TestCase):
         self.assertEqual(rec['leader'], '01914nkm a2200277ia 4500')
         self.assertEqual(len(rec['fields']), 21)
 
+    def testBatchesIndex(self):
+        '''Records come in batches, their offsets are indexed and the fetch
+        can resume from a checkpoint'''
+        path = DIR_FIXTURES + '/marc-test'
+        h = fetcher.MARCFetcher('file:' + path, None, batch_size=4)
+        first = h.next()
+        checkpoint = h.get_checkpoint()
+        self.assertEqual(checkpoint['records_fetched'], 4)
+        batches = [first] + list(h)
+        self.assertEqual([len(batch) for batch in batches], [4, 4, 2])
+        data = open(path).read()
+        self.assertEqual(len(h.record_index), 10)
+        offset = 0
+        for rec_offset, length in h.record_index:
+            self.assertEqual(rec_offset, offset)
+            self.assertEqual(data[offset + length - 1], '\x1d')
+            self.assertEqual(int(data[offset:offset + 5]), length)
+            offset += length
+        self.assertEqual(offset, len(data))
+        self.assertEqual(checkpoint['file_offset'], h.record_index[4][0])
+        h = fetcher.MARCFetcher('file:' + path, None, batch_size=4)
+        h.resume(checkpoint)
+        self.assertEqual(list(h), batches[1:])
+
 
 class AlephMARCXMLFetcherTestCase(LogOverrideMixin, TestCase):
     @httpretty.activate
@@ -70,6 +100,91 @@ class AlephMARCXMLFetcherTestCase(LogOverrideMixin, TestCase):
             num_fetched += len(objset)
         self.assertEqual(num_fetched, 8)
 
+    @httpretty.activate
+    def testFetchingConcurrent(self):
+        '''Test that pages fetched concurrently come back in order'''
+        for start, page in ((1, '1-3'), (4, '4-6'), (7, '7-8')):
+            httpretty.register_uri(
+                httpretty.GET,
+                'http://ucsb-fake-aleph/endpoint&maximumRecords=3'
+                '&startRecord={}'.format(start),
+                body=open(DIR_FIXTURES +
+                          '/ucsb-aleph-resp-{}.xml'.format(page)).read())
+        h = fetcher.AlephMARCXMLFetcher(
+            'http://ucsb-fake-aleph/endpoint', None, page_size=3,
+            concurrency=3)
+        h_serial = fetcher.AlephMARCXMLFetcher(
+            'http://ucsb-fake-aleph/endpoint', None, page_size=3)
+        self.assertEqual(h.page_last, 3)
+        self.assertEqual(list(h), list(h_serial))
+        self.assertEqual(h.current_record, 10)
+
+    @httpretty.activate
+    def testFirstPageReused(self):
+        '''The first page is requested once, the next pages are fetched in
+        the background when it is returned'''
+        for start, page in ((1, '1-3'), (4, '4-6'), (7, '7-8')):
+            httpretty.register_uri(
+                httpretty.GET,
+                'http://ucsb-fake-aleph/endpoint&maximumRecords=3'
+                '&startRecord={}'.format(start),
+                body=open(DIR_FIXTURES +
+                          '/ucsb-aleph-resp-{}.xml'.format(page)).read())
+        h = fetcher.AlephMARCXMLFetcher(
+            'http://ucsb-fake-aleph/endpoint', None, page_size=3)
+        self.assertEqual(h.concurrency, 4)
+        sent = httpretty.core.httpretty.latest_requests
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(len(h.next()), 3)
+        self.assertEqual(sorted(h._pages_pending.keys()), [2, 3])
+        self.assertEqual(sum(len(objset) for objset in h), 5)
+        self.assertEqual(
+            sorted(r.querystring['startRecord'][0] for r in sent),
+            ['1', '4', '7'])
+        h = fetcher.AlephMARCXMLFetcher(
+            'http://ucsb-fake-aleph/endpoint', None, page_size=3)
+        h.resume({'page_current': 2})
+        self.assertEqual(h._pages_done, {})
+
+
+class MARCXMLToDictTestCase(TestCase):
+    '''Test converting MARC XML elements to pymarc's as_dict structure'''
+
+    def assertSameAsPymarc(self, element, xml):
+        self.assertEqual(
+            marc_xml_to_dicts(element),
+            [rec.as_dict() for rec in pymarc.parse_xml_to_array(StringIO(xml))
+             if rec is not None])
+
+    def testAlephPages(self):
+        '''SRU pages parsed with ElementTree'''
+        for name in ('1-3', '4-6', '7-8'):
+            xml = open(
+                DIR_FIXTURES + '/ucsb-aleph-resp-{}.xml'.format(name)).read()
+            tree = ET.fromstring(xml)
+            self.assertTrue(marc_xml_to_dicts(tree))
+            self.assertSameAsPymarc(tree, xml)
+
+    def testOAIRecords(self):
+        '''OAI metadata records parsed with lxml'''
+        tree = etree.parse(DIR_FIXTURES + '/testOAI-tind.xml')
+        records = tree.findall(
+            './/{http://www.openarchives.org/OAI/2.0/}metadata/')
+        self.assertEqual(len(records), 5)
+        for record in records:
+            self.assertSameAsPymarc(record,
+                                    etree.tostring(record, encoding='utf-8'))
+
+    def testDefaults(self):
+        '''Missing leader & indicators, odd tags'''
+        xml = '<collection><record>' \
+            '<controlfield tag="1">x</controlfield>' \
+            '<datafield tag="245"><subfield code="a"></subfield>' \
+            '<subfield code="b">\xc3\xa9</subfield></datafield>' \
+            '<datafield tag="ABC" ind1="1" ind2="2"/>' \
+            '</record></collection>'
+        self.assertSameAsPymarc(ET.fromstring(xml), xml)
+
 
 class Harvest_MARC_ControllerTestCase(ConfigFileOverrideMixin,
                                       LogOverrideMixin, TestCase):
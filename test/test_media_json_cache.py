@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import shutil
+import tempfile
+from StringIO import StringIO
+from unittest import TestCase
+from mock import patch, Mock
+from botocore.exceptions import ClientError
+from test.utils import LogOverrideMixin
+from harvester import media_json_cache
+from harvester.media_json_cache import MediaJsonCache
+from harvester.solr_updater import check_nuxeo_media, MediaJSONError
+
+MEDIA_JSON = {
+    'label': 'Brag',
+    'href': 'https://nuxeo.cdlib.org/Nuxeo/nxfile/default/x/file:content/',
+    'structMap': [
+        {'label': 'page 1', 'href': 'https://example.edu/p1.jpg'},
+        {'label': 'page 2'},
+    ]
+}
+
+
+def not_modified():
+    return ClientError({'Error': {'Code': '304'}}, 'GetObject')
+
+
+def s3_object(etag, body=MEDIA_JSON):
+    return {'ETag': etag, 'Body': StringIO(json.dumps(body))}
+
+
+class MediaJsonCacheTestCase(LogOverrideMixin, TestCase):
+    '''Test the on disk cache of parsed media json'''
+    def setUp(self):
+        super(MediaJsonCacheTestCase, self).setUp()
+        self.cache_dir = tempfile.mkdtemp()
+        self.s3 = Mock()
+        self.cache = MediaJsonCache(self.cache_dir, s3=self.s3)
+
+    def tearDown(self):
+        super(MediaJsonCacheTestCase, self).tearDown()
+        shutil.rmtree(self.cache_dir)
+
+    def testConditionalGet(self):
+        '''The media json is parsed once per ETag'''
+        self.s3.get_object.side_effect = [
+            s3_object('"e1"'), not_modified(), s3_object('"e2"')]
+        entry = self.cache.get('bucket', 'media_json/a-media.json')
+        self.assertEqual(entry['labels'], ['Brag', 'page 1', 'page 2'])
+        self.assertEqual(len(entry['files']), 2)
+        self.assertEqual(entry['etag'], '"e1"')
+        self.s3.get_object.assert_called_with(
+            Bucket='bucket', Key='media_json/a-media.json')
+        entry = self.cache.get_url('s3://bucket/media_json/a-media.json')
+        self.assertEqual(entry['labels'], ['Brag', 'page 1', 'page 2'])
+        self.s3.get_object.assert_called_with(
+            Bucket='bucket', Key='media_json/a-media.json',
+            IfNoneMatch='"e1"')
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        entry = self.cache.get('bucket', 'media_json/a-media.json')
+        self.assertEqual(entry['etag'], '"e2"')
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+        self.s3.get_object.side_effect = ClientError(
+            {'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        self.assertRaises(ClientError, self.cache.get, 'bucket', 'missing')
+
+    def testEvict(self):
+        '''The least recently used entries go when the cache is full'''
+        self.s3.get_object.side_effect = lambda **kwargs: s3_object('"e"')
+        for i in range(5):
+            self.cache.get('bucket', 'key{}'.format(i))
+            path = self.cache._path('bucket', 'key{}'.format(i))
+            os.utime(path, (1000 + i, 1000 + i))
+        size = os.path.getsize(path)
+        self.cache.max_bytes = size * 3
+        self.cache.evict()
+        for i in range(5):
+            self.assertEqual(
+                os.path.exists(self.cache._path('bucket', 'key{}'.format(i))),
+                i >= 3)
+
+    @patch('harvester.fetcher.http_client.head')
+    @patch('harvester.solr_updater.MediaJson')
+    def testCheckNuxeoMedia(self, mock_mediajson, mock_head):
+        '''The files of the cached media json are checked every time,
+        without getting the media json again'''
+        media_json = dict(MEDIA_JSON, href='s3://media/a.jp2')
+        self.s3.get_object.side_effect = [
+            s3_object('"e1"', media_json), not_modified(), not_modified()]
+        mock_head.return_value.ok = True
+        doc = {'harvest_id_s': 'a-UUID',
+               'structmap_url': 's3://bucket/media_json/a-media.json'}
+        with patch.dict(os.environ, {'MEDIA_JSON_CACHE_DIR': self.cache_dir}):
+            with patch.object(media_json_cache, '_cache', self.cache):
+                check_nuxeo_media(doc)
+                check_nuxeo_media(doc)
+                self.assertEqual(self.s3.head_object.call_count, 2)
+                self.s3.head_object.assert_called_with(Bucket='media',
+                                                       Key='a.jp2')
+                mock_head.assert_called_with('https://example.edu/p1.jpg',
+                                             allow_redirects=True)
+                self.assertEqual(mock_head.call_count, 2)
+                # a file removed later is reported
+                self.s3.head_object.side_effect = ClientError(
+                    {'Error': {'Code': '404'}}, 'HeadObject')
+                self.assertRaises(MediaJSONError, check_nuxeo_media, doc)
+        self.assertEqual(mock_mediajson.call_count, 0)
+        self.assertEqual(self.cache.misses, 1)
+
+
+# Copyright © 2016, Regents of the University of California
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+# - Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# - Neither the name of the University of California nor the names of its
+#   contributors may be used to endorse or promote products derived from this
+#   software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import os
+import datetime
 from unittest import TestCase
 import pickle
 import json
@@ -143,6 +144,149 @@ class NuxeoFetcherTestCase(LogOverrideMixin, TestCase):
             'https://nuxeo.cdlib.org/Nuxeo/nxpicsfile/default/'
             '40677ed1-f7c2-476f-886d-bf79c3fec8c4/Medium:content/')
 
+    @patch('pynux.utils.Nuxeo.nxql', autospec=True)
+    @patch('harvester.fetcher.nuxeo_fetcher.DeepHarvestNuxeo', autospec=True)
+    def testModifiedSince(self, mock_deepharvest, mock_nxql):
+        '''Test that only objects modified since the last harvest, or with
+        a modified component, are fetched'''
+        deepharvest_mocker(mock_deepharvest)
+        objects = mock_deepharvest.return_value.fetch_objects.return_value
+        mock_nxql.return_value = [
+            {'uid': objects[1]['uid'], 'parentRef': 'folder-uid'},
+            {'uid': 'component-uid', 'parentRef': objects[2]['uid']},
+        ]
+        h = fetcher.NuxeoFetcher(
+            'https://example.edu/api/v1', '/asset-library/here',
+            since=datetime.datetime(2017, 7, 14, 12, 1))
+        query = mock_nxql.call_args[0][1]
+        self.assertIn("ecm:path STARTSWITH '/asset-library/here'", query)
+        self.assertIn("dc:modified >= TIMESTAMP '2017-07-14T12:01:00'", query)
+        self.assertEqual([c['uid'] for c in h._children],
+                         [objects[1]['uid'], objects[2]['uid']])
+
+    @patch('pynux.utils.Nuxeo.get_metadata', autospec=True)
+    @patch('pynux.utils.Nuxeo.nxql', autospec=True)
+    @patch('boto.connect_s3', autospec=True)
+    @patch('harvester.fetcher.nuxeo_fetcher.DeepHarvestNuxeo', autospec=True)
+    def testFetchBatched(self, mock_deepharvest, mock_boto, mock_nxql,
+                         mock_get_metadata):
+        '''Metadata & components come from one NXQL query per batch, media
+        json over one S3 connection per thread'''
+        deepharvest_mocker(mock_deepharvest)
+        objects = mock_deepharvest.return_value.fetch_objects.return_value
+        mock_boto.return_value.get_bucket.return_value.\
+            get_key.return_value.\
+            get_contents_as_string.return_value = open(
+                DIR_FIXTURES + '/nuxeo_media_structmap.json').read()
+        doc = json.load(open(DIR_FIXTURES + '/nuxeo_doc.json'))
+        imageless = json.load(
+            open(DIR_FIXTURES + '/nuxeo_doc_imageless_parent.json'))
+        components = json.load(
+            open(DIR_FIXTURES + '/nuxeo_image_components.json'))['entries']
+        components[0] = json.load(
+            open(DIR_FIXTURES + '/nuxeo_first_image_component.json'))
+
+        def nxql(nx, query):
+            if 'ecm:uuid IN' in query:
+                docs = []
+                for obj in objects:
+                    if obj['uid'] in query:
+                        metadata = dict(doc if obj is objects[0]
+                                        else imageless)
+                        metadata['uid'] = obj['uid']
+                        docs.append(metadata)
+                return reversed(docs)
+            self.assertIn('ecm:parentId IN', query)
+            self.assertIn('ecm:primaryType IN', query)
+            self.assertNotIn(objects[0]['uid'], query)
+            results = []
+            for obj in objects[1:]:
+                for component in components:
+                    component = dict(component, parentRef=obj['uid'])
+                    if obj is objects[2]:
+                        component['type'] = 'CustomFile'
+                    results.append(component)
+            return results
+        mock_nxql.side_effect = nxql
+        h = fetcher.NuxeoFetcher('https://example.edu/api/v1',
+                                 'path-to-asset/here', batch_size=2,
+                                 media_concurrency=2)
+        batches = list(h)
+        self.assertEqual([len(batch) for batch in batches], [2, 1])
+        docs = batches[0] + batches[1]
+        self.assertEqual([d['uid'] for d in docs],
+                         [obj['uid'] for obj in objects])
+        self.assertEqual(mock_nxql.call_count, 4)
+        self.assertEqual(mock_get_metadata.call_count, 0)
+        self.assertEqual(h.get_checkpoint(), {'position': 3})
+        self.assertEqual(docs[0]['structmap_text'],
+                         "Angela Davis socializing with students at UC Irvine "
+                         "AS-061_A69-013_001.tif AS-061_A69-013_002.tif "
+                         "AS-061_A69-013_003.tif AS-061_A69-013_004.tif "
+                         "AS-061_A69-013_005.tif AS-061_A69-013_006.tif "
+                         "AS-061_A69-013_007.tif")
+        self.assertEqual(docs[0]['structmap_url'],
+                         's3://static.ucldc.cdlib.org/media_json/' +
+                         objects[0]['uid'] + '-media.json')
+        self.assertEqual(
+            docs[0]['isShownBy'],
+            'https://nuxeo.cdlib.org/Nuxeo/nxpicsfile/default/{}/'
+            'Medium:content/'.format(objects[0]['uid']))
+        self.assertEqual(
+            docs[1]['isShownBy'],
+            'https://nuxeo.cdlib.org/Nuxeo/nxpicsfile/default/'
+            'e8af2d74-0c8b-4d18-b86c-4067b9e16159/Medium:content/')
+        self.assertEqual(
+            docs[2]['isShownBy'],
+            'https://s3.amazonaws.com/static.ucldc.cdlib.org/'
+            'ucldc-nuxeo-thumb-media/e8af2d74-0c8b-4d18-b86c-4067b9e16159')
+        self.assertLessEqual(mock_boto.call_count, 2)
+        self.assertIsNone(h._media_pool)
+        # a harvest that stops early closes the media threads
+        h = fetcher.NuxeoFetcher('https://example.edu/api/v1',
+                                 'path-to-asset/here', batch_size=2,
+                                 media_concurrency=2)
+        h.next()
+        pool = h._media_pool
+        with patch.object(pool, 'terminate', wraps=pool.terminate) as \
+                mock_terminate:
+            h.close()
+        self.assertEqual(mock_terminate.call_count, 1)
+        self.assertIsNone(h._media_pool)
+
+    @patch('pynux.utils.Nuxeo.nxql', autospec=True)
+    @patch('harvester.fetcher.nuxeo_fetcher.DeepHarvestNuxeo', autospec=True)
+    def testComponentsBatch(self, mock_deepharvest, mock_nxql):
+        '''Only the first image & thumbnail components are kept, and the
+        query is read until each parent has an image component'''
+        deepharvest_mocker(mock_deepharvest)
+        image = json.load(
+            open(DIR_FIXTURES + '/nuxeo_first_image_component.json'))
+        pdf = dict(image, type='CustomFile')
+        read = []
+
+        def nxql(nx, query):
+            children = [
+                dict(pdf, uid='a-0', parentRef='a'),
+                dict(image, uid='b-0', parentRef='b'),
+                dict(pdf, uid='a-1', parentRef='a'),
+                dict(image, uid='b-1', parentRef='b'),
+                dict(image, uid='a-2', parentRef='a'),
+                dict(image, uid='a-3', parentRef='a'),
+            ]
+            for child in children:
+                read.append(child['uid'])
+                yield child
+        mock_nxql.side_effect = nxql
+        h = fetcher.NuxeoFetcher('https://example.edu/api/v1',
+                                 'path-to-asset/here', batch_size=2)
+        components = h._get_components_batch([{'uid': 'a'}, {'uid': 'b'}])
+        self.assertEqual(
+            dict((uid, [c['uid'] for c in children])
+                 for uid, children in components.items()),
+            {'a': ['a-0', 'a-2'], 'b': ['b-0']})
+        self.assertEqual(read, ['a-0', 'b-0', 'a-1', 'b-1', 'a-2'])
+
     @httpretty.activate
     @patch('boto.connect_s3', autospec=True)
     @patch('harvester.fetcher.nuxeo_fetcher.DeepHarvestNuxeo', autospec=True)
@@ -3,7 +3,12 @@ import os
 import json
 from unittest import TestCase
 import shutil
+import urlparse
+from urlparse import parse_qs
+from StringIO import StringIO
 from mock import patch
+import requests
+from requests.packages.urllib3.exceptions import ProtocolError
 from xml.etree import ElementTree as ET
 from mypretty import httpretty
 # import httpretty
@@ -498,6 +503,123 @@ class OAC_XML_Fetcher_mixed_contentTestCase(LogOverrideMixin, TestCase):
         self.assertRaises(StopIteration, oac_fetcher.next)
 
 
+class RawResponse(StringIO):
+    '''Stands in for the urllib3 response of a streamed request'''
+    def release_conn(self):
+        pass
+
+
+class BrokenRawResponse(RawResponse):
+    '''A streamed body that breaks off after size bytes'''
+    def __init__(self, body, size, exc):
+        RawResponse.__init__(self, body)
+        self.size = size
+        self.exc = exc
+
+    def read(self, n=-1):
+        if self.tell() >= self.size:
+            raise self.exc
+        if n < 0 or self.tell() + n > self.size:
+            n = self.size - self.tell()
+        return RawResponse.read(self, n)
+
+
+class OAC_XML_Fetcher_prefetchTestCase(LogOverrideMixin, TestCase):
+    '''Test fetching pages worked out from the group totals'''
+    url = 'http://dsc.cdlib.org/search?facet=type-tab&style=cui&raw=1&' \
+        'relation=ark:/13030/hb5d5nb7dj'
+    fixtures = {
+        None: 'testOAC-url_next-0.xml',
+        ('image', '1'): 'testOAC-url_next-0.xml',
+        ('image', '11'): 'testOAC-url_next-1.xml',
+        ('text', '1'): 'testOAC-url_next-2.xml',
+        ('text', '11'): 'testOAC-url_next-3.xml',
+    }
+
+    def get(self, url, **kwargs):
+        query = parse_qs(urlparse.urlsplit(url).query)
+        key = None
+        if 'group' in query:
+            key = (query['group'][0], query['startDoc'][0])
+        self.urls.append(key)
+        resp = requests.Response()
+        resp.status_code = 200
+        resp.raw = RawResponse(open(DIR_FIXTURES + '/' +
+                                    self.fixtures[key]).read())
+        return resp
+
+    def setUp(self):
+        super(OAC_XML_Fetcher_prefetchTestCase, self).setUp()
+        self.urls = []
+        patcher = patch('harvester.fetcher.http_client.get',
+                        side_effect=self.get)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def testPrefetch(self):
+        serial = list(fetcher.OAC_XML_Fetcher(self.url, 'extra_data',
+                                              docsPerPage=10))
+        self.urls = []
+        h = fetcher.OAC_XML_Fetcher(self.url, 'extra_data', docsPerPage=10,
+                                    concurrency=3)
+        self.assertEqual(h.pages, [('image', 1), ('image', 11),
+                                   ('text', 1), ('text', 11)])
+        objsets = list(h)
+        self.assertEqual([len(objset) for objset in objsets],
+                         [10, 3, 10, 1])
+        self.assertEqual(objsets, serial)
+        # the first response is kept as page 1, not requested again
+        self.assertEqual(self.urls[0], None)
+        self.assertEqual(sorted(self.urls[1:]),
+                         [('image', '11'), ('text', '1'), ('text', '11')])
+        self.assertEqual(h.currentDoc, 24)
+        self.assertEqual(h.currentGroup, 'text')
+
+    def testResume(self):
+        h = fetcher.OAC_XML_Fetcher(self.url, 'extra_data', docsPerPage=10)
+        h.next()
+        h.next()
+        checkpoint = h.get_checkpoint()
+        rest = list(h)
+        h = fetcher.OAC_XML_Fetcher(self.url, 'extra_data', docsPerPage=10,
+                                    concurrency=2)
+        h.resume(checkpoint)
+        self.assertEqual(h.page_current, 3)
+        self.assertEqual(list(h), rest)
+
+    @patch('time.sleep')
+    def testPageBreaksOff(self, mock_sleep):
+        '''A page whose body breaks off or is cut short is read again'''
+        serial = list(fetcher.OAC_XML_Fetcher(self.url, 'extra_data',
+                                              docsPerPage=10))
+        body = open(DIR_FIXTURES + '/testOAC-url_next-1.xml').read()
+        get = self.get
+        broken = [ProtocolError('Connection broken'), None]
+
+        def get_broken(url, **kwargs):
+            resp = get(url, **kwargs)
+            if 'startDoc=11&group=image' in url and broken:
+                exc = broken.pop(0)
+                if exc:
+                    resp.raw = BrokenRawResponse(body, 2000, exc)
+                else:  # cut short, the XML is not well formed
+                    resp.raw = RawResponse(body[:2000])
+            return resp
+        with patch('harvester.fetcher.http_client.get',
+                   side_effect=get_broken):
+            objsets = list(fetcher.OAC_XML_Fetcher(
+                self.url, 'extra_data', docsPerPage=10))
+        self.assertEqual(objsets, serial)
+        self.assertEqual(mock_sleep.call_count, 2)
+        with patch('harvester.fetcher.http_client.get',
+                   side_effect=get_broken):
+            h = fetcher.OAC_XML_Fetcher(self.url, 'extra_data',
+                                        docsPerPage=10)
+            h.next()
+            broken.extend([ProtocolError('Connection broken')] * 6)
+            self.assertRaises(ProtocolError, h.next)
+
+
 class OAC_JSON_FetcherTestCase(LogOverrideMixin, TestCase):
     '''Test the OAC_JSON_Fetcher
     '''
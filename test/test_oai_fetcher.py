@@ -161,6 +161,33 @@ class OAIFetcherTestCase(LogOverrideMixin, TestCase):
                          {u'verb': [u'ListRecords'], u'set': [u'sugoroku'],
                          u'metadataPrefix': [u'marcxml']})
 
+    @httpretty.activate
+    def testCheckpointResume(self):
+        '''Test that the fetch can resume part way through a response'''
+        httpretty.register_uri(
+            httpretty.GET,
+            'http://content.cdlib.org/oai',
+            body=open(DIR_FIXTURES+'/testOAI-tind.xml').read())
+        tind_fetcher = fetcher.OAIFetcher('http://content.cdlib.org/oai',
+                                          'set=sugoroku&metadataPrefix=marcxml')
+        self.assertEqual(tind_fetcher.get_checkpoint(),
+                         {'resumptionToken': None, 'offset': 0})
+        # the fixture's resumptionToken gets the same 5 records again
+        recs = [tind_fetcher.next() for n in range(7)]
+        checkpoint = tind_fetcher.get_checkpoint()
+        self.assertEqual(checkpoint, {'resumptionToken': 'sugoroku___kwbSpr',
+                                      'offset': 2})
+        resumed_fetcher = fetcher.OAIFetcher(
+            'http://content.cdlib.org/oai',
+            'set=sugoroku&metadataPrefix=marcxml')
+        resumed_fetcher.resume(checkpoint)
+        self.assertEqual(httpretty.last_request().querystring,
+                         {u'verb': [u'ListRecords'],
+                          u'resumptionToken': [u'sugoroku___kwbSpr']})
+        self.assertEqual(resumed_fetcher.next()['id'], recs[2]['id'])
+        self.assertEqual(resumed_fetcher.get_checkpoint(), {
+            'resumptionToken': 'sugoroku___kwbSpr', 'offset': 3})
+
     @httpretty.activate
     def testDCTERMS(self):
         '''Test the OAI fetcher when the source data has exteneded dcterms in
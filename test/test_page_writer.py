@@ -0,0 +1,69 @@
+import gzip
+import StringIO
+from unittest import TestCase
+from mock import MagicMock
+from harvester.fetcher.page_writer import S3PageWriter
+
+
+class S3PageWriterTestCase(TestCase):
+    '''Test the streaming JSONL page writer'''
+
+    def setUp(self):
+        self.bucket = MagicMock()
+        self.upload = self.bucket.Object().initiate_multipart_upload()
+        self.upload.Part().upload.side_effect = lambda Body: {
+            'ETag': 'etag-{}'.format(len(Body))}
+        self.objset = [{'id': n, 'title': 'record {}'.format(n)}
+                       for n in range(10)]
+
+    def test_small_page(self):
+        '''Small pages are saved with one put_object'''
+        with S3PageWriter(self.bucket, 'page-0.jsonl') as writer:
+            for obj in self.objset[:2]:
+                writer.write(obj)
+        self.bucket.put_object.assert_called_with(
+            Body='{"id": 0, "title": "record 0"}\n'
+            '{"id": 1, "title": "record 1"}\n',
+            Key='page-0.jsonl')
+        self.assertEqual(writer.num_records, 2)
+
+    def test_compressed_page(self):
+        with S3PageWriter(
+                self.bucket, 'page-0.jsonl.gz', compress=True) as writer:
+            for obj in self.objset[:2]:
+                writer.write(obj)
+        kwargs = self.bucket.put_object.call_args[1]
+        self.assertEqual(kwargs['Key'], 'page-0.jsonl.gz')
+        self.assertEqual(kwargs['ContentEncoding'], 'gzip')
+        body = gzip.GzipFile(fileobj=StringIO.StringIO(kwargs['Body'])).read()
+        self.assertEqual(body, '{"id": 0, "title": "record 0"}\n'
+                         '{"id": 1, "title": "record 1"}\n')
+
+    def test_multipart_page(self):
+        '''Pages bigger than the part size are uploaded in parts'''
+        with S3PageWriter(self.bucket, 'page-0.jsonl', part_size=64) as writer:
+            for obj in self.objset:
+                writer.write(obj)
+        self.assertFalse(self.bucket.put_object.called)
+        bodies = [c[1]['Body'] for c in
+                  self.upload.Part().upload.call_args_list]
+        self.assertEqual(len(bodies), 4)
+        self.assertTrue(all(len(b) >= 64 for b in bodies[:-1]))
+        self.assertEqual(
+            ''.join(bodies),
+            ''.join('{{"id": {0}, "title": "record {0}"}}\n'.format(n)
+                    for n in range(10)))
+        parts = self.upload.complete.call_args[1]['MultipartUpload']['Parts']
+        self.assertEqual([p['PartNumber'] for p in parts], [1, 2, 3, 4])
+        self.assertEqual(parts[0]['ETag'], 'etag-{}'.format(len(bodies[0])))
+
+    def test_abort_on_error(self):
+        def write_bad_page():
+            with S3PageWriter(
+                    self.bucket, 'page-0.jsonl', part_size=64) as writer:
+                for obj in self.objset:
+                    writer.write(obj)
+                raise ValueError('Boom!')
+        self.assertRaises(ValueError, write_bad_page)
+        self.upload.abort.assert_called_with()
+        self.assertFalse(self.upload.complete.called)
@@ -4,6 +4,8 @@ from unittest import TestCase
 import shutil
 import re
 import pickle
+import StringIO
+from botocore.exceptions import ClientError
 from mypretty import httpretty
 # import httpretty
 import logbook
@@ -254,6 +256,59 @@ class MainTestCase(ConfigFileOverrideMixin, LogOverrideMixin, TestCase):
         )
 
 
+    @httpretty.activate
+    @patch('boto3.resource', autospec=True)
+    def testMainFnIncremental(self, mock_boto3):
+        '''The ingest doc of an incremental harvest records the since of
+        the harvest, not the last harvest it just saved'''
+        httpretty.register_uri(
+            httpretty.GET,
+            "https://registry.cdlib.org/api/v1/collection/197/",
+            body=open(DIR_FIXTURES + '/collection_api_test.json').read())
+        httpretty.register_uri(
+            httpretty.GET,
+            re.compile("http://content.cdlib.org/oai?.*"),
+            body=open(DIR_FIXTURES + '/testOAI-128-records.xml').read())
+        s3_objects = {}
+
+        def put_object(**kwargs):
+            s3_objects[kwargs['Key']] = kwargs['Body']
+
+        def get_object(key):
+            s3_object = MagicMock()
+            if key not in s3_objects:
+                s3_object.get.side_effect = ClientError(
+                    {'Error': {'Code': 'NoSuchKey', 'Message': ''}},
+                    'GetObject')
+            else:
+                s3_object.get.return_value = {
+                    'Body': StringIO.StringIO(s3_objects[key])}
+            return s3_object
+
+        bucket = mock_boto3().Bucket()
+        bucket.put_object.side_effect = put_object
+        bucket.Object.side_effect = get_object
+        with patch('dplaingestion.couch.Couch') as mock_couch:
+            instance = mock_couch.return_value
+            instance._create_ingestion_document.return_value = 'test-id'
+            ingest_doc_id, num, self.dir_save, self.harvester = fetcher.main(
+                self.user_email,
+                self.url_api_collection,
+                log_handler=self.test_log_handler,
+                mail_handler=self.test_log_handler,
+                dir_profile=self.dir_test_profile,
+                profile_path=self.profile_path,
+                config_file=self.config_file,
+                incremental=True)
+        self.assertIn('data-fetched/197/last-harvest.json', s3_objects)
+        update_kwargs = instance.update_ingestion_doc.call_args[1]
+        self.assertEqual(update_kwargs['fetch_process/status'], 'complete')
+        self.assertIsNone(update_kwargs['fetch_process/since'])
+        self.assertEqual(update_kwargs['fetch_process/changed_items'], 128)
+        self.assertIsNone(self.harvester.since)
+        self.assertNotIn('from', httpretty.last_request().querystring)
+
+
 class LogFileNameTestCase(TestCase):
     '''Test the log file name function'''
 
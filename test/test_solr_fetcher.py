@@ -1,12 +1,18 @@
 # -*- coding: utf-8 -*-
+import datetime
+import re
+import json
+import urlparse
 from unittest import TestCase
-from mock import patch
+from mock import patch, Mock
 from test.utils import ConfigFileOverrideMixin, LogOverrideMixin
 from test.utils import DIR_FIXTURES
 from harvester.collection_registry_client import Collection
 import solr
 import pysolr
 import harvester.fetcher as fetcher
+from harvester.fetcher.solr_fetcher import AdaptiveRows, range_filter_query
+from harvester.fetcher.solr_fetcher import SolrDocsStream
 from mypretty import httpretty
 
 # import httpretty
@@ -197,6 +203,264 @@ class RequestsSolrFetcherTestCase(LogOverrideMixin, TestCase):
             '&q=extra:data&wt=xml&sort=PID asc',
             h.url_request)
 
+    def test_url_request_since(self):
+        '''Test the filter query for an incremental harvest'''
+        since = datetime.datetime(2017, 7, 14, 12, 1)
+        h = fetcher.RequestsSolrFetcher(
+            'http://example.edu/solr', 'q=extra:data&fq=type:image',
+            since=since)
+        self.assertEqual(
+            h._query_params['fq'],
+            ['type:image', 'timestamp:[2017-07-14T12:01:00Z TO *]'])
+        self.assertIn(
+            '&fq=type:image&fq=timestamp:[2017-07-14T12:01:00Z TO *]',
+            h.url_request)
+        h = fetcher.RequestsSolrFetcher(
+            'http://example.edu/solr',
+            'q=extra:data&since_field=system_modified_dtsi', since=since)
+        self.assertEqual(
+            h._query_params['fq'],
+            ['system_modified_dtsi:[2017-07-14T12:01:00Z TO *]'])
+        self.assertNotIn('since_field', h.url_request)
+
+
+class FakeSolr(object):
+    '''Answers cursorMark, start & range filter queries for a list of ids.
+    The cursorMark is the position in the list.'''
+    re_range = re.compile(
+        r'id:([\[{])(\*|"[^"]*") TO (\*|"[^"]*")([\]}])')
+
+    def __init__(self, ids):
+        self.ids = ids
+        self.urls = []
+
+    def get(self, url, headers=None):
+        self.urls.append(url)
+        params = urlparse.parse_qs(urlparse.urlsplit(url).query)
+        ids = self.ids
+        if params.get('sort', ['id asc'])[0] == 'id desc':
+            ids = list(reversed(ids))
+        for fq in params.get('fq', []):
+            l_bracket, lower, upper, u_bracket = self.re_range.match(
+                fq).groups()
+            ids = [i for i in ids
+                   if (lower == '*' or i > lower[1:-1] or
+                       (l_bracket == '[' and i == lower[1:-1])) and
+                   (upper == '*' or i < upper[1:-1] or
+                    (u_bracket == ']' and i == upper[1:-1]))]
+        rows = int(params['rows'][0])
+        resp_obj = {'response': {'numFound': len(ids)}}
+        if 'cursorMark' in params:
+            cursor = params['cursorMark'][0]
+            start = 0 if cursor == '*' else int(cursor)
+            resp_obj['nextCursorMark'] = str(min(start + rows, len(ids))) \
+                if start < len(ids) else cursor
+        else:
+            start = int(params.get('start', [0])[0])
+        resp_obj['response']['docs'] = [
+            {'id': i} for i in ids[start:start + rows]]
+        resp = Mock()
+        resp.json.return_value = resp_obj
+        resp.content = 'x' * 100 * len(resp_obj['response']['docs'])
+        return resp
+
+
+class RequestsSolrFetcherSlicesTestCase(LogOverrideMixin, TestCase):
+    '''Test the adaptive rows & sliced harvest of the RequestsSolrFetcher'''
+    def testAdaptiveRows(self):
+        '''Rows double at most per page, and shrink for slow or big
+        pages'''
+        rows = AdaptiveRows(rows_min=10, rows_max=5000, target_seconds=5,
+                            max_bytes=1000000)
+        self.assertEqual(rows.update(1000, 1000, 100000, 0.5), 2000)
+        self.assertEqual(rows.update(4000, 4000, 100000, 0.5), 5000)
+        self.assertEqual(rows.update(1000, 1000, 100000, 8), 625)
+        self.assertEqual(rows.update(1000, 1000, 4000000, 1), 500)
+        self.assertEqual(rows.update(1000, 1000, 2000000, 1), 500)
+        self.assertEqual(rows.update(20, 20, 4000000, 1), 10)
+        self.assertEqual(rows.update(1000, 0, 100, 1), 1000)
+
+    def testRangeFilterQuery(self):
+        '''Ranges include the lower bound only, values are quoted'''
+        self.assertEqual(range_filter_query('id', None, u'a"b'),
+                         'id:[* TO "a\\"b"}')
+        self.assertEqual(range_filter_query('id', 'a', None),
+                         'id:["a" TO *]')
+        self.assertEqual(range_filter_query('id', 'a', 'b', desc=True),
+                         'id:{"a" TO "b"]')
+        self.assertEqual(range_filter_query('id', None, 'b', desc=True),
+                         'id:[* TO "b"]')
+
+    def testSlices(self):
+        '''Slices are harvested at the same time and returned in order'''
+        solr = FakeSolr(['id{:03}'.format(i) for i in range(100)])
+        with patch('harvester.fetcher.http_client.get', side_effect=solr.get):
+            h = fetcher.RequestsSolrFetcher('http://example.edu/solr',
+                                            'q=*:*&slices=4')
+            h._page_size = 10
+            self.assertNotIn('slices', h.url_request)
+            docs = []
+            for objset in h:
+                self.assertTrue(objset)
+                docs.extend(objset)
+        self.assertEqual([d['id'] for d in docs], solr.ids)
+        self.assertEqual(h._bounds, ['id025', 'id050', 'id075'])
+        fqs = set(re.search(r'&fq=([^&]*)', url).group(1)
+                  for url in solr.urls if 'fq=' in url)
+        self.assertEqual(len(fqs), 4)
+
+    def testSlicesDesc(self):
+        '''The slices of a descending sort are returned in its order'''
+        solr = FakeSolr(['id{:03}'.format(i) for i in range(100)])
+        with patch('harvester.fetcher.http_client.get', side_effect=solr.get):
+            h = fetcher.RequestsSolrFetcher('http://example.edu/solr',
+                                            'q=*:*&sort=id desc&slices=4')
+            h._page_size = 10
+            docs = []
+            for objset in h:
+                docs.extend(objset)
+        self.assertEqual([d['id'] for d in docs], list(reversed(solr.ids)))
+        self.assertEqual(h._bounds, ['id074', 'id049', 'id024'])
+
+    def testSlicesResume(self):
+        '''A sliced harvest carries on from the checkpoint'''
+        solr = FakeSolr(['id{:03}'.format(i) for i in range(100)])
+        with patch('harvester.fetcher.http_client.get', side_effect=solr.get):
+            h = fetcher.RequestsSolrFetcher('http://example.edu/solr',
+                                            'q=*:*', slices=4)
+            h._page_size = 10
+            docs = h.next() + h.next() + h.next() + h.next()
+            checkpoint = h.get_checkpoint()
+            self.assertEqual(checkpoint['slice'], 1)
+            h = fetcher.RequestsSolrFetcher('http://example.edu/solr',
+                                            'q=*:*', slices=4)
+            h._page_size = 10
+            h.resume(checkpoint)
+            for objset in h:
+                docs.extend(objset)
+        self.assertEqual([d['id'] for d in docs], solr.ids)
+
+    def testSlicesClose(self):
+        '''Closing the fetcher part way stops the slice threads waiting to
+        put their pages'''
+        solr = FakeSolr(['id{:03}'.format(i) for i in range(400)])
+        with patch('harvester.fetcher.http_client.get', side_effect=solr.get):
+            h = fetcher.RequestsSolrFetcher('http://example.edu/solr',
+                                            'q=*:*', slices=4)
+            h._page_size = 10
+            h.slice_put_seconds = 0.01
+            self.assertEqual(len(h.next()), 10)
+            threads = list(h._slice_threads)
+            self.assertEqual(len(threads), 4)
+            h.close()
+            self.assertFalse(any(thread.is_alive() for thread in threads))
+            self.assertIsNone(h._slice_queues)
+            num_urls = len(solr.urls)
+            self.assertLess(num_urls, 40)
+        h.close()
+        self.assertEqual(len(solr.urls), num_urls)
+
+
+def solr_page(docs, cursor_next):
+    '''Return the JSON body of a Solr cursorMark page'''
+    return json.dumps({
+        'responseHeader': {'status': 0, 'params': {'q': 'docs:[* TO *]'}},
+        'response': {'numFound': 7, 'start': 0, 'docs': docs},
+        'nextCursorMark': cursor_next}, indent=2)
+
+
+class SolrDocsStreamTestCase(TestCase):
+    '''Test the incremental decoding of Solr responses'''
+    def testChunks(self):
+        '''Docs are the same whatever the chunks the body arrives in'''
+        body = open(DIR_FIXTURES + '/ucb-cursor-results-0.json').read()
+        body = body.replace('"docs": [', '"docs": [{"title": "caf\\u00e9 ' +
+                            u'\u00e9t\u00e9 ]}'.encode('utf-8') + '"},')
+        expected = json.loads(body)
+        for chunk_size in (1, 3, 7, 100, 100000):
+            resp = Mock()
+            resp.iter_content.side_effect = lambda size: (
+                body[i:i + size] for i in range(0, len(body), size))
+            stream = SolrDocsStream(resp, chunk_size=chunk_size)
+            docs = list(stream)
+            self.assertEqual(docs, expected['response']['docs'])
+            self.assertEqual(docs[0]['title'], u'caf\xe9 \xe9t\xe9 ]}')
+            self.assertEqual(stream.response['nextCursorMark'],
+                             expected['nextCursorMark'])
+            self.assertEqual(stream.response['response']['numFound'], 4)
+            self.assertEqual(stream.nbytes, len(body))
+
+    def testNoDocs(self):
+        '''A body without docs is decoded whole'''
+        resp = Mock()
+        resp.iter_content.return_value = iter(['{"error": ', '{"code": 400}}'])
+        stream = SolrDocsStream(resp)
+        self.assertEqual(list(stream), [])
+        self.assertEqual(stream.response, {'error': {'code': 400}})
+        resp.iter_content.return_value = iter(['{"response": {"docs": [{}, '])
+        self.assertRaises(ValueError, list, SolrDocsStream(resp))
+
+
+class RequestsSolrFetcherStreamingTestCase(LogOverrideMixin, TestCase):
+    '''Test the streamed decoding of RequestsSolrFetcher pages'''
+    def setUp(self):
+        super(RequestsSolrFetcherStreamingTestCase, self).setUp()
+        self.docs = [{'id': str(i), 'text': 'x' * i} for i in range(7)]
+        httpretty.enable()
+        httpretty.register_uri(
+            httpretty.GET,
+            'http://example.edu/solr',
+            responses=[
+                httpretty.Response(body=solr_page(self.docs[:5], 'c1')),
+                httpretty.Response(body=solr_page(self.docs[5:], 'c2')),
+                httpretty.Response(body=solr_page([], 'c2')),
+            ])
+
+    def tearDown(self):
+        super(RequestsSolrFetcherStreamingTestCase, self).tearDown()
+        httpretty.disable()
+        httpretty.reset()
+
+    def testStreaming(self):
+        '''Pages are returned in objsets of stream_batch docs'''
+        h = fetcher.RequestsSolrFetcher('http://example.edu/solr',
+                                        'q=*:*&streaming=true')
+        h.stream_batch = 2
+        self.assertNotIn('streaming', h.url_request)
+        objsets = list(h)
+        self.assertEqual([len(objset) for objset in objsets], [2, 2, 1, 2])
+        self.assertEqual(sum(objsets, []), self.docs)
+        self.assertEqual(h._nextCursorMark, 'c2')
+
+    def testResume(self):
+        '''A checkpoint in the middle of a page asks for the page again
+        and skips the docs already returned'''
+        h = fetcher.RequestsSolrFetcher('http://example.edu/solr', 'q=*:*',
+                                        streaming=True)
+        h.stream_batch = 2
+        docs = h.next()
+        checkpoint = h.get_checkpoint()
+        self.assertEqual(checkpoint, {'_cursorMark': '*',
+                                      '_nextCursorMark': None,
+                                      'page_offset': 2})
+        httpretty.register_uri(
+            httpretty.GET,
+            'http://example.edu/solr',
+            responses=[
+                httpretty.Response(body=solr_page(self.docs[:5], 'c1')),
+                httpretty.Response(body=solr_page(self.docs[5:], 'c2')),
+                httpretty.Response(body=solr_page([], 'c2')),
+            ])
+        h = fetcher.RequestsSolrFetcher('http://example.edu/solr', 'q=*:*',
+                                        streaming=True)
+        h.stream_batch = 2
+        h.resume(checkpoint)
+        for objset in h:
+            docs.extend(objset)
+        self.assertEqual(docs, self.docs)
+        self.assertIn('cursorMark=*&',
+                      httpretty.core.httpretty.latest_requests[-3].path)
+
 
 class HarvestSolr_ControllerTestCase(ConfigFileOverrideMixin, LogOverrideMixin,
                                      TestCase):
@@ -1,8 +1,11 @@
 import os
+import shutil
+import tempfile
 from unittest import TestCase
 import json
 from datetime import datetime as DT
-from mock import patch
+from mock import patch, Mock
+from solr import SolrException
 from test.utils import DIR_FIXTURES
 from test.utils import ConfigFileOverrideMixin
 from harvester.solr_updater import push_doc_to_solr, map_couch_to_solr_doc
@@ -16,6 +19,11 @@ from harvester.solr_updater import get_sort_collection_data_string
 from harvester.solr_updater import map_registry_data
 from harvester.solr_updater import UTC
 from harvester.solr_updater import dejson
+from harvester.solr_updater import unpack_if_json, dejson_stats
+from harvester.solr_updater import DEJSON_CACHE
+from harvester.solr_updater import DATE_CACHE, unpack_date, get_facet_decades
+from harvester.solr_updater import load_date_cache, save_date_cache
+from harvester.solr_updater import date_cache_key
 from harvester.solr_updater import check_nuxeo_media
 from harvester.solr_updater import MissingSourceResource
 from harvester.solr_updater import MissingTitle
@@ -27,6 +35,8 @@ from harvester.solr_updater import MediaJSONError
 from harvester.solr_updater import MissingMediaJSON
 from harvester.solr_updater import sync_couch_collection_to_solr
 from harvester.solr_updater import harvesting_report
+from harvester.solr_updater import SolrBulkIndexer
+from harvester.solr_updater import map_couch_docs_parallel
 from botocore.exceptions import ClientError
 
 
@@ -449,6 +459,65 @@ class SolrUpdaterTestCase(ConfigFileOverrideMixin, TestCase):
             "Venice (Los Angeles, Calif.)", "Los Angeles (Calif.)"
         ])
 
+    def test_unpack_if_json(self):
+        '''Only strings that may be JSON objects are parsed, their results
+        are cached'''
+        DEJSON_CACHE.clear()
+        stats = dejson_stats()
+        for value in ('Los Angeles (Calif.)', '5', '[1, 2]', '"quoted"',
+                      'null', '', '{not json'):
+            self.assertEqual(unpack_if_json('subject', value), value)
+        self.assertEqual(dejson_stats()['skipped'], stats['skipped'] + 6)
+        self.assertEqual(dejson_stats()['misses'], 1)
+        self.assertEqual(unpack_if_json('subject', '{not json'), '{not json')
+        self.assertEqual(dejson_stats()['hits'], 1)
+        for i in range(2):
+            self.assertEqual(
+                unpack_if_json('creator', u' \n{"name": "Pierce, C.C."}'),
+                u'Pierce, C.C.')
+            self.assertEqual(unpack_if_json('creator', '{"role": "a"}'),
+                             '{"role": "a"}')
+        self.assertEqual(dejson_stats()['hits'], 3)
+        self.assertEqual(dejson_stats()['misses'], 3)
+        self.assertEqual(unpack_if_json('creator', '{"name": ["a"]}'), ['a'])
+        self.assertNotIn('{"name": ["a"]}', DEJSON_CACHE)
+        self.assertRaises(TypeError, unpack_if_json, 'extent', 5)
+
+    def test_date_cache(self):
+        '''Dates & decades are computed once for equal date structures and
+        the cache can be saved for the next run'''
+        DATE_CACHE.clear()
+        date = {'begin': '1885', 'end': '1889-12-31',
+                'displayDate': '1885-1889'}
+        dates = unpack_date([date])
+        self.assertEqual(dates[0], ['1885-1889'])
+        self.assertEqual(dates[1][0].year, 1885)
+        dates[0].append('changed')
+        self.assertEqual(unpack_date([dict(date)])[0], ['1885-1889'])
+        decades = get_facet_decades(date)
+        self.assertEqual(decades, set(['1880s']))
+        decades.add('changed')
+        self.assertEqual(get_facet_decades(date), set(['1880s']))
+        self.assertEqual(unpack_date(date)[2][0].month, 12)
+        self.assertEqual(DATE_CACHE.stats(),
+                         {'hits': 2, 'misses': 3, 'size': 3})
+        with patch('harvester.solr_updater.facet_decade',
+                   side_effect=AttributeError('bad date')):
+            self.assertRaises(AttributeError, get_facet_decades,
+                              {'displayDate': '1900'})
+        self.assertEqual(len(DATE_CACHE), 3)
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, 'dates.pkl')
+        with patch.dict(os.environ, {'DATE_CACHE_FILE': path}):
+            save_date_cache()
+            DATE_CACHE.clear()
+            load_date_cache()
+        shutil.rmtree(tmpdir)
+        self.assertEqual(len(DATE_CACHE), 3)
+        self.assertEqual(unpack_date(date)[2][0].tzinfo.utcoffset(None),
+                         UTC.utcoffset(None))
+        self.assertEqual(DATE_CACHE.hits, 1)
+
     def test_dejson_from_map(self):
         '''Test that the dejson works from the mapping function'''
         doc = json.load(open(DIR_FIXTURES + '/couchdb_ucla.json'))
@@ -514,6 +583,147 @@ class SolrUpdaterTestCase(ConfigFileOverrideMixin, TestCase):
             check_nuxeo_media, doc)
 
 
+    def test_map_couch_docs_parallel(self):
+        '''Chunks of docs are mapped in order with a report of the docs
+        left out, the same with a pool of processes or inline'''
+        doc = json.load(open(DIR_FIXTURES + '/couchdb_doc.json'))
+        docs = []
+        for i in range(25):
+            d = json.loads(json.dumps(doc))
+            d['_id'] = 'id-{}'.format(i)
+            d['sourceResource']['creator'] = ['{"name": "Pierce, C.C."}']
+            if i % 10 == 3:
+                del d['sourceResource']
+            elif i % 10 == 7:
+                del d['isShownAt']
+            docs.append(d)
+        expected = map_couch_to_solr_doc(json.loads(json.dumps(docs[0])))
+        skipped = []
+        for processes in (1, 2):
+            DEJSON_CACHE.clear()
+            results = list(map_couch_docs_parallel(
+                (json.loads(json.dumps(d)) for d in docs),
+                processes=processes, chunk_size=10))
+            self.assertEqual(len(results), 3)
+            self.assertEqual([len(solr_docs) for solr_docs, r, c in results],
+                             [8, 8, 4])
+            skipped.append(sum(c['skipped'] for s, r, c in results))
+            self.assertEqual(
+                sum(c['hits'] + c['misses'] for s, r, c in results), 20)
+            self.assertEqual(results[0][0][0], expected)
+            self.assertEqual(results[0][1], {'Missing SourceResource': 1,
+                                             'Missing isShownAt': 1})
+            self.assertEqual(results[2][1], {'Missing SourceResource': 1})
+        self.assertGreater(skipped[0], 0)
+        self.assertEqual(skipped[0], skipped[1])
+
+    def test_map_couch_docs_parallel_date_cache(self):
+        '''The dates cached by the mapping processes are saved for the next
+        run'''
+        doc = json.load(open(DIR_FIXTURES + '/couchdb_doc.json'))
+        date = doc['sourceResource']['date']
+        docs = []
+        for i in range(20):
+            d = json.loads(json.dumps(doc))
+            d['_id'] = 'id-{}'.format(i)
+            docs.append(d)
+        DATE_CACHE.clear()
+        results = list(map_couch_docs_parallel(docs, processes=2,
+                                               chunk_size=5))
+        self.assertEqual(sum(len(r[0]) for r in results), 20)
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, 'dates.pkl')
+        with patch.dict(os.environ, {'DATE_CACHE_FILE': path}):
+            save_date_cache()
+            DATE_CACHE.clear()
+            load_date_cache()
+        shutil.rmtree(tmpdir)
+        self.assertGreater(len(DATE_CACHE), 0)
+        self.assertIn(date_cache_key('dates', date), DATE_CACHE)
+
+    def test_bulk_indexer(self):
+        '''Docs are added in batches by count or size, a batch with bad
+        docs is split until the bad docs are found'''
+        def add_many(docs):
+            if any(doc['id'] in ('bad-3', 'bad-8') for doc in docs):
+                raise SolrException(400, 'bad doc')
+        solr_db = Mock()
+        solr_db.add_many.side_effect = add_many
+        solr_db.add.side_effect = lambda doc: add_many([doc])
+        indexer = SolrBulkIndexer(solr_db, batch_docs=4, in_flight=1)
+        docs = [{'id': '{}-{}'.format('bad' if i in (3, 8) else 'ok', i),
+                 'harvest_id_s': str(i), 'collection_url': 'c'}
+                for i in range(10)]
+        for doc in docs[:4]:
+            indexer.add(doc)
+        self.assertEqual(indexer.num_added, 3)
+        for doc in docs[4:]:
+            indexer.add(doc)
+        self.assertEqual(indexer.flush(), 8)
+        added = [call[0][0] for call in solr_db.add_many.call_args_list]
+        self.assertEqual(added, [docs[:4], docs[:2], docs[2:4], docs[4:8],
+                                 docs[8:]])
+        self.assertEqual(solr_db.add.call_count, 4)
+        indexer = SolrBulkIndexer(solr_db, batch_docs=100, batch_bytes=100,
+                                  in_flight=1)
+        solr_db.add_many.reset_mock()
+        indexer.add(docs[0])
+        indexer.add(docs[1])
+        self.assertEqual(solr_db.add_many.call_count, 1)
+        solr_db.add_many.side_effect = SolrException(500, 'down')
+        indexer.add(docs[2])
+        self.assertRaises(SolrException, indexer.add, docs[4])
+
+    @patch('harvester.solr_updater.Solr')
+    def test_bulk_indexer_in_flight(self, mock_solr):
+        '''Batches in flight use a connection per thread'''
+        solr_db = Mock()
+        solr_db.url = 'http://solr.example.edu/'
+        # made before the threads use them, so they all share these mocks
+        mock_solr.return_value = Mock(add_many=Mock(), add=Mock())
+        indexer = SolrBulkIndexer(solr_db, batch_docs=2, in_flight=3)
+        for i in range(9):
+            indexer.add({'id': str(i), 'harvest_id_s': str(i)})
+        self.assertEqual(indexer.flush(), 9)
+        mock_solr.assert_called_with('http://solr.example.edu/')
+        added = []
+        for call in mock_solr.return_value.add_many.call_args_list:
+            added.extend(call[0][0])
+        mock_solr.return_value.add.assert_called_once_with(
+            {'id': '8', 'harvest_id_s': '8'})
+        self.assertEqual(sorted(doc['id'] for doc in added),
+                         [str(i) for i in range(8)])
+        self.assertEqual(solr_db.add_many.call_count, 0)
+        self.assertIsNone(indexer._pool)
+
+    @patch('harvester.solr_updater.Solr')
+    def test_bulk_indexer_in_flight_error(self, mock_solr):
+        '''An error in a batch in flight stops the threads'''
+        solr_db = Mock()
+        solr_db.url = 'http://solr.example.edu/'
+        mock_solr.return_value.add_many.side_effect = SolrException(
+            500, 'down')
+        indexer = SolrBulkIndexer(solr_db, batch_docs=2, in_flight=2)
+        for i in range(4):
+            indexer.add({'id': str(i), 'harvest_id_s': str(i)})
+        pool = indexer._pool
+        with patch.object(pool, 'terminate', wraps=pool.terminate) as \
+                mock_terminate:
+            self.assertRaises(SolrException, indexer.flush)
+        self.assertEqual(mock_terminate.call_count, 1)
+        self.assertIsNone(indexer._pool)
+        self.assertEqual(indexer._pending, [])
+        for i in range(4):
+            indexer.add({'id': str(i), 'harvest_id_s': str(i)})
+        pool = indexer._pool
+        with patch.object(pool, 'terminate', wraps=pool.terminate) as \
+                mock_terminate:
+            indexer.add({'id': '4', 'harvest_id_s': '4'})
+            self.assertRaises(SolrException, indexer.add,
+                              {'id': '5', 'harvest_id_s': '5'})
+        self.assertEqual(mock_terminate.call_count, 1)
+        self.assertIsNone(indexer._pool)
+
     @patch('harvester.solr_updater.MediaJson', autospec=True)
     @patch('harvester.solr_updater.publish_to_harvesting')
     @patch('harvester.solr_updater.Solr', autospec=True)
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 from unittest import TestCase
+from mock import patch
 from mypretty import httpretty
 # import httpretty
 import harvester.fetcher as fetcher
@@ -54,6 +55,47 @@ class UCDFetcherTestCase(LogOverrideMixin, TestCase):
         self.assertEqual(test2['metadata']['license'],
                          'http://rightsstatements.org/vocab/InC-NC/1.0/')
 
+    @httpretty.activate
+    def testObjsetsConcurrent(self):
+        '''Records come in objsets of page_size, in sitemap order, when
+        fetched by threads & extracted by processes'''
+        url = 'https://digital.ucdavis.edu/sitemap-eastman.xml'
+        httpretty.register_uri(
+            httpretty.GET,
+            url,
+            body=open(DIR_FIXTURES + '/ucd-sitemap.xml').read(),
+            status=200)
+        for n, rec in enumerate(('B-1022', 'B-1912', 'B-1160'), 1):
+            httpretty.register_uri(
+                httpretty.GET,
+                'https://digital.ucdavis.edu/record/collection/eastman/B-1/'
+                + rec,
+                body=open(
+                    DIR_FIXTURES + '/ucd-recpage-{}.xml'.format(n)).read(),
+                status=200)
+        serial = [obj for objset in fetcher.UCD_JSON_Fetcher(
+            url, None, fetch_concurrency=1, extract_processes=1)
+            for obj in objset]
+        h = fetcher.UCD_JSON_Fetcher(url, None, page_size=2,
+                                     fetch_concurrency=2, extract_processes=2)
+        self.assertEqual(h.page_last, 2)
+        self.assertIsNotNone(h._extract_pool)
+        objsets = list(h)
+        self.assertEqual([len(objset) for objset in objsets], [2, 1])
+        self.assertEqual(objsets[0] + objsets[1], serial)
+        self.assertEqual(h.docs_fetched, 3)
+        self.assertIsNone(h._extract_pool)
+        h = fetcher.UCD_JSON_Fetcher(url, None, page_size=2,
+                                     extract_processes=2)
+        pool = h._extract_pool
+        h.next()
+        with patch.object(pool, 'terminate', wraps=pool.terminate) as \
+                mock_terminate:
+            h.close()
+        self.assertEqual(mock_terminate.call_count, 1)
+        self.assertIsNone(h._extract_pool)
+        self.assertIsNone(fetcher.UCD_JSON_Fetcher(url, None)._extract_pool)
+
 # Copyright © 2016, Regents of the University of California
 # All rights reserved.
 # Redistribution and use in source and binary forms, with or without
@@ -40,6 +40,27 @@ class XMLFetcherTestCase(LogOverrideMixin, TestCase):
         self.assertEqual(test2['metadata']['q'], ['scanned'])
         self.assertEqual(test2['metadata']['d'], ['Epson'])
 
+    @httpretty.activate
+    def testStreaming(self):
+        '''Streaming mode returns the same records in objsets of 1000'''
+        url = 'https://s3.amazonaws.com/pastperfectonline/xmlfiles/museum_231'
+        httpretty.register_uri(
+            httpretty.GET,
+            url,
+            body=open(DIR_FIXTURES + '/xml-fetch.xml').read())
+        docs = []
+        for d in fetcher.XML_Fetcher(url, None):
+            docs.extend(d)
+        h = fetcher.XML_Fetcher(url, 'streaming')
+        self.assertTrue(h.streaming)
+        self.assertFalse(hasattr(h, 'hits'))
+        objsets = list(h)
+        self.assertEqual([len(objset) for objset in objsets],
+                         [1000, 1000, 320])
+        self.assertEqual(h.docs_fetched, 2320)
+        self.assertTrue(h.xml_file.closed)
+        self.assertEqual([obj for objset in objsets for obj in objset], docs)
+
 # Copyright © 2016, Regents of the University of California
 # All rights reserved.
 # Redistribution and use in source and binary forms, with or without